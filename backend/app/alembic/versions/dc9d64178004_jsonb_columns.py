@@ -0,0 +1,57 @@
+"""jsonb columns
+
+Revision ID: dc9d64178004
+Revises: e46762d184b0
+Create Date: 2026-10-17 02:18:06.035492
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'dc9d64178004'
+down_revision = 'e46762d184b0'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    ('grower', 'id_card_photo'),
+    ('grower', 'land_ownership_certificate'),
+    ('grower', 'crop_type_pic'),
+    ('grower', 'business_license_photos'),
+    ('middleman', 'transaction_contracts'),
+    ('middleman', 'id_card_photo'),
+    ('middleman', 'business_license_photos'),
+    ('middleman', 'transaction_contract_images'),
+    ('middleman', 'split_quantities'),
+    ('middleman', 'split_qr_codes'),
+    ('middleman', 'original_split'),
+    ('middleman', 'original_qr_codes'),
+    ('middlemanlineage', 'quantity_path'),
+]
+
+
+def upgrade():
+    for table, column in COLUMNS:
+        op.alter_column(table, column,
+                   existing_type=postgresql.JSON(astext_type=sa.Text()),
+                   type_=postgresql.JSONB(astext_type=sa.Text()),
+                   existing_nullable=True,
+                   postgresql_using=f'{column}::jsonb')
+    # the type change above rewrites the tables under an exclusive lock; the
+    # GIN index is built afterwards without blocking writes
+    with op.get_context().autocommit_block():
+        op.create_index('ix_middleman_split_qr_codes', 'middleman', ['split_qr_codes'], unique=False, postgresql_using='gin', postgresql_ops={'split_qr_codes': 'jsonb_path_ops'}, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_middleman_split_qr_codes', table_name='middleman', postgresql_concurrently=True)
+    for table, column in reversed(COLUMNS):
+        op.alter_column(table, column,
+                   existing_type=postgresql.JSONB(astext_type=sa.Text()),
+                   type_=postgresql.JSON(astext_type=sa.Text()),
+                   existing_nullable=True,
+                   postgresql_using=f'{column}::json')
@@ -0,0 +1,37 @@
+"""add hot path indexes
+
+Revision ID: e46762d184b0
+Revises: b833c56b8220
+Create Date: 2026-10-17 02:15:44.211646
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel.sql.sqltypes
+
+
+# revision identifiers, used by Alembic.
+revision = 'e46762d184b0'
+down_revision = 'b833c56b8220'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block; build
+    # without blocking writes to these tables while the migration runs
+    with op.get_context().autocommit_block():
+        op.create_index('ix_grower_phone_number', 'grower', ['phone_number'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_middleman_purchase_from', 'middleman', ['purchase_from_type', 'purchase_from_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_product_grower_id_name', 'product', ['grower_id', 'name'], unique=False, postgresql_concurrently=True)
+        op.create_index(op.f('ix_transaction_parent_transaction_id'), 'transaction', ['parent_transaction_id'], unique=False, postgresql_concurrently=True)
+        op.create_index('ix_transaction_seller', 'transaction', ['seller_type', 'seller_id'], unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_transaction_seller', table_name='transaction', postgresql_concurrently=True)
+        op.drop_index(op.f('ix_transaction_parent_transaction_id'), table_name='transaction', postgresql_concurrently=True)
+        op.drop_index('ix_product_grower_id_name', table_name='product', postgresql_concurrently=True)
+        op.drop_index('ix_middleman_purchase_from', table_name='middleman', postgresql_concurrently=True)
+        op.drop_index('ix_grower_phone_number', table_name='grower', postgresql_concurrently=True)
@@ -1,15 +1,24 @@
-from collections.abc import Generator
+import time
+from collections.abc import AsyncGenerator, Generator
 from typing import Annotated
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from pydantic import ValidationError
+from starlette.concurrency import run_in_threadpool
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.core import security
 from app.core.config import settings
-from app.core.db import engine
+from app.core.db import (
+    async_engine,
+    async_replica_engine,
+    engine,
+    replica_engine,
+    replica_health,
+)
 from app.models import TokenPayload, User
 
 reusable_oauth2 = OAuth2PasswordBearer(
@@ -22,7 +31,66 @@ def get_db() -> Generator[Session, None, None]:
         yield session
 
 
+async def get_async_db() -> AsyncGenerator[AsyncSession, None]:
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+# 写请求成功后由中间件设置，窗口内该客户端的读请求仍走主库
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+
+def read_only(request: Request) -> None:
+    # 无副作用的 POST 路由依赖此项，成功后不开启读己之写窗口
+    request.state.read_only = True
+
+
+def wants_replica(request: Request) -> bool:
+    if replica_health is None:
+        return False
+    until = request.cookies.get(READ_PRIMARY_COOKIE)
+    if until:
+        try:
+            if float(until) > time.time():
+                return False
+        except ValueError:
+            pass
+    return True
+
+
+def get_read_db(request: Request) -> Generator[Session, None, None]:
+    bind = engine
+    if wants_replica(request) and replica_health.is_healthy():
+        bind = replica_engine
+    with Session(bind) as session:
+        yield session
+
+
+async def get_async_read_db(
+        request: Request) -> AsyncGenerator[AsyncSession, None]:
+    bind = async_engine
+    if wants_replica(request):
+        # 健康检查是同步查询，到期时放到线程池执行，避免阻塞事件循环
+        if replica_health.is_stale():
+            healthy = await run_in_threadpool(replica_health.check)
+        else:
+            healthy = replica_health.healthy
+        if healthy:
+            bind = async_replica_engine
+    async with AsyncSession(bind, expire_on_commit=False) as session:
+        yield session
+
+
+def reads_primary(session: AsyncSession) -> bool:
+    # 副本可能尚未回放最近的写入，共享缓存只能用主库读到的结果填充
+    return session.bind is async_engine
+
+
 SessionDep = Annotated[Session, Depends(get_db)]
+AsyncSessionDep = Annotated[AsyncSession, Depends(get_async_db)]
+# 只读路由使用：副本健康且不在读己之写窗口内时读副本，否则读主库
+ReadSessionDep = Annotated[Session, Depends(get_read_db)]
+AsyncReadSessionDep = Annotated[AsyncSession, Depends(get_async_read_db)]
 TokenDep = Annotated[str, Depends(reusable_oauth2)]
 
 
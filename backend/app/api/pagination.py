@@ -0,0 +1,42 @@
+import base64
+import json
+from collections.abc import Sequence
+from typing import Any, Optional
+
+from fastapi import HTTPException
+
+
+def encode_cursor(last_id: int) -> str:
+    raw = json.dumps({"id": last_id}, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return int(json.loads(raw)["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def paginate(statement: Any, id_column: Any, *, skip: int, limit: int,
+             cursor: Optional[str]) -> Any:
+    """
+    Order ``statement`` by ``id_column`` and page it.
+
+    With a ``cursor`` the page starts right after the id it encodes (keyset),
+    so deep pages cost the same as the first one; without it the old
+    ``skip`` offset is used for compatibility.
+    """
+    if cursor:
+        statement = statement.where(id_column > decode_cursor(cursor))
+    elif skip:
+        statement = statement.offset(skip)
+    return statement.order_by(id_column).limit(limit)
+
+
+def next_cursor(rows: Sequence[Any], limit: int) -> Optional[str]:
+    # 本页取满时才可能还有下一页
+    if rows and len(rows) == limit:
+        return encode_cursor(rows[-1].id)
+    return None
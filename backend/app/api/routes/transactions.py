@@ -1,20 +1,37 @@
 import json
-from sqlalchemy.orm import joinedload
-from typing import Any, List, Dict
-from pydantic import BaseModel
-from fastapi import APIRouter, HTTPException
-from sqlmodel import select, func
+import os
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import selectinload
+from typing import Any, List, Dict, Optional
+from pydantic import BaseModel, Field
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
+from sqlmodel import Session, select, func
+from starlette.concurrency import run_in_threadpool
 from urllib.parse import urljoin
 from fastapi.requests import Request
-from app.api.deps import SessionDep
+from app.api.pagination import next_cursor, paginate
+from app.api.deps import (AsyncReadSessionDep, AsyncSessionDep, SessionDep,
+                          get_current_active_superuser, read_only,
+                          reads_primary)
+from app import qr_labels, qr_render
+from app.core import cache
+from app.qr_cache import image_cache_key, qr_image_cache
+from app.qr_token import decode_qr_token, encode_qr_token
 from app.core.config import settings
+from app.core.db import engine, get_pool_stats
 from app.models import (
     Grower,
     GrowerCreate,
     GrowerRead,
+    GrowerSummary,
     Middleman,
     MiddlemanCreate,
     MiddlemanRead,
+    PageResponse,
     Plot,
     PlotCreate,
     PlotRead,
@@ -22,16 +39,66 @@ from app.models import (
     ProductCreate,
     ProductRead,
     QRCodeInfo,
+    QRCodePayload,
     ResponseBase,
+    SplitLot,
+    SplitLotRead,
+    SplitLotRepackage,
     Transaction,
     TransactionCreate,
     TransactionRead,
 )
-from app.utils import generate_qr_code, decode_qr_code
-from app.crud import get_product_by_name, get_product_by_grower_and_name, get_grower_by_id
+from app.utils import (generate_qr_code, qr_code_filename_from_url,
+                       qr_code_url)
+from app.crud import (
+    create_middleman_lineage,
+    create_child_split_lots,
+    create_qr_code_payload,
+    create_qr_code_payloads,
+    create_split_lots,
+    decrement_middleman_remaining,
+    decrement_middlemen_remaining,
+    decrement_split_lot_remaining,
+    decrement_split_lots_remaining,
+    decrement_product_yield,
+    decrement_products_yield,
+    get_qr_code_info as get_transaction_qr_code_info,
+    get_product_by_name,
+    get_product_by_grower_and_name,
+    get_products_by_grower_and_names,
+    get_grower_by_id,
+    get_middleman_upstream,
+    get_middleman_by_split_qr_code,
+    get_middlemen_upstream,
+    get_qr_code_payload,
+    get_recall_statement,
+    get_inventory_balance,
+    get_next_split_index,
+    get_split_lot,
+    get_split_lots,
+    get_split_lots_by_middlemen,
+    get_split_lots_by_keys,
+    record_inventory_movement,
+    restore_split_lots_remaining,
+)
 
 router = APIRouter()
 BASE_URL = f"https://{settings.DOMAIN}"
+GROWER_QR_DIRECTORY = "uploads/grower_qrcodes"
+MIDDLEMAN_QR_DIRECTORY = "uploads/middleman_qrcodes"
+TRANSACTION_QR_DIRECTORY = "uploads/transaction_qrcodes"
+# 二维码来源类型对应的图片目录
+QR_DIRECTORIES = {
+    "grower": GROWER_QR_DIRECTORY,
+    "middleman": MIDDLEMAN_QR_DIRECTORY,
+    "transaction": TRANSACTION_QR_DIRECTORY,
+}
+
+
+def grower_qr_payload(grower_id: int) -> str:
+    if settings.QR_PAYLOAD_FORMAT == "token":
+        return encode_qr_token("grower", grower_id)
+    return json.dumps({"id": grower_id})
 
 
 @router.post("/growers/", response_model=ResponseBase[GrowerRead])
@@ -58,12 +125,23 @@ def create_grower(
                     remaining_yield=product_data.total_yield,
                 )
                 session.add(product)
+                session.flush()
+                record_inventory_movement(session=session,
+                                          node_type="product",
+                                          node_id=product.id,
+                                          delta=product.total_yield,
+                                          reason="stock")
         session.commit()
-        qr_data = json.dumps({"id": grower.id})
+        qr_data = grower_qr_payload(grower.id)
         # qr_data = f"Grower ID: {grower.id}, Name: {grower.name or grower.company_name}"
         qr_code_filename = generate_qr_code(qr_data,
                                             prefix="grower",
-                                            directory="uploads/grower_qrcodes")
+                                            directory=GROWER_QR_DIRECTORY)
+        # 记录二维码内容，图片未预先生成时据此按需渲染
+        create_qr_code_payload(session=session,
+                               qr_code=qr_code_filename[0],
+                               payload=qr_data,
+                               source_type="grower")
         grower.qr_code = qr_code_filename[1]
         session.commit()
         session.refresh(grower)
@@ -80,39 +158,44 @@ def create_grower(
 #     return ResponseBase(message="Growers retrieved successfully", data=growers)
 
 
-@router.get("/growers/", response_model=ResponseBase[List[GrowerRead]])
-def list_growers(session: SessionDep, skip: int = 0, limit: int = 100) -> Any:
-    statement = (select(Grower).options(
-        joinedload(Grower.plots),
-        joinedload(Grower.products).load_only(
-            Product.id, Product.remaining_yield)).offset(skip).limit(limit))
-    growers = session.exec(statement).unique().all()
-
-    # 手动构建响应数据
-    grower_data = []
-    for grower in growers:
-        grower_dict = grower.dict()
-        grower_dict['products'] = [{
-            "id": product.id,
-            "remaining_yield": product.remaining_yield
-        } for product in grower.products]
-        grower_data.append(grower_dict)
-
-    return ResponseBase(message="Growers retrieved successfully",
-                        data=grower_data)
+@router.get("/growers/", response_model=PageResponse[List[GrowerSummary]])
+async def list_growers(session: AsyncReadSessionDep,
+                       skip: int = 0,
+                       limit: int = 100,
+                       cursor: Optional[str] = None) -> Any:
+    # selectinload 为地块和产品各发一条 IN 查询，LIMIT 只作用于种植者行，
+    # 不会像 joinedload 那样按 地块 × 产品 膨胀结果集
+    statement = select(Grower).options(
+        selectinload(Grower.plots),
+        selectinload(Grower.products).load_only(Product.id,
+                                                Product.remaining_yield))
+    statement = paginate(statement,
+                         Grower.id,
+                         skip=skip,
+                         limit=limit,
+                         cursor=cursor)
+    growers = (await session.exec(statement)).all()
+
+    return PageResponse(
+        message="Growers retrieved successfully",
+        data=[
+            GrowerSummary.model_validate(grower, from_attributes=True)
+            for grower in growers
+        ],
+        next_cursor=next_cursor(growers, limit))
 
 
 @router.get("/growers/{grower_id}", response_model=ResponseBase[GrowerRead])
-def read_grower(
-    session: SessionDep,
+async def read_grower(
+    session: AsyncReadSessionDep,
     grower_id: int,
 ) -> Any:
-    # 使用 joinedload 预加载 plots 和 products
+    # 使用 selectinload 分别预加载 plots 和 products，每个集合一条查询
     query = select(Grower).options(
-        joinedload(Grower.plots),
-        joinedload(Grower.products)).where(Grower.id == grower_id)
+        selectinload(Grower.plots),
+        selectinload(Grower.products)).where(Grower.id == grower_id)
 
-    grower = session.exec(query).first()
+    grower = (await session.exec(query)).first()
 
     if not grower:
         return ResponseBase(message="Grower not found", code=404)
@@ -137,11 +220,11 @@ def create_plot(
 
 
 @router.get("/plots/{plot_id}", response_model=ResponseBase[PlotRead])
-def read_plot(
-    session: SessionDep,
+async def read_plot(
+    session: AsyncSessionDep,
     plot_id: int,
 ) -> Any:
-    plot = session.get(Plot, plot_id)
+    plot = await session.get(Plot, plot_id)
     if not plot:
         return ResponseBase(message="Plot not found", code=404)
     return ResponseBase(message="Plot retrieved successfully", data=plot)
@@ -155,22 +238,55 @@ def create_product(
     product = Product.model_validate(
         product_in, update={"remaining_yield": product_in.total_yield})
     session.add(product)
+    session.flush()
+    record_inventory_movement(session=session,
+                              node_type="product",
+                              node_id=product.id,
+                              delta=product.total_yield,
+                              reason="stock")
     session.commit()
     session.refresh(product)
     return ResponseBase(message="Product created successfully", data=product)
 
 
 @router.get("/products/{product_id}", response_model=ResponseBase[ProductRead])
-def read_product(
-    session: SessionDep,
+async def read_product(
+    session: AsyncSessionDep,
     product_id: int,
 ) -> Any:
-    product = session.get(Product, product_id)
+    product = await session.get(Product, product_id)
     if not product:
         return ResponseBase(message="Product not found", code=404)
     return ResponseBase(message="Product retrieved successfully", data=product)
 
 
+def build_middleman(middleman: MiddlemanCreate) -> Middleman:
+    # 数据验证
+    if not middleman.purchased_quantity or middleman.purchased_quantity <= 0:
+        raise ValueError("Purchased quantity must be positive")
+
+    db_middleman = Middleman(**middleman.model_dump(
+        exclude={"split_quantities", "transaction_contract_images"}))
+
+    db_middleman.split_quantities = middleman.split_quantities or [
+        middleman.purchased_quantity
+    ]
+    # db_middleman.split_qr_codes = []
+    db_middleman.transaction_contract_images = middleman.transaction_contract_images or []
+
+    # 确保拆分数量的总和等于购买数量
+    if sum(db_middleman.split_quantities) != db_middleman.purchased_quantity:
+        raise ValueError(
+            "Sum of split quantities must equal purchased quantity")
+    if db_middleman.purchase_from_type not in ("grower", "middleman"):
+        raise ValueError("Invalid purchase_from_type")
+    if (db_middleman.purchase_from_split_index is not None
+            and db_middleman.purchase_from_type != "middleman"):
+        raise ValueError(
+            "purchase_from_split_index requires a middleman source")
+    return db_middleman
+
+
 @router.post("/middlemen/", response_model=ResponseBase[MiddlemanRead])
 def create_middleman(
     session: SessionDep,
@@ -178,49 +294,46 @@ def create_middleman(
 ) -> Any:
     try:
         with session.begin():
-            # 数据验证
-            if middleman.purchased_quantity <= 0:
-                raise ValueError("Purchased quantity must be positive")
-
-            db_middleman = Middleman(**middleman.model_dump(
-                exclude={"split_quantities", "transaction_contract_images"}))
-
-            db_middleman.split_quantities = middleman.split_quantities or [
-                middleman.purchased_quantity
-            ]
-            # db_middleman.split_qr_codes = []
-            db_middleman.transaction_contract_images = middleman.transaction_contract_images or []
-
-            # 确保拆分数量的总和等于购买数量
-            if sum(db_middleman.split_quantities
-                   ) != db_middleman.purchased_quantity:
-                raise ValueError(
-                    "Sum of split quantities must equal purchased quantity")
+            db_middleman = build_middleman(middleman)
 
             # 处理购买来源
             if db_middleman.purchase_from_type == "grower":
-                handle_purchase_from_grower(session, db_middleman)
+                seller_node = handle_purchase_from_grower(session, db_middleman)
             elif db_middleman.purchase_from_type == "middleman":
-                handle_purchase_from_middleman(session, db_middleman)
+                seller_node = handle_purchase_from_middleman(
+                    session, db_middleman)
             else:
                 raise ValueError("Invalid purchase_from_type")
 
             db_middleman.remaining_quantity = db_middleman.purchased_quantity
             session.add(db_middleman)
             session.flush()
+            record_purchase_movements(session, db_middleman, seller_node)
+
+            # 在同一事务中维护溯源闭包表和拆分批次
+            create_middleman_lineage(session=session, middlemen=[db_middleman])
+            create_split_lots(session=session, middlemen=[db_middleman])
 
-            # 生成QR码
-            qr_codes = generate_split_qr_codes(db_middleman)
-            main_qr_code = generate_main_qr_code(db_middleman)
+            # 记录QR码内容，图片在事务提交后由进程池生成
+            render_items: List[qr_render.RenderItem] = []
+            qr_codes = generate_split_qr_codes(session, db_middleman,
+                                               render_items)
+            main_qr_code = generate_main_qr_code(session, db_middleman,
+                                                 render_items)
 
             db_middleman.qr_code = main_qr_code
             db_middleman.split_qr_codes = qr_codes
 
+        render_id = qr_render.submit(render_items, MIDDLEMAN_QR_DIRECTORY)
+        # 卖方（种植者产品或上游中间商）库存已变化，清除包含该节点的溯源缓存
+        cache.invalidate_nodes([(db_middleman.purchase_from_type,
+                                 db_middleman.purchase_from_id)])
         session.refresh(db_middleman)
 
         response_data = db_middleman.dict()
         response_data["qr_codes"] = qr_codes
         response_data["main_qr_code"] = main_qr_code
+        response_data["qr_render_id"] = render_id
 
         return ResponseBase(
             message="Middleman transaction created successfully",
@@ -232,54 +345,322 @@ def create_middleman(
                             detail=f"An error occurred: {str(e)}")
 
 
-def handle_purchase_from_grower(session: SessionDep, db_middleman: Middleman):
-    grower = session.get(Grower, db_middleman.purchase_from_id)
-    if not grower:
-        raise ValueError("Grower not found")
+class MiddlemanBulkCreate(BaseModel):
+    items: List[MiddlemanCreate] = Field(
+        ..., min_length=1, max_length=settings.BULK_PURCHASE_MAX)
+
+
+class MiddlemanBulkItemResult(BaseModel):
+    index: int
+    success: bool
+    error: Optional[str] = None
+    middleman: Optional[MiddlemanRead] = None
+    qr_codes: List[str] = []
+    main_qr_code: Optional[str] = None
 
-    product = session.exec(
-        select(Product).where(
-            Product.grower_id == grower.id,
-            Product.name == db_middleman.purchased_product)).first()
+
+class MiddlemanBulkOut(BaseModel):
+    results: List[MiddlemanBulkItemResult]
+    created: int
+    failed: int
+    qr_render_id: Optional[str] = None
+    # 采购已提交但二维码记录失败时的原因，此时各成功条目不带二维码
+    qr_error: Optional[str] = None
+
+
+@router.post("/middlemen/bulk", response_model=ResponseBase[MiddlemanBulkOut])
+def create_middlemen_bulk(
+    session: SessionDep,
+    bulk_in: MiddlemanBulkCreate,
+) -> Any:
+    """
+    Register many purchases in one transaction.
+
+    Items are validated up front, inventory is decremented with one
+    set-based UPDATE per source table and all accepted rows are inserted
+    together. Quantities are aggregated per source, so when a grower product
+    or seller middleman cannot cover the sum of its items every item buying
+    from it fails. Items naming a split lot are also drawn from that lot,
+    aggregated the same way. QR codes are recorded after the purchases are
+    committed; if that fails the purchases stand, the items keep
+    ``success`` without QR codes and ``qr_error`` says why.
+    """
+    errors: Dict[int, str] = {}
+    pending: Dict[int, Middleman] = {}
+    for index, item in enumerate(bulk_in.items):
+        try:
+            pending[index] = build_middleman(item)
+        except ValueError as ve:
+            errors[index] = str(ve)
+
+    created: Dict[int, Middleman] = {}
+    try:
+        with session.begin():
+            from_grower = {
+                index: m
+                for index, m in pending.items()
+                if m.purchase_from_type == "grower"
+            }
+            from_middleman = {
+                index: m
+                for index, m in pending.items()
+                if m.purchase_from_type == "middleman"
+            }
+
+            # 一次查询解析所有 (种植者, 产品名) 对应的产品
+            products = get_products_by_grower_and_names(
+                session=session,
+                keys=[(m.purchase_from_id, m.purchased_product)
+                      for m in from_grower.values()])
+            product_ids: Dict[int, int] = {}
+            for index, m in from_grower.items():
+                product = products.get((m.purchase_from_id, m.purchased_product))
+                if product:
+                    product_ids[index] = product.id
+            missing_growers = {
+                m.purchase_from_id
+                for index, m in from_grower.items() if index not in product_ids
+            }
+            if missing_growers:
+                existing = set(
+                    session.exec(
+                        select(Grower.id).where(
+                            Grower.id.in_(missing_growers))))
+                for index, m in from_grower.items():
+                    if index not in product_ids:
+                        errors[index] = (
+                            "Product not found for this grower"
+                            if m.purchase_from_id in existing else
+                            "Grower not found")
+
+            # 按来源汇总数量，各用一条 UPDATE ... FROM (VALUES ...) 条件扣减
+            product_quantities: Dict[int, float] = defaultdict(float)
+            for index, product_id in product_ids.items():
+                product_quantities[product_id] += (
+                    from_grower[index].purchased_quantity)
+
+            # 指定批次的条目先按批次汇总扣减，批次不足的条目不再计入卖家
+            lot_quantities: Dict[tuple[int, int], float] = defaultdict(float)
+            for m in from_middleman.values():
+                if m.purchase_from_split_index is not None:
+                    lot_quantities[(m.purchase_from_id,
+                                    m.purchase_from_split_index)] += (
+                                        m.purchased_quantity)
+            decremented_lots = decrement_split_lots_remaining(
+                session=session, quantities=lot_quantities)
+            failed_lots = set(lot_quantities) - decremented_lots
+            existing_lots = set(
+                get_split_lots_by_keys(session=session,
+                                       keys=list(failed_lots)))
+            for index, m in list(from_middleman.items()):
+                key = (m.purchase_from_id, m.purchase_from_split_index)
+                if key in failed_lots:
+                    errors[index] = (
+                        "Insufficient remaining quantity in split lot"
+                        if key in existing_lots else "Split lot not found")
+                    del from_middleman[index]
+
+            seller_quantities: Dict[int, float] = defaultdict(float)
+            for m in from_middleman.values():
+                seller_quantities[m.purchase_from_id] += m.purchased_quantity
+
+            decremented_products = decrement_products_yield(
+                session=session, quantities=product_quantities)
+            decremented_sellers = decrement_middlemen_remaining(
+                session=session, quantities=seller_quantities)
+
+            for index, product_id in product_ids.items():
+                if product_id in decremented_products:
+                    created[index] = from_grower[index]
+                else:
+                    errors[index] = "Insufficient remaining yield from grower"
+            failed_sellers = set(seller_quantities) - decremented_sellers
+            # 卖家总量不足时，退回已为其扣减的批次
+            restore_split_lots_remaining(
+                session=session,
+                quantities={
+                    key: quantity
+                    for key, quantity in lot_quantities.items()
+                    if key in decremented_lots and key[0] in failed_sellers
+                })
+            existing_sellers = set(
+                session.exec(
+                    select(Middleman.id).where(
+                        Middleman.id.in_(failed_sellers)))
+            ) if failed_sellers else set()
+            for index, m in from_middleman.items():
+                if m.purchase_from_id in decremented_sellers:
+                    created[index] = m
+                elif m.purchase_from_id in existing_sellers:
+                    errors[index] = (
+                        "Insufficient remaining quantity from seller middleman")
+                else:
+                    errors[index] = "Seller middleman not found"
+
+            created = dict(sorted(created.items()))
+            for m in created.values():
+                m.remaining_quantity = m.purchased_quantity
+            # 同一映射的多行在 flush 时合并为多值 INSERT ... RETURNING
+            session.add_all(created.values())
+            session.flush()
+            for index, m in created.items():
+                record_purchase_movements(
+                    session, m,
+                    ("product", product_ids[index])
+                    if index in product_ids else
+                    ("middleman", m.purchase_from_id))
+            create_middleman_lineage(session=session,
+                                     middlemen=list(created.values()))
+            create_split_lots(session=session, middlemen=list(created.values()))
+
+            changed_nodes = {(m.purchase_from_type, m.purchase_from_id)
+                             for m in created.values()}
+            results = {
+                index: MiddlemanBulkItemResult(
+                    index=index,
+                    success=True,
+                    middleman=MiddlemanRead.model_validate(
+                        m.model_dump(exclude={"split_qr_codes"})))
+                for index, m in created.items()
+            }
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"An error occurred: {str(e)}")
+
+    cache.invalidate_nodes(changed_nodes)
+
+    # 采购已提交，批量记录二维码并在一个事务中写回，提交后再生成图片
+    render_id = None
+    qr_error = None
+    if created:
+        render_items: List[qr_render.RenderItem] = []
+        try:
+            with session.begin():
+                # 一次查询重新加载提交后已过期的对象，避免逐个 refresh
+                session.exec(
+                    select(Middleman).where(
+                        Middleman.id.in_([m.id for m in created.values()
+                                          ]))).all()
+                # 所有新建中间商的拆分批次一次查出
+                lots = get_split_lots_by_middlemen(
+                    session=session,
+                    middleman_ids=[m.id for m in created.values()])
+                for index, m in created.items():
+                    qr_codes = generate_split_qr_codes(session, m,
+                                                       render_items,
+                                                       lots.get(m.id, []))
+                    main_qr_code = generate_main_qr_code(
+                        session, m, render_items)
+                    m.qr_code = main_qr_code
+                    m.split_qr_codes = qr_codes
+                    result = results[index]
+                    result.middleman.qr_code = main_qr_code
+                    result.middleman.split_qr_codes = qr_codes
+                    result.qr_codes = qr_codes
+                    result.main_qr_code = main_qr_code
+        except Exception as e:
+            # 采购本身已提交，条目仍为成功，只撤回已填入的二维码
+            qr_error = f"QR code generation failed: {str(e)}"
+            for index in created:
+                result = results[index]
+                result.qr_codes = []
+                result.main_qr_code = None
+                result.middleman.qr_code = None
+                result.middleman.split_qr_codes = []
+        else:
+            render_id = qr_render.submit(render_items, MIDDLEMAN_QR_DIRECTORY)
+
+    for index, error in errors.items():
+        results[index] = MiddlemanBulkItemResult(index=index,
+                                                 success=False,
+                                                 error=error)
+
+    return ResponseBase(message="Bulk purchase processed",
+                        data=MiddlemanBulkOut(
+                            results=[results[i] for i in sorted(results)],
+                            created=len(created),
+                            failed=len(errors),
+                            qr_render_id=render_id,
+                            qr_error=qr_error))
+
+
+def record_purchase_movements(session: SessionDep, db_middleman: Middleman,
+                              seller_node: tuple[str, int]) -> None:
+    # 库存流水：卖方出库，买方入库
+    seller_type, seller_id = seller_node
+    record_inventory_movement(session=session,
+                              node_type=seller_type,
+                              node_id=seller_id,
+                              delta=-db_middleman.purchased_quantity,
+                              reason="sale",
+                              middleman_id=db_middleman.id)
+    record_inventory_movement(session=session,
+                              node_type="middleman",
+                              node_id=db_middleman.id,
+                              delta=db_middleman.purchased_quantity,
+                              reason="purchase",
+                              middleman_id=db_middleman.id)
+
+
+def handle_purchase_from_grower(session: SessionDep, db_middleman: Middleman):
+    product = get_product_by_grower_and_name(
+        session=session,
+        grower_id=db_middleman.purchase_from_id,
+        product_name=db_middleman.purchased_product)
     if not product:
+        if not session.get(Grower, db_middleman.purchase_from_id):
+            raise ValueError("Grower not found")
         raise ValueError("Product not found for this grower")
 
-    if product.remaining_yield < db_middleman.purchased_quantity:
+    # 条件扣减：剩余产量不足时不更新任何行
+    remaining_yield = decrement_product_yield(
+        session=session,
+        product_id=product.id,
+        quantity=db_middleman.purchased_quantity)
+    if remaining_yield is None:
         raise ValueError("Insufficient remaining yield from grower")
 
-    product.remaining_yield -= db_middleman.purchased_quantity
+    return ("product", product.id)
 
 
 def handle_purchase_from_middleman(session: SessionDep,
                                    db_middleman: Middleman):
-    seller_middleman = session.get(Middleman, db_middleman.purchase_from_id)
-    if not seller_middleman:
-        raise ValueError("Seller middleman not found")
-
     # 检查1：确保分割的 split 之和等于交易总量
     if sum(db_middleman.split_quantities) != db_middleman.purchased_quantity:
         raise ValueError(
             "Sum of split quantities does not match the purchased quantity")
 
-    # 检查2：确保卖家中间商有足够的剩余数量
-    if seller_middleman.remaining_quantity < db_middleman.purchased_quantity:
+    # 检查2：指定批次时先按行扣减该批次，剩余不足时不更新任何行
+    split_index = db_middleman.purchase_from_split_index
+    if split_index is not None:
+        lot_remaining = decrement_split_lot_remaining(
+            session=session,
+            middleman_id=db_middleman.purchase_from_id,
+            split_index=split_index,
+            quantity=db_middleman.purchased_quantity)
+        if lot_remaining is None:
+            if not session.get(Middleman, db_middleman.purchase_from_id):
+                raise ValueError("Seller middleman not found")
+            if not get_split_lot(session=session,
+                                 middleman_id=db_middleman.purchase_from_id,
+                                 split_index=split_index):
+                raise ValueError("Split lot not found")
+            raise ValueError("Insufficient remaining quantity in split lot")
+
+    # 检查3：原子扣减卖家中间商的剩余数量，剩余不足时不更新任何行
+    remaining_quantity = decrement_middleman_remaining(
+        session=session,
+        middleman_id=db_middleman.purchase_from_id,
+        quantity=db_middleman.purchased_quantity)
+    if remaining_quantity is None:
+        if not session.get(Middleman, db_middleman.purchase_from_id):
+            raise ValueError("Seller middleman not found")
         raise ValueError(
             "Insufficient remaining quantity from seller middleman")
 
-    # 更新卖家中间商的剩余数量
-    new_remaining_quantity = seller_middleman.remaining_quantity - db_middleman.purchased_quantity
+    # 批次数量只记在 SplitLot 上，不再更新卖家中间商的 split_quantities
 
-    # 检查3：确保新的剩余数量不会小于 0
-    if new_remaining_quantity < 0:
-        raise ValueError(
-            "Transaction would result in negative remaining quantity")
-
-    # 更新卖家中间商的数据
-    seller_middleman.remaining_quantity = new_remaining_quantity
-
-    # 不需要更新卖家中间商的 split_quantities 和 split_qr_codes
-
-    return seller_middleman
+    return ("middleman", db_middleman.purchase_from_id)
 
 
 # def handle_purchase_from_middleman(session: SessionDep,
@@ -301,36 +682,230 @@ def handle_purchase_from_middleman(session: SessionDep,
 #         seller_middleman.split_quantities)]
 
 
-def generate_split_qr_codes(db_middleman: Middleman) -> List[str]:
+def split_qr_payload(middleman_id: int, split_index: int) -> str:
+    if settings.QR_PAYLOAD_FORMAT == "token":
+        return encode_qr_token("middleman", middleman_id, split_index)
+    qr_data = {"middleman_id": middleman_id, "split_index": split_index}
+    qr_url = urljoin(BASE_URL, "/api/middleman/split-info")
+    return json.dumps({"url": qr_url, "data": qr_data})
+
+
+def generate_split_qr_codes(
+        session: SessionDep,
+        db_middleman: Middleman,
+        render_items: List[qr_render.RenderItem],
+        lots: Optional[List[SplitLot]] = None) -> List[str]:
+    """
+    Record the split QR payloads and return their URLs. The images are
+    appended to ``render_items`` for ``qr_render.submit`` after commit.
+
+    ``lots`` are the middleman's split lots when the caller has already
+    loaded them; otherwise they are queried.
+    """
+    if lots is None:
+        lots = get_split_lots(session=session, middleman_id=db_middleman.id)
     qr_codes = []
-    for i, quantity in enumerate(db_middleman.split_quantities):
-        qr_data = {"middleman_id": db_middleman.id, "split_index": i}
-        qr_url = urljoin(BASE_URL, "/api/middleman/split-info")
-
-        qr_code_filename = generate_qr_code(
-            json.dumps({
-                "url": qr_url,
-                "data": qr_data
-            }),
-            prefix=f"middleman_{db_middleman.id}_split_{i}",
-            directory="uploads/middleman_qrcodes")
-        db_middleman.split_qr_codes.append(qr_code_filename[1])
-        qr_codes.append(qr_code_filename[1])
+    payloads = []
+    for lot in lots:
+        i = lot.split_index
+        payload = split_qr_payload(db_middleman.id, i)
+        # 文件名由二维码内容决定，无需等图片生成即可返回
+        filename = qr_render.qr_code_filename(
+            payload, prefix=f"middleman_{db_middleman.id}_split_{i}")
+        render_items.append((payload, filename))
+        # 同步记录二维码内容，溯源时直接查表，无需再解码图片
+        payloads.append(
+            create_qr_code_payload(
+                session=session,
+                qr_code=filename,
+                payload=payload,
+                source_type="middleman",
+                middleman_id=db_middleman.id,
+                split_index=i,
+                parent_type=db_middleman.purchase_from_type,
+                parent_id=db_middleman.purchase_from_id))
+        qr_codes.append(qr_code_url(filename, MIDDLEMAN_QR_DIRECTORY))
+    # 一次 flush 批量写入二维码内容，再把内容ID回填到各批次
+    session.flush()
+    for lot, qr_payload in zip(lots, payloads):
+        lot.qr_payload_id = qr_payload.id
     return qr_codes
 
 
-def generate_main_qr_code(db_middleman: Middleman) -> str:
-    qr_data = {"middleman_id": db_middleman.id}
+def main_qr_payload(middleman_id: int) -> str:
+    if settings.QR_PAYLOAD_FORMAT == "token":
+        return encode_qr_token("middleman", middleman_id)
+    qr_data = {"middleman_id": middleman_id}
     qr_url = urljoin(BASE_URL, "/api/middleman/info")
+    return json.dumps({"url": qr_url, "data": qr_data})
+
+
+def generate_main_qr_code(session: SessionDep, db_middleman: Middleman,
+                          render_items: List[qr_render.RenderItem]) -> str:
+    payload = main_qr_payload(db_middleman.id)
+
+    filename = qr_render.qr_code_filename(
+        payload, prefix=f"middleman_{db_middleman.id}_main")
+    render_items.append((payload, filename))
+    create_qr_code_payload(session=session,
+                           qr_code=filename,
+                           payload=payload,
+                           source_type="middleman",
+                           middleman_id=db_middleman.id,
+                           parent_type=db_middleman.purchase_from_type,
+                           parent_id=db_middleman.purchase_from_id)
+    return qr_code_url(filename, MIDDLEMAN_QR_DIRECTORY)
+
+
+class SplitLotRepackageOut(BaseModel):
+    lots: List[SplitLotRead]
+    qr_render_id: Optional[str] = None
+
+
+@router.post("/middlemen/{middleman_id}/lots/{split_index}/repackage",
+             response_model=ResponseBase[SplitLotRepackageOut])
+def repackage_split_lot(
+    session: SessionDep,
+    middleman_id: int,
+    split_index: int,
+    repackage_in: SplitLotRepackage,
+) -> Any:
+    """
+    Re-split part or all of a lot into child lots.
+
+    The children take the middleman's next split indexes and point to the
+    parent lot, which keeps whatever was not repackaged, so the history
+    survives any number of re-splits. The children are also appended to the
+    middleman's ``split_quantities`` and ``split_qr_codes``, which stay
+    indexed by split index. The statement count does not depend
+    on the number of children; their QR images are rendered by the process
+    pool after commit.
+    """
+    quantities = repackage_in.quantities
+    try:
+        if len(quantities) > settings.SPLIT_LOTS_MAX:
+            raise ValueError(
+                f"At most {settings.SPLIT_LOTS_MAX} lots per repackage")
+        if any(quantity <= 0 for quantity in quantities):
+            raise ValueError("Lot quantities must be positive")
+
+        with session.begin():
+            # 锁定中间商行，串行化同一中间商的重新拆分，避免拆分序号冲突
+            middleman = session.exec(
+                select(Middleman).where(
+                    Middleman.id == middleman_id).with_for_update()).first()
+            if not middleman:
+                raise ValueError("Middleman not found")
+            parent = get_split_lot(session=session,
+                                   middleman_id=middleman_id,
+                                   split_index=split_index)
+            if not parent:
+                raise ValueError("Split lot not found")
+            if decrement_split_lot_remaining(session=session,
+                                             middleman_id=middleman_id,
+                                             split_index=split_index,
+                                             quantity=sum(quantities)) is None:
+                raise ValueError(
+                    "Insufficient remaining quantity in split lot")
+
+            first_index = get_next_split_index(session=session,
+                                               middleman_id=middleman_id)
+            indexes = range(first_index, first_index + len(quantities))
+            payloads = [split_qr_payload(middleman_id, i) for i in indexes]
+            filenames = [
+                qr_render.qr_code_filename(
+                    payload, prefix=f"middleman_{middleman_id}_split_{i}")
+                for payload, i in zip(payloads, indexes)
+            ]
+            qr_payload_ids = create_qr_code_payloads(
+                session=session,
+                payloads=[{
+                    "qr_code": filename,
+                    "payload": payload,
+                    "source_type": "middleman",
+                    "middleman_id": middleman_id,
+                    "split_index": i,
+                    "parent_type": middleman.purchase_from_type,
+                    "parent_id": middleman.purchase_from_id,
+                } for filename, payload, i in zip(filenames, payloads,
+                                                  indexes)])
+            lots = create_child_split_lots(session=session,
+                                           parent=parent,
+                                           first_index=first_index,
+                                           quantities=quantities,
+                                           qr_payload_ids=qr_payload_ids)
+            qr_codes = [
+                qr_code_url(filename, MIDDLEMAN_QR_DIRECTORY)
+                for filename in filenames
+            ]
+            # 中间商的拆分数组按拆分序号排列，子批次序号接在末尾，同一事务中追加
+            middleman.split_quantities = [
+                *middleman.split_quantities, *quantities
+            ]
+            middleman.split_qr_codes = [*middleman.split_qr_codes, *qr_codes]
+            session.add(middleman)
+            data = [
+                SplitLotRead(**lot.model_dump(), qr_code=qr_code)
+                for lot, qr_code in zip(lots, qr_codes)
+            ]
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Exception as e:
+        raise HTTPException(status_code=500,
+                            detail=f"An error occurred: {str(e)}")
 
-    main_qr_code_filename = generate_qr_code(
-        json.dumps({
-            "url": qr_url,
-            "data": qr_data
-        }),
-        prefix=f"middleman_{db_middleman.id}_main",
-        directory="uploads/middleman_qrcodes")
-    return main_qr_code_filename[1]
+    render_id = qr_render.submit(list(zip(payloads, filenames)),
+                                 MIDDLEMAN_QR_DIRECTORY)
+    cache.invalidate_nodes([("middleman", middleman_id)])
+    return ResponseBase(message="Split lot repackaged successfully",
+                        data=SplitLotRepackageOut(lots=data,
+                                                  qr_render_id=render_id))
+
+
+@router.get("/middlemen/{middleman_id}/lots",
+            response_model=ResponseBase[List[SplitLotRead]])
+async def list_split_lots(
+    session: AsyncReadSessionDep,
+    middleman_id: int,
+) -> Any:
+    """
+    All lots of a middleman in split order, repackaged ones included; follow
+    ``parent_lot_id`` for a lot's re-split history.
+    """
+    statement = select(SplitLot, QRCodePayload.qr_code).outerjoin(
+        QRCodePayload, QRCodePayload.id == SplitLot.qr_payload_id).where(
+            SplitLot.middleman_id == middleman_id).order_by(
+                SplitLot.split_index)
+    rows = (await session.exec(statement)).all()
+    data = [
+        SplitLotRead(**lot.model_dump(),
+                     qr_code=qr_code_url(qr_code, MIDDLEMAN_QR_DIRECTORY)
+                     if qr_code else None) for lot, qr_code in rows
+    ]
+    return ResponseBase(message="Split lots retrieved successfully", data=data)
+
+
+class QRRenderStatus(BaseModel):
+    render_id: str
+    status: str
+    total: int
+    done: int
+    failed: int
+
+
+@router.get("/qr_renders/{render_id}",
+            response_model=ResponseBase[QRRenderStatus])
+def get_qr_render_status(render_id: str) -> Any:
+    """
+    Progress of a background QR image render returned as ``qr_render_id``:
+    ``pending`` until every image is written, then ``done`` or ``failed``;
+    ``unknown`` while the status store is unavailable.
+    """
+    status = qr_render.get_status(render_id)
+    if not status:
+        return ResponseBase(message="QR render not found", code=404)
+    return ResponseBase(message="QR render status retrieved successfully",
+                        data=QRRenderStatus(**status))
 
 
 class MiddlemanInfoRequest(BaseModel):
@@ -360,6 +935,7 @@ class MiddlemanSplitInfo(BaseModel):
     middleman_id: int
     split_index: int
     quantity: int
+    remaining: float
     product: str
     source: str
     purchase_from_id: int
@@ -371,15 +947,61 @@ class MiddlemanSplitInfoOut(BaseModel):
     count: int
 
 
-@router.post("/api/middleman/info", response_model=MiddlemanInfoOut)
-def get_middleman_info(request: MiddlemanInfoRequest,
-                       session: SessionDep) -> Any:
+class MiddlemanBatchItem(BaseModel):
+    middleman_id: int
+    split_index: Optional[int] = None
+
+
+class MiddlemanBatchInfoRequest(BaseModel):
+    items: List[MiddlemanBatchItem] = Field(
+        ..., min_length=1, max_length=settings.TRACE_BATCH_MAX)
+
+
+class TraceStep(BaseModel):
+    node: str
+    quantity: float
+
+
+class TraceNode(BaseModel):
+    source_type: str
+    id: int
+    name: Optional[str]
+    product: Optional[str]
+
+
+class MiddlemanBatchInfo(BaseModel):
+    middleman_id: int
+    split_index: Optional[int]
+    quantity: float
+    product: Optional[str]
+    purchase_from_id: Optional[int]
+    purchase_from_type: Optional[str]
+    trace: List[TraceStep]
+
+
+class MiddlemanBatchInfoOut(BaseModel):
+    data: List[MiddlemanBatchInfo]
+    nodes: Dict[str, TraceNode]
+    missing: List[MiddlemanBatchItem]
+    count: int
+
+
+@router.post("/api/middleman/info",
+             response_model=MiddlemanInfoOut,
+             dependencies=[Depends(read_only)])
+async def get_middleman_info(request: MiddlemanInfoRequest,
+                             session: AsyncReadSessionDep) -> Any:
+    cache_key = cache.trace_key("info", request.middleman_id)
+    cached, generation = await cache.get_trace_async(cache_key)
+    if cached is not None:
+        return cached
+
     count_stmt = select(func.count()).select_from(Middleman).where(
         Middleman.id == request.middleman_id)
-    count = session.exec(count_stmt).one()
+    count = (await session.exec(count_stmt)).one()
 
     stmt = select(Middleman).where(Middleman.id == request.middleman_id)
-    middleman = session.exec(stmt).first()
+    middleman = (await session.exec(stmt)).first()
 
     if not middleman:
         raise HTTPException(status_code=404, detail="Middleman not found")
@@ -391,34 +1013,222 @@ def get_middleman_info(request: MiddlemanInfoRequest,
                          purchase_from_id=middleman.purchase_from_id,
                          purchase_from_type=middleman.purchase_from_type)
 
-    return MiddlemanInfoOut(data=data, count=count)
-
-
-@router.post("/api/middleman/split-info", response_model=MiddlemanSplitInfoOut)
-def get_middleman_split_info(request: MiddlemanSplitInfoRequest,
-                             session: SessionDep) -> Any:
-    count_stmt = select(func.count()).select_from(Middleman).where(
-        Middleman.id == request.middleman_id)
-    count = session.exec(count_stmt).one()
-
-    stmt = select(Middleman).where(Middleman.id == request.middleman_id)
-    middleman = session.exec(stmt).first()
-
-    if not middleman:
+    response = MiddlemanInfoOut(data=data, count=count)
+    if reads_primary(session):
+        await cache.set_trace_async(cache_key,
+                                    response.model_dump(),
+                                    [("middleman", middleman.id)],
+                                    generation=generation)
+    return response
+
+
+@router.post("/api/middleman/split-info",
+             response_model=MiddlemanSplitInfoOut,
+             dependencies=[Depends(read_only)])
+async def get_middleman_split_info(request: MiddlemanSplitInfoRequest,
+                                   session: AsyncReadSessionDep) -> Any:
+    cache_key = cache.trace_key("split_info", request.middleman_id,
+                                request.split_index)
+    cached, generation = await cache.get_trace_async(cache_key)
+    if cached is not None:
+        return cached
+
+    # 只取所需列；外连接批次，以区分中间商不存在与批次不存在
+    stmt = select(Middleman.purchased_product, Middleman.purchase_from_id,
+                  Middleman.purchase_from_type, SplitLot.quantity,
+                  SplitLot.remaining).outerjoin(
+                      SplitLot,
+                      and_(SplitLot.middleman_id == Middleman.id,
+                           SplitLot.split_index == request.split_index)).where(
+                               Middleman.id == request.middleman_id)
+    row = (await session.exec(stmt)).first()
+
+    if not row:
         raise HTTPException(status_code=404, detail="Middleman not found")
-    if request.split_index >= len(middleman.split_quantities):
+    if row.quantity is None:
         raise HTTPException(status_code=404, detail="Split index out of range")
 
-    data = MiddlemanSplitInfo(
-        middleman_id=middleman.id,
-        split_index=request.split_index,
-        quantity=middleman.split_quantities[request.split_index],
-        product=middleman.purchased_product,
-        source="middleman",
-        purchase_from_id=middleman.purchase_from_id,
-        purchase_from_type=middleman.purchase_from_type)
-
-    return MiddlemanSplitInfoOut(data=data, count=count)
+    data = MiddlemanSplitInfo(middleman_id=request.middleman_id,
+                              split_index=request.split_index,
+                              quantity=row.quantity,
+                              remaining=row.remaining,
+                              product=row.purchased_product,
+                              source="middleman",
+                              purchase_from_id=row.purchase_from_id,
+                              purchase_from_type=row.purchase_from_type)
+
+    response = MiddlemanSplitInfoOut(data=data, count=1)
+    if reads_primary(session):
+        await cache.set_trace_async(cache_key,
+                                    response.model_dump(),
+                                    [("middleman", request.middleman_id)],
+                                    generation=generation)
+    return response
+
+
+@router.get("/qr_token/{token:path}")
+async def resolve_qr_token(token: str, session: AsyncReadSessionDep) -> Any:
+    """
+    Resolve a compact QR token (``QR_PAYLOAD_FORMAT=token``) to the same
+    response as the grower, info or split-info endpoint its JSON payload
+    pointed at. The signature is checked before any query runs.
+    """
+    try:
+        node = decode_qr_token(token)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if node.node_type == "grower":
+        return await read_grower(session, node.node_id)
+    if node.split_index is None:
+        return await get_middleman_info(
+            MiddlemanInfoRequest(middleman_id=node.node_id), session)
+    return await get_middleman_split_info(
+        MiddlemanSplitInfoRequest(middleman_id=node.node_id,
+                                  split_index=node.split_index), session)
+
+
+@router.post("/api/middleman/batch-info",
+             response_model=MiddlemanBatchInfoOut,
+             dependencies=[Depends(read_only)])
+async def get_middleman_batch_info(request: MiddlemanBatchInfoRequest,
+                                   session: AsyncSessionDep) -> Any:
+    """
+    Resolve many middleman/split QR identifiers with three queries: the
+    middlemen, their upstream lineage and the requested split lots.
+
+    Ancestors shared by several items are returned once in ``nodes``; each
+    item's ``trace`` refers to them by key, nearest first. Middleman keys
+    are ``middleman:<id>``; grower keys also name the product sold, as
+    ``grower:<id>:<product>``, since one grower supplies several products.
+    """
+    return await session.run_sync(resolve_middleman_batch_info, request)
+
+
+def resolve_middleman_batch_info(
+        session: Session,
+        request: MiddlemanBatchInfoRequest) -> MiddlemanBatchInfoOut:
+    middleman_ids = {item.middleman_id for item in request.items}
+    middlemen = {
+        m.id: m
+        for m in session.exec(
+            select(Middleman).where(Middleman.id.in_(middleman_ids)))
+    }
+    upstream = get_middlemen_upstream(session=session,
+                                      middleman_ids=list(middlemen))
+
+    nodes: Dict[str, TraceNode] = {}
+    traces: Dict[int, List[TraceStep]] = {}
+    for middleman_id, rows in upstream.items():
+        product = middlemen[middleman_id].purchased_product
+        steps = []
+        for lineage, seller, grower in rows:
+            key = f"{lineage.ancestor_type}:{lineage.ancestor_id}"
+            if grower:
+                # 同一种植者可向不同条目供应不同产品，节点按产品区分
+                key = f"{key}:{product}"
+            if key not in nodes:
+                if seller:
+                    nodes[key] = TraceNode(source_type="middleman",
+                                           id=seller.id,
+                                           name=seller.name,
+                                           product=seller.purchased_product)
+                elif grower:
+                    nodes[key] = TraceNode(source_type="grower",
+                                           id=grower.id,
+                                           name=grower.name,
+                                           product=product)
+            if seller:
+                product = seller.purchased_product
+            steps.append(
+                TraceStep(node=key, quantity=lineage.quantity_path[0]))
+        traces[middleman_id] = steps
+
+    lots = get_split_lots_by_keys(
+        session=session,
+        keys=[(item.middleman_id, item.split_index) for item in request.items
+              if item.split_index is not None])
+
+    data = []
+    missing = []
+    for item in request.items:
+        middleman = middlemen.get(item.middleman_id)
+        lot = lots.get((item.middleman_id, item.split_index))
+        if not middleman or (item.split_index is not None and not lot):
+            missing.append(item)
+            continue
+        if lot:
+            quantity = lot.quantity
+        else:
+            quantity = middleman.purchased_quantity
+        data.append(
+            MiddlemanBatchInfo(
+                middleman_id=middleman.id,
+                split_index=item.split_index,
+                quantity=quantity,
+                product=middleman.purchased_product,
+                purchase_from_id=middleman.purchase_from_id,
+                purchase_from_type=middleman.purchase_from_type,
+                trace=traces.get(middleman.id, [])))
+
+    return MiddlemanBatchInfoOut(data=data,
+                                 nodes=nodes,
+                                 missing=missing,
+                                 count=len(data))
+
+
+@router.get("/stats/cache",
+            dependencies=[Depends(get_current_active_superuser)],
+            response_model=ResponseBase[Dict])
+def get_trace_cache_stats() -> Any:
+    """
+    Trace cache hit/miss counters, shared by all workers.
+    """
+    return ResponseBase(message="Cache stats retrieved successfully",
+                        data=cache.get_stats())
+
+
+@router.get("/stats/pool",
+            dependencies=[Depends(get_current_active_superuser)],
+            response_model=ResponseBase[Dict])
+def get_db_pool_stats() -> Any:
+    """
+    Connection pool occupancy and checkout latency of the serving worker.
+    """
+    return ResponseBase(message="Pool stats retrieved successfully",
+                        data=get_pool_stats())
+
+
+class InventoryBalance(BaseModel):
+    node_type: str
+    node_id: int
+    balance: float
+    as_of: Optional[datetime] = None
+
+
+@router.get("/inventory/{node_type}/{node_id}",
+            response_model=ResponseBase[InventoryBalance])
+async def read_inventory_balance(
+    session: AsyncSessionDep,
+    node_type: str,
+    node_id: int,
+    as_of: Optional[datetime] = None,
+) -> Any:
+    """
+    Balance of a grower product or middleman lot from the inventory ledger,
+    optionally as of a past moment (UTC).
+    """
+    if node_type not in ("product", "middleman"):
+        return ResponseBase(message="Invalid node_type", code=400)
+    balance = await session.run_sync(
+        lambda sync_session: get_inventory_balance(session=sync_session,
+                                                   node_type=node_type,
+                                                   node_id=node_id,
+                                                   as_of=as_of))
+    return ResponseBase(message="Inventory balance retrieved successfully",
+                        data=InventoryBalance(node_type=node_type,
+                                              node_id=node_id,
+                                              balance=balance,
+                                              as_of=as_of))
 
 
 # @router.post("/middlemen/transaction/",
@@ -508,14 +1318,20 @@ def get_middleman_split_info(request: MiddlemanSplitInfoRequest,
 #                         data=middleman)
 
 
-@router.get("/middlemen/", response_model=ResponseBase[List[MiddlemanRead]])
-def list_middlemen(session: SessionDep,
-                   skip: int = 0,
-                   limit: int = 100) -> Any:
-    statement = select(Middleman).offset(skip).limit(limit)
-    middlemen = session.exec(statement).all()
-    return ResponseBase(message="Middlemen retrieved successfully",
-                        data=middlemen)
+@router.get("/middlemen/", response_model=PageResponse[List[MiddlemanRead]])
+async def list_middlemen(session: AsyncSessionDep,
+                         skip: int = 0,
+                         limit: int = 100,
+                         cursor: Optional[str] = None) -> Any:
+    statement = paginate(select(Middleman),
+                         Middleman.id,
+                         skip=skip,
+                         limit=limit,
+                         cursor=cursor)
+    middlemen = (await session.exec(statement)).all()
+    return PageResponse(message="Middlemen retrieved successfully",
+                        data=middlemen,
+                        next_cursor=next_cursor(middlemen, limit))
 
 
 # @router.get("/middlemen/{middleman_id}",
@@ -545,11 +1361,11 @@ def list_middlemen(session: SessionDep,
 
 @router.get("/middlemen/{middleman_id}",
             response_model=ResponseBase[MiddlemanRead])
-def read_middleman(
-    session: SessionDep,
+async def read_middleman(
+    session: AsyncReadSessionDep,
     middleman_id: int,
 ) -> Any:
-    middleman = session.get(Middleman, middleman_id)
+    middleman = await session.get(Middleman, middleman_id)
     if not middleman:
         return ResponseBase(message="Middleman not found", code=404)
     return ResponseBase(message="Middleman retrieved successfully",
@@ -564,16 +1380,31 @@ def create_transaction(
     product = session.get(Product, transaction_in.product_id)
     if not product:
         return ResponseBase(message="Product not found", code=404)
-    if product.remaining_yield < transaction_in.quantity:
+    if decrement_product_yield(session=session,
+                               product_id=product.id,
+                               quantity=transaction_in.quantity) is None:
+        session.rollback()
         return ResponseBase(message="Insufficient remaining yield", code=400)
+    record_inventory_movement(session=session,
+                              node_type="product",
+                              node_id=product.id,
+                              delta=-transaction_in.quantity,
+                              reason="sale",
+                              middleman_id=transaction_in.buyer_id)
     transaction = Transaction.model_validate(transaction_in)
+    # 先 flush 取得交易ID：二维码文件名由内容决定，内容须包含ID才能唯一
+    session.add(transaction)
+    session.flush()
     qr_data = f"Transaction ID: {transaction.id}, Product: {product.name}, Quantity: {transaction.quantity}"
     qr_code_filename = generate_qr_code(
-        qr_data, prefix="transaction", directory="uploads/transaction_qrcodes")
-    transaction.qr_code = qr_code_filename
-    session.add(transaction)
-    product.remaining_yield -= transaction_in.quantity
+        qr_data, prefix="transaction", directory=TRANSACTION_QR_DIRECTORY)
+    transaction.qr_code = qr_code_filename[0]
+    create_qr_code_payload(session=session,
+                           qr_code=qr_code_filename[0],
+                           payload=qr_data,
+                           source_type="transaction")
     session.commit()
+    cache.invalidate_nodes([("grower", product.grower_id)])
     session.refresh(transaction)
     return ResponseBase(message="Transaction created successfully",
                         data=transaction)
@@ -581,88 +1412,356 @@ def create_transaction(
 
 @router.get("/transactions/{transaction_id}",
             response_model=ResponseBase[TransactionRead])
-def read_transaction(
-    session: SessionDep,
+async def read_transaction(
+    session: AsyncSessionDep,
     transaction_id: int,
 ) -> Any:
-    transaction = session.get(Transaction, transaction_id)
+    transaction = await session.get(Transaction, transaction_id)
     if not transaction:
         return ResponseBase(message="Transaction not found", code=404)
     return ResponseBase(message="Transaction retrieved successfully",
                         data=transaction)
 
 
-@router.get("/qr_code/{qr_code}", response_model=ResponseBase[Dict])
-def get_qr_code_info(
+RECALL_BATCH_SIZE = 1000
+
+
+def stream_recall(statement: Any):
+    # 使用独立会话和服务端游标分批读取，响应流式输出期间不占用请求会话
+    with Session(engine) as session:
+        result = session.exec(
+            statement.execution_options(yield_per=RECALL_BATCH_SIZE))
+        for row in result:
+            yield json.dumps(dict(row._mapping), ensure_ascii=False) + "\n"
+
+
+@router.get("/recall/growers/{grower_id}")
+def recall_grower(
+    session: SessionDep,
+    grower_id: int,
+) -> Any:
+    """
+    Stream every downstream middleman lot of a grower as NDJSON.
+    """
+    grower = session.get(Grower, grower_id)
+    if not grower:
+        return ResponseBase(message="Grower not found", code=404)
+    statement = get_recall_statement(grower_id=grower.id)
+    return StreamingResponse(stream_recall(statement),
+                             media_type="application/x-ndjson")
+
+
+@router.get("/recall/products/{product_id}")
+def recall_product(
     session: SessionDep,
+    product_id: int,
+) -> Any:
+    """
+    Stream every downstream middleman lot of a grower product as NDJSON.
+    """
+    product = session.get(Product, product_id)
+    if not product:
+        return ResponseBase(message="Product not found", code=404)
+    statement = get_recall_statement(grower_id=product.grower_id,
+                                     product_name=product.name)
+    return StreamingResponse(stream_recall(statement),
+                             media_type="application/x-ndjson")
+
+
+@router.get("/qr_code/{qr_code}", response_model=ResponseBase[Dict])
+async def get_qr_code_info(
+    session: AsyncSessionDep,
+    qr_code: str,
+) -> Any:
+    cache_key = cache.trace_key("qr_code", qr_code)
+    cached, generation = await cache.get_trace_async(cache_key)
+    if cached is not None:
+        return cached
+
+    # 溯源查询复用同步 crud，经 run_sync 在 greenlet 中执行，不阻塞事件循环
+    response, nodes = await session.run_sync(build_qr_code_response, qr_code)
+    if nodes:
+        await cache.set_trace_async(cache_key,
+                                    jsonable_encoder(response),
+                                    nodes,
+                                    generation=generation)
+    return response
+
+
+@router.get("/qr_code/{qr_code}/image")
+async def get_qr_code_image(
+    session: AsyncReadSessionDep,
     qr_code: str,
+    size: int = Query(10, ge=1, le=40, description="每个模块的像素数，ZPL 为打印点数"),
+    border: int = Query(4, ge=0, le=20, description="边框宽度（模块数）"),
+    image_format: str = Query("png",
+                              alias="format",
+                              pattern="^(" +
+                              "|".join(qr_render.IMAGE_FORMATS) + ")$"),
+) -> Any:
+    """
+    Render a QR code image from its recorded payload.
+
+    Served from the in-memory LRU or the disk cache when the same code was
+    requested with the same parameters before; the database is only read
+    on a miss.
+    """
+    key = image_cache_key(qr_code, size, border, image_format)
+    image = await run_in_threadpool(qr_image_cache.get, key)
+    if image is None:
+        payload = (await session.exec(
+            select(QRCodePayload.payload).where(
+                QRCodePayload.qr_code == qr_code))).first()
+        if payload is None:
+            raise HTTPException(status_code=404, detail="QR code not found")
+        image = await run_in_threadpool(qr_render.render_qr_image,
+                                        payload,
+                                        box_size=size,
+                                        border=border,
+                                        image_format=image_format)
+        await run_in_threadpool(qr_image_cache.put, key, image)
+    media_type = qr_render.IMAGE_FORMATS[image_format]
+    # 同一文件名的内容不会变化，客户端和 CDN 可长期缓存
+    return Response(
+        content=image,
+        media_type=media_type,
+        headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
+
+class QRLabelSheetRequest(BaseModel):
+    qr_codes: List[str] = Field(..., min_length=1,
+                                max_length=settings.SPLIT_LOTS_MAX)
+    label_size: float = Field(40, ge=10, le=180, description="标签边长（毫米）")
+    border: int = Field(2, ge=0, le=20, description="边框宽度（模块数）")
+    captions: bool = Field(True, description="是否在二维码下方打印标签名")
+
+
+@router.post("/qr_labels/sheet", dependencies=[Depends(read_only)])
+async def get_qr_label_sheet(request: QRLabelSheetRequest,
+                             session: AsyncReadSessionDep) -> Any:
+    """
+    Print the given QR codes as a PDF sheet of labels on A4 pages, drawn as
+    vector rectangles from the module matrix and streamed page by page.
+    """
+    rows = (await session.exec(
+        select(QRCodePayload.qr_code, QRCodePayload.payload).where(
+            QRCodePayload.qr_code.in_(request.qr_codes)))).all()
+    payloads = dict(rows)
+    missing = [code for code in request.qr_codes if code not in payloads]
+    if missing:
+        raise HTTPException(status_code=404,
+                            detail=f"QR code not found: {missing[0]}")
+
+    labels = ((qr_render.make_qr_matrix(payloads[code],
+                                        border=request.border),
+               qr_render.qr_code_label(code) if request.captions else None)
+              for code in request.qr_codes)
+    # 同步生成器由 StreamingResponse 放入线程池逐页迭代
+    return StreamingResponse(
+        qr_labels.iter_pdf_sheets(labels,
+                                  label_size=request.label_size *
+                                  qr_labels.MM),
+        media_type="application/pdf",
+        headers={"Content-Disposition": 'inline; filename="qr_labels.pdf"'})
+
+
+def load_label_png(qr_code: str, payload: str, source_type: str) -> bytes:
+    """
+    The PNG for ``qr_code``: the eagerly written file if it exists,
+    otherwise a render from ``payload`` through the image cache.
+    """
+    path = os.path.join(QR_DIRECTORIES[source_type],
+                        qr_render.qr_code_subpath(qr_code))
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    box_size = qr_render.RENDER_PARAMS["box_size"]
+    border = qr_render.RENDER_PARAMS["border"]
+    key = image_cache_key(qr_code, box_size, border, "png")
+    image = qr_image_cache.get(key)
+    if image is None:
+        image = qr_render.render_qr_image(payload,
+                                          box_size=box_size,
+                                          border=border,
+                                          image_format="png")
+        qr_image_cache.put(key, image)
+    return image
+
+
+def label_export_response(rows: List[Any], export_format: str,
+                          name: str) -> StreamingResponse:
+    """
+    Stream the ``(qr_code, payload, source_type)`` rows as a ZIP of PNGs or
+    a PDF label sheet. Images are loaded or rendered one at a time while
+    the response is sent.
+    """
+    if export_format == "pdf":
+        body = qr_labels.iter_pdf_sheets(
+            (qr_render.make_qr_matrix(payload, border=2),
+             qr_render.qr_code_label(qr_code))
+            for qr_code, payload, _ in rows)
+        media_type = "application/pdf"
+    else:
+        body = qr_labels.iter_zip(
+            (f"{qr_render.qr_code_label(qr_code)}.png",
+             load_label_png(qr_code, payload, source_type))
+            for qr_code, payload, source_type in rows)
+        media_type = "application/zip"
+    # 同步生成器由 StreamingResponse 放入线程池逐项迭代
+    return StreamingResponse(body,
+                             media_type=media_type,
+                             headers={
+                                 "Content-Disposition":
+                                 f'attachment; filename="{name}.{export_format}"'
+                             })
+
+
+@router.get("/middlemen/{middleman_id}/labels")
+async def export_middleman_labels(
+    session: AsyncReadSessionDep,
+    middleman_id: int,
+    export_format: str = Query("zip", alias="format", pattern="^(zip|pdf)$"),
+) -> Any:
+    """
+    Download every QR label of a middleman, the main code followed by all
+    split lots including repackaged ones, as a ZIP of PNGs or a PDF sheet.
+    """
+    if await session.get(Middleman, middleman_id) is None:
+        raise HTTPException(status_code=404, detail="Middleman not found")
+    rows = (await session.exec(
+        select(QRCodePayload.qr_code, QRCodePayload.payload,
+               QRCodePayload.source_type).where(
+                   QRCodePayload.middleman_id == middleman_id).order_by(
+                       QRCodePayload.split_index.nulls_first(),
+                       QRCodePayload.id))).all()
+    return label_export_response(rows, export_format,
+                                 f"middleman_{middleman_id}_labels")
+
+
+@router.get("/growers/{grower_id}/labels")
+async def export_grower_labels(
+    session: AsyncReadSessionDep,
+    grower_id: int,
+    export_format: str = Query("zip", alias="format", pattern="^(zip|pdf)$"),
 ) -> Any:
-    qr_code_data = json.loads(decode_qr_code(qr_code))
-    source_type = qr_code_data.get("source")
-
-    if source_type == "grower":
-        # 现有的种植者逻辑
-        ...
-    elif source_type == "middleman":
-        middleman = session.get(Middleman, qr_code_data["middleman_id"])
+    """
+    Download the grower's QR label and those of every middleman lot bought
+    directly from the grower, as a ZIP of PNGs or a PDF sheet.
+    """
+    grower = await session.get(Grower, grower_id)
+    if grower is None:
+        raise HTTPException(status_code=404, detail="Grower not found")
+    conditions = [
+        and_(QRCodePayload.parent_type == "grower",
+             QRCodePayload.parent_id == grower_id)
+    ]
+    if grower.qr_code:
+        conditions.append(
+            QRCodePayload.qr_code == qr_code_filename_from_url(grower.qr_code))
+    rows = (await session.exec(
+        select(QRCodePayload.qr_code, QRCodePayload.payload,
+               QRCodePayload.source_type).where(or_(*conditions)).order_by(
+                   QRCodePayload.middleman_id.nulls_first(),
+                   QRCodePayload.split_index.nulls_first(),
+                   QRCodePayload.id))).all()
+    return label_export_response(rows, export_format,
+                                 f"grower_{grower_id}_labels")
+
+
+def build_qr_code_response(
+        session: Session,
+        qr_code: str) -> tuple[ResponseBase, List[cache.Node]]:
+    qr_payload = get_qr_code_payload(session=session, qr_code=qr_code)
+    if qr_payload:
+        if qr_payload.source_type == "transaction":
+            return build_transaction_qr_code_response(session, qr_code)
+        if qr_payload.source_type != "middleman":
+            return ResponseBase(message="Invalid QR code data", code=400), []
+        middleman = session.get(Middleman, qr_payload.middleman_id)
         if not middleman:
-            return ResponseBase(message="Middleman not found", code=404)
+            return ResponseBase(message="Middleman not found", code=404), []
+        split_index = qr_payload.split_index
+    else:
+        # 早于二维码内容表生成的拆分二维码：按 split_qr_codes 反查所属中间商
+        owner = get_middleman_by_split_qr_code(session=session,
+                                               qr_code=qr_code)
+        if not owner:
+            return build_transaction_qr_code_response(session, qr_code)
+        middleman, split_index = owner
+
+    if split_index is not None:
+        lot = get_split_lot(session=session,
+                            middleman_id=middleman.id,
+                            split_index=split_index)
+        if not lot:
+            return ResponseBase(message="Split lot not found", code=404), []
+        quantity = lot.quantity
+    else:
+        quantity = middleman.purchased_quantity
 
-        trace_data = trace_middleman_chain(session, qr_code_data)
+    trace_data = trace_middleman_chain(session, middleman)
 
-        return ResponseBase(message="QR code info retrieved successfully",
+    response = ResponseBase(message="QR code info retrieved successfully",
                             data={
                                 "source_type": "middleman",
                                 "middleman_info": {
                                     "id": middleman.id,
                                     "name": middleman.name,
-                                    "product": qr_code_data["product"],
-                                    "quantity": qr_code_data["quantity"]
+                                    "product": middleman.purchased_product,
+                                    "quantity": quantity,
+                                    "split_index": split_index
                                 },
                                 "trace_data": trace_data
                             })
-    else:
-        return ResponseBase(message="Invalid QR code data", code=400)
+    nodes = [("middleman", middleman.id)]
+    nodes += [(node["source_type"], node["id"]) for node in trace_data]
+    return response, nodes
+
+
+def build_transaction_qr_code_response(
+        session: Session,
+        qr_code: str) -> tuple[ResponseBase, List[cache.Node]]:
+    # 交易二维码：按 parent_transaction 链回溯
+    qr_code_info = get_transaction_qr_code_info(session=session,
+                                                qr_code=qr_code)
+    if not qr_code_info:
+        return ResponseBase(message="QR code not found", code=404), []
+    response = ResponseBase(message="QR code info retrieved successfully",
+                            data={
+                                "source_type": "transaction",
+                                **qr_code_info.model_dump()
+                            })
+    return response, [("grower", qr_code_info.grower.id)]
 
 
 def trace_middleman_chain(session: SessionDep,
-                          qr_code_data: Dict) -> List[Dict]:
+                          middleman: Middleman) -> List[Dict]:
+    # 通过溯源闭包表一次查询取出全部上游，不再逐级查询或解码二维码图片
     trace = []
-    current_data = qr_code_data
-
-    while "original_middleman_id" in current_data:
-        original_middleman = session.get(Middleman,
-                                         current_data["original_middleman_id"])
-        if not original_middleman:
-            break
-
-        trace.append({
-            "id":
-            original_middleman.id,
-            "name":
-            original_middleman.name,
-            "quantity":
-            original_middleman.split_quantities[
-                current_data["original_split_index"]],
-            "product":
-            original_middleman.purchase_type
-        })
-
-        if original_middleman.purchase_from_id:
-            grower = session.get(Grower, original_middleman.purchase_from_id)
-            if grower:
-                trace.append({
-                    "source_type": "grower",
-                    "id": grower.id,
-                    "name": grower.name,
-                    "product": original_middleman.purchase_type,
-                    "quantity":
-                    original_middleman.split_quantities[0]  # 假设从种植者处购买的是第一个批次
-                })
-            break
-        else:
-            current_data = json.loads(
-                decode_qr_code(original_middleman.split_qr_codes[0]))
+    product = middleman.purchased_product
+    for lineage, seller, grower in get_middleman_upstream(
+            session=session, middleman_id=middleman.id):
+        # quantity_path[0] 为从该上游直接买入的数量
+        quantity = lineage.quantity_path[0]
+        if seller:
+            trace.append({
+                "source_type": "middleman",
+                "id": seller.id,
+                "name": seller.name,
+                "quantity": quantity,
+                "product": seller.purchased_product
+            })
+            product = seller.purchased_product
+        elif grower:
+            trace.append({
+                "source_type": "grower",
+                "id": grower.id,
+                "name": grower.name,
+                "product": product,
+                "quantity": quantity
+            })
 
     return trace
 
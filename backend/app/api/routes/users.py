@@ -4,7 +4,13 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlmodel import col, delete, func, select
 
 from app import crud
-from app.api.deps import CurrentUser, SessionDep, get_current_active_superuser
+from app.api.deps import (
+    CurrentUser,
+    ReadSessionDep,
+    SessionDep,
+    get_current_active_superuser,
+)
+from app.api.pagination import next_cursor, paginate
 from app.core.config import settings
 from app.core.security import get_password_hash, verify_password
 from app.models import (
@@ -27,18 +33,28 @@ router = APIRouter()
 @router.get("/",
             dependencies=[Depends(get_current_active_superuser)],
             response_model=UsersOut)
-def read_users(session: SessionDep, skip: int = 0, limit: int = 100) -> Any:
+def read_users(
+    session: ReadSessionDep,
+    skip: int = 0,
+    limit: int = 100,
+    cursor: str | None = None,
+) -> Any:
     """
-    Retrieve users.
+    Retrieve users. Pass the returned ``next_cursor`` as ``cursor`` to fetch
+    the next page without an OFFSET scan. ``count`` is only returned on the
+    first page.
     """
 
-    statment = select(func.count()).select_from(User)
-    count = session.exec(statment).one()
+    # count(*) 需要全表扫描，只在第一页计算，翻页时不再重复
+    count = None
+    if cursor is None:
+        statment = select(func.count()).select_from(User)
+        count = session.exec(statment).one()
 
-    statement = select(User).offset(skip).limit(limit)
+    statement = paginate(select(User), User.id, skip=skip, limit=limit, cursor=cursor)
     users = session.exec(statement).all()
 
-    return UsersOut(data=users, count=count)
+    return UsersOut(data=users, count=count, next_cursor=next_cursor(users, limit))
 
 
 @router.post("/",
@@ -7,12 +7,14 @@ from urllib.parse import urlparse
 
 from fastapi import APIRouter, BackgroundTasks, HTTPException
 from pydantic import BaseModel
+from starlette.concurrency import run_in_threadpool
 
-from app.api.deps import SessionDep
+from app.api.deps import AsyncSessionDep, SessionDep
+from app.api.routes.transactions import GROWER_QR_DIRECTORY, grower_qr_payload
 from app.core.config import QR_CODE_DIRECTORY, UPLOAD_DIRECTORY, settings
-from app.core.redis_conf import redis_client
-from app.models import Grower, GrowerCreate, Middleman, ResponseBase
-from app.utils import generate_qr_code, verify_code
+from app.core.redis_conf import async_redis_client, redis_client
+from app.models import Grower, GrowerCreate, Middleman, QRCodePayload, ResponseBase
+from app.utils import generate_qr_code, verify_code_async
 
 router = APIRouter()
 logging.basicConfig(level=logging.INFO)
@@ -30,13 +32,15 @@ router = APIRouter()
 @router.post("/", response_model=ResponseBase)
 async def verify_form(
     background_tasks: BackgroundTasks,
-    session: SessionDep,
+    session: AsyncSessionDep,
     verification_data: VerificationData,
 ):
     # localhost/uploads/temp/WechatIMG323.jpg
     #
     # 获取待验证的数据
-    pending_data = redis_client.get(f"pending_form:{verification_data.temp_id}")
+    pending_data = await async_redis_client.get(
+        f"pending_form:{verification_data.temp_id}"
+    )
     if not pending_data:
         raise HTTPException(status_code=400, detail="Invalid or expired temporary ID")
 
@@ -49,7 +53,7 @@ async def verify_form(
         raise HTTPException(status_code=400, detail="Invalid data format")
 
     # 验证码检查
-    if not verify_code(
+    if not await verify_code_async(
         grower_data["phone_number"], verification_data.verification_code
     ):
         return ResponseBase(code=400, message="Invalid verification code")
@@ -66,7 +70,7 @@ async def verify_form(
         raise HTTPException(status_code=400, detail="Invalid form type")
 
     # 清理Redis中的临时数据
-    redis_client.delete(f"pending_form:{verification_data.temp_id}")
+    await async_redis_client.delete(f"pending_form:{verification_data.temp_id}")
 
     return ResponseBase(
         message=f"{form_type} created successfully", code=200, data=result
@@ -74,29 +78,40 @@ async def verify_form(
 
 
 async def create_company_grower(
-    session: SessionDep, data: dict, files: dict, temp_id: str
+    session: AsyncSessionDep, data: dict, files: dict, temp_id: str
 ):
     grower_data = GrowerCreate(**data)
 
     # 生成临时的 QR 码值
     temp_qr_code = ""
 
-    grower = Grower(**grower_data.dict(), type="company", qr_code=temp_qr_code)
+    # 地块和产品不在此表单中创建，与 create_grower 一样排除
+    grower = Grower(
+        **grower_data.model_dump(exclude={"plots", "products"}),
+        type="company",
+        qr_code=temp_qr_code,
+    )
     session.add(grower)
-    session.flush()  # 这会给 grower 分配一个 ID，但不会提交事务
-
-    # 处理文件
-    business_license_photos = await save_files(
-        files.get("business_license_photos", []), "business_license", grower.id
+    await session.flush()  # 这会给 grower 分配一个 ID，但不会提交事务
+
+    # 处理文件：复制文件是阻塞 IO，放入线程池执行
+    business_license_photos = await run_in_threadpool(
+        save_files,
+        files.get("business_license_photos", []),
+        "business_license",
+        grower.id,
     )
-    land_ownership_certificates = await save_files(
-        files.get("land_ownership_certificate", []), "land_ownership", grower.id
+    land_ownership_certificates = await run_in_threadpool(
+        save_files,
+        files.get("land_ownership_certificate", []),
+        "land_ownership",
+        grower.id,
     )
-    crop_type_pics = await save_files(
-        files.get("crop_type_pic", []), "crop_type_pic", grower.id
+    crop_type_pics = await run_in_threadpool(
+        save_files, files.get("crop_type_pic", []), "crop_type_pic", grower.id
     )
-    id_card_photo = await save_files(
-        files.get("id_card_photo", []), "idcard", grower.id
+    id_card_photo = await run_in_threadpool(
+        save_files, files.get("id_card_photo", []), "idcard", grower.id
     )
     prefix = f"https://{settings.DOMAIN}/{UPLOAD_DIRECTORY}"
     if business_license_photos:
@@ -112,21 +127,24 @@ async def create_company_grower(
     if id_card_photo:
         grower.id_card_photo = [prefix + id_card for id_card in id_card_photo]
 
-    # 生成二维码
-    qr_code_filename = generate_qr_code(
-        grower.id, f"/grower/{str(grower.id)}", QR_CODE_DIRECTORY
+    # 生成二维码：内容与个人种植主一致，渲染和写文件放入线程池，不阻塞事件循环
+    qr_data = grower_qr_payload(grower.id)
+    qr_code_filename, qr_code_access_url = await run_in_threadpool(
+        generate_qr_code, qr_data, "grower", GROWER_QR_DIRECTORY
     )
+    # 记录二维码内容，图片未预先生成时据此按需渲染
+    session.add(
+        QRCodePayload(qr_code=qr_code_filename, payload=qr_data, source_type="grower")
+    )
+    grower.qr_code = qr_code_access_url
 
-    qr_code_access_path = os.path.join(UPLOAD_DIRECTORY, "qrcode", qr_code_filename)
-    grower.qr_code = qr_code_access_path
-
-    session.commit()
-    session.refresh(grower)
+    await session.commit()
+    await session.refresh(grower)
 
     return grower
 
 
-async def save_files(file_urls: List[str], folder: str, grower_id: int) -> List[str]:
+def save_files(file_urls: List[str], folder: str, grower_id: int) -> List[str]:
     saved_paths = []
     for file_url in file_urls:
         # 解析 URL，获取文件名
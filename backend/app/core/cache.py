@@ -0,0 +1,211 @@
+import json
+import logging
+from collections.abc import Iterable
+from typing import Any, NamedTuple, Optional
+
+from redis import RedisError
+
+from app.core.config import settings
+from app.core.redis_conf import async_redis_client, redis_client
+
+logger = logging.getLogger(__name__)
+
+TRACE_PREFIX = "trace_cache"
+HITS_KEY = f"{TRACE_PREFIX}:stats:hits"
+MISSES_KEY = f"{TRACE_PREFIX}:stats:misses"
+# 每次失效递增的全局代数；各节点记录其最近一次失效时的代数
+GENERATION_KEY = f"{TRACE_PREFIX}:generation"
+
+# 溯源链上的节点：("grower", id) 或 ("middleman", id)
+Node = tuple[str, int]
+
+# 一次往返完成读取、命中/未命中计数，并取回当前代数
+GET_SCRIPT = """
+local cached = redis.call('GET', KEYS[1])
+redis.call('INCR', cached and KEYS[2] or KEYS[3])
+return {cached, redis.call('GET', KEYS[4]) or '0'}
+"""
+
+# KEYS：响应键，n 个依赖集合键，n 个节点失效代数键
+# ARGV：响应、TTL、读取时的代数、n
+# 任一节点在读取之后被失效时放弃写入，避免把失效前查到的旧数据写回缓存
+SET_SCRIPT = """
+local n = tonumber(ARGV[4])
+for i = 1, n do
+    local invalidated = redis.call('GET', KEYS[1 + n + i])
+    if invalidated and tonumber(invalidated) > tonumber(ARGV[3]) then
+        return 0
+    end
+end
+redis.call('SETEX', KEYS[1], ARGV[2], ARGV[1])
+for i = 1, n do
+    redis.call('SADD', KEYS[1 + i], KEYS[1])
+    redis.call('EXPIRE', KEYS[1 + i], ARGV[2])
+end
+return 1
+"""
+
+# KEYS：GENERATION_KEY，n 个依赖集合键，n 个节点失效代数键；ARGV：TTL、n
+INVALIDATE_SCRIPT = """
+local n = tonumber(ARGV[2])
+local generation = redis.call('INCR', KEYS[1])
+for i = 1, n do
+    redis.call('SET', KEYS[1 + n + i], generation, 'EX', ARGV[1])
+    for _, key in ipairs(redis.call('SMEMBERS', KEYS[1 + i])) do
+        redis.call('DEL', key)
+    end
+    redis.call('DEL', KEYS[1 + i])
+end
+return generation
+"""
+
+_get_script = redis_client.register_script(GET_SCRIPT)
+_set_script = redis_client.register_script(SET_SCRIPT)
+_invalidate_script = redis_client.register_script(INVALIDATE_SCRIPT)
+_async_get_script = async_redis_client.register_script(GET_SCRIPT)
+_async_set_script = async_redis_client.register_script(SET_SCRIPT)
+
+
+class TraceLookup(NamedTuple):
+    # 命中时为缓存的响应
+    value: Optional[Any]
+    # 读取时的失效代数，未命中后写回时传给 set_trace；Redis 不可用时为 None
+    generation: Optional[int]
+
+
+def trace_key(kind: str, *parts: Any) -> str:
+    return ":".join([TRACE_PREFIX, kind, *[str(part) for part in parts]])
+
+
+def _deps_key(node: Node) -> str:
+    node_type, node_id = node
+    return f"{TRACE_PREFIX}:deps:{node_type}:{node_id}"
+
+
+def _invalidated_key(node: Node) -> str:
+    node_type, node_id = node
+    return f"{TRACE_PREFIX}:invalidated:{node_type}:{node_id}"
+
+
+def _lookup(result: list) -> TraceLookup:
+    cached, generation = result
+    return TraceLookup(
+        json.loads(cached) if cached is not None else None, int(generation))
+
+
+def get_trace(key: str) -> TraceLookup:
+    """
+    Look up the cached trace response for ``key`` and count the hit or
+    miss, in one round trip.
+
+    Redis being unavailable is treated as a miss so scans never fail
+    because of the cache.
+    """
+    try:
+        result = _get_script(keys=[key, HITS_KEY, MISSES_KEY, GENERATION_KEY])
+    except RedisError as e:
+        logger.warning(f"Trace cache read failed: {str(e)}")
+        return TraceLookup(None, None)
+    return _lookup(result)
+
+
+async def get_trace_async(key: str) -> TraceLookup:
+    """
+    Same as ``get_trace`` on the asyncio Redis client, for async routes.
+    """
+    try:
+        result = await _async_get_script(
+            keys=[key, HITS_KEY, MISSES_KEY, GENERATION_KEY])
+    except RedisError as e:
+        logger.warning(f"Trace cache read failed: {str(e)}")
+        return TraceLookup(None, None)
+    return _lookup(result)
+
+
+def _set_arguments(key: str, value: Any, nodes: Iterable[Node],
+                   generation: int) -> tuple[list[str], list[Any]]:
+    nodes = list(set(nodes))
+    keys = [
+        key, *[_deps_key(node) for node in nodes],
+        *[_invalidated_key(node) for node in nodes]
+    ]
+    args = [
+        json.dumps(value, ensure_ascii=False), settings.TRACE_CACHE_TTL,
+        generation, len(nodes)
+    ]
+    return keys, args
+
+
+def set_trace(key: str, value: Any, nodes: Iterable[Node], *,
+              generation: Optional[int]) -> None:
+    """
+    Cache a fully assembled trace response and register it under every
+    lineage node it was built from, so that a write to any of those nodes
+    can drop exactly the responses that depend on it.
+
+    ``generation`` is the one returned by the ``get_trace`` miss that led to
+    building ``value``. If any of ``nodes`` was invalidated since then the
+    response may predate that write, and it is not cached.
+    """
+    if generation is None:
+        return
+    keys, args = _set_arguments(key, value, nodes, generation)
+    try:
+        _set_script(keys=keys, args=args)
+    except RedisError as e:
+        logger.warning(f"Trace cache write failed: {str(e)}")
+
+
+async def set_trace_async(key: str, value: Any, nodes: Iterable[Node], *,
+                          generation: Optional[int]) -> None:
+    """
+    Same as ``set_trace`` on the asyncio Redis client, for async routes.
+    """
+    if generation is None:
+        return
+    keys, args = _set_arguments(key, value, nodes, generation)
+    try:
+        await _async_set_script(keys=keys, args=args)
+    except RedisError as e:
+        logger.warning(f"Trace cache write failed: {str(e)}")
+
+
+def invalidate_nodes(nodes: Iterable[Node]) -> None:
+    """
+    Drop every cached trace response that includes any of ``nodes`` and
+    mark the nodes invalidated, so responses read before now are not
+    written back.
+    """
+    nodes = list(set(nodes))
+    if not nodes:
+        return
+    keys = [
+        GENERATION_KEY, *[_deps_key(node) for node in nodes],
+        *[_invalidated_key(node) for node in nodes]
+    ]
+    try:
+        _invalidate_script(keys=keys,
+                           args=[settings.TRACE_CACHE_TTL, len(nodes)])
+    except RedisError as e:
+        logger.warning(f"Trace cache invalidation failed: {str(e)}")
+
+
+def get_stats() -> dict[str, Any]:
+    try:
+        hits, misses = redis_client.mget(HITS_KEY, MISSES_KEY)
+    except RedisError as e:
+        logger.warning(f"Trace cache stats read failed: {str(e)}")
+        return {
+            "available": False,
+            "hits": 0,
+            "misses": 0,
+            "hit_ratio": 0.0,
+        }
+    hits, misses = int(hits or 0), int(misses or 0)
+    total = hits + misses
+    return {
+        "available": True,
+        "hits": hits,
+        "misses": misses,
+        "hit_ratio": hits / total if total else 0.0,
+    }
@@ -57,6 +57,12 @@ class Settings(BaseSettings):
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
     POSTGRES_DB: str = ""
+    # 连接池（每个 worker 进程各自一份）
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_PRE_PING: bool = True
+    DB_POOL_RECYCLE: int = 1800  # 秒，-1 表示不回收
+    DB_POOL_TIMEOUT: float = 30  # 等待空闲连接的秒数
 
     @computed_field  # type: ignore[misc]
     @property
@@ -70,6 +76,27 @@ class Settings(BaseSettings):
             path=self.POSTGRES_DB,
         )
 
+    # 只读副本（可选），未配置时读请求全部走主库
+    POSTGRES_REPLICA_SERVER: str | None = None
+    POSTGRES_REPLICA_PORT: int = 5432
+    REPLICA_MAX_LAG: float = 5  # 副本回放延迟超过该秒数时回退主库
+    REPLICA_HEALTH_INTERVAL: float = 5  # 副本健康检查间隔秒数
+    READ_YOUR_WRITES_WINDOW: int = 10  # 同一客户端写入后读主库的秒数
+
+    @computed_field  # type: ignore[misc]
+    @property
+    def SQLALCHEMY_REPLICA_DATABASE_URI(self) -> PostgresDsn | None:
+        if not self.POSTGRES_REPLICA_SERVER:
+            return None
+        return MultiHostUrl.build(
+            scheme="postgresql+psycopg",
+            username=self.POSTGRES_USER,
+            password=self.POSTGRES_PASSWORD,
+            host=self.POSTGRES_REPLICA_SERVER,
+            port=self.POSTGRES_REPLICA_PORT,
+            path=self.POSTGRES_DB,
+        )
+
     SMTP_TLS: bool = True
     SMTP_SSL: bool = False
     SMTP_PORT: int = 587
@@ -122,6 +149,22 @@ class Settings(BaseSettings):
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
 
+    # 溯源
+    TRACE_MAX_DEPTH: int = 100  # 交易链最大回溯层数
+    TRACE_CACHE_TTL: int = 600  # 溯源结果缓存秒数
+    TRACE_BATCH_MAX: int = 500  # 批量溯源单次最多条数
+    BULK_PURCHASE_MAX: int = 200  # 批量采购单次最多条数
+    SPLIT_LOTS_MAX: int = 1000  # 单次重新拆分最多生成的批次数
+    INVENTORY_COMPACT_GRACE: int = 300  # 库存压缩跳过最近这么多秒内写入的流水，避开未提交的事务
+    QR_RENDER_WORKERS: int = 4  # 后台渲染二维码图片的进程数
+    QR_RENDER_STATUS_TTL: int = 86400  # 二维码渲染进度保留秒数
+    QR_EAGER_RENDER: bool = True  # 创建时即生成二维码图片；关闭后只记录内容，扫码下载时按需渲染
+    QR_IMAGE_CACHE_BYTES: int = 64 * 1024 * 1024  # 按需渲染图片的内存缓存上限
+    QR_IMAGE_CACHE_DIR: str = "uploads/qr_cache"  # 按需渲染图片的磁盘缓存目录
+    QR_IMAGE_DISK_CACHE_BYTES: int = 1024 * 1024 * 1024  # 磁盘缓存上限，超出后淘汰最久未用的图片
+    # 二维码内容格式：json 为带完整 URL 的 JSON；token 为 T/M<id>.<拆分序号>.<签名> 短令牌，需客户端支持
+    QR_PAYLOAD_FORMAT: Literal["json", "token"] = "json"
+
     # 短信服务
     REGION: str = "cn-hangzhou"  # 如 'cn-hangzhou'
     ACCESS_KEY_ID: str
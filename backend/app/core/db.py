@@ -1,10 +1,233 @@
+import logging
+import os
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any
+
+from sqlalchemy import exc, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from sqlmodel import Session, create_engine, select
 
 from app import crud
 from app.core.config import settings
 from app.models import User, UserCreate
 
-engine = create_engine(str(settings.SQLALCHEMY_DATABASE_URI))
+logger = logging.getLogger(__name__)
+
+
+class PoolMetrics:
+    """
+    Checkout counters of one connection pool in this worker process.
+    """
+
+    def __init__(self, window: int = 1000) -> None:
+        self._lock = threading.Lock()
+        self._recent: deque[float] = deque(maxlen=window)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            self._recent.append(seconds)
+
+    def record_timeout(self) -> None:
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            recent = sorted(self._recent)
+            checkouts, timeouts = self.checkouts, self.timeouts
+            wait_total, wait_max = self.wait_total, self.wait_max
+        if len(recent) >= 2:
+            quantiles = statistics.quantiles(recent, n=100)
+            p50, p95, p99 = quantiles[49], quantiles[94], quantiles[98]
+        else:
+            p50 = p95 = p99 = recent[0] if recent else 0.0
+        return {
+            "checkouts": checkouts,
+            "timeouts": timeouts,
+            "wait_avg_ms": wait_total / checkouts * 1000 if checkouts else 0.0,
+            "wait_max_ms": wait_max * 1000,
+            "wait_p50_ms": p50 * 1000,
+            "wait_p95_ms": p95 * 1000,
+            "wait_p99_ms": p99 * 1000,
+        }
+
+
+class _InstrumentedPoolMixin:
+    # 类属性：engine.dispose() 重建连接池时沿用同一份统计
+    metrics: PoolMetrics
+
+    def _do_get(self) -> Any:
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()  # type: ignore[misc]
+        except exc.TimeoutError:
+            self.metrics.record_timeout()
+            raise
+        self.metrics.record_wait(time.perf_counter() - start)
+        return connection
+
+
+class InstrumentedQueuePool(_InstrumentedPoolMixin, QueuePool):
+    metrics = PoolMetrics()
+
+
+class InstrumentedAsyncQueuePool(_InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    metrics = PoolMetrics()
+
+
+class InstrumentedReplicaQueuePool(InstrumentedQueuePool):
+    metrics = PoolMetrics()
+
+
+class InstrumentedAsyncReplicaQueuePool(InstrumentedAsyncQueuePool):
+    metrics = PoolMetrics()
+
+
+def _pool_options() -> dict[str, Any]:
+    return {
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+    }
+
+
+engine = create_engine(
+    str(settings.SQLALCHEMY_DATABASE_URI),
+    poolclass=InstrumentedQueuePool,
+    **_pool_options(),
+)
+# 异步引擎（psycopg async），供 async def 路由使用，避免在事件循环中阻塞 IO
+async_engine = create_async_engine(
+    str(settings.SQLALCHEMY_DATABASE_URI),
+    poolclass=InstrumentedAsyncQueuePool,
+    **_pool_options(),
+)
+
+# 只读副本：仅供无副作用的读路由使用，写入始终走主库
+replica_engine = None
+async_replica_engine = None
+if settings.SQLALCHEMY_REPLICA_DATABASE_URI:
+    replica_engine = create_engine(
+        str(settings.SQLALCHEMY_REPLICA_DATABASE_URI),
+        poolclass=InstrumentedReplicaQueuePool,
+        connect_args={"connect_timeout": 3},
+        **_pool_options(),
+    )
+    async_replica_engine = create_async_engine(
+        str(settings.SQLALCHEMY_REPLICA_DATABASE_URI),
+        poolclass=InstrumentedAsyncReplicaQueuePool,
+        connect_args={"connect_timeout": 3},
+        **_pool_options(),
+    )
+
+# 回放延迟（秒）；不在恢复模式，或 WAL 接收进程在运行且已回放完收到的 WAL 时为 0。
+# 接收进程断开后收到的与回放的 LSN 也会相等，此时改用最后回放事务的时间计算，
+# 从未回放过事务则视为无穷大
+REPLICA_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+            AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver) THEN 0
+        ELSE coalesce(
+            extract(epoch FROM now() - pg_last_xact_replay_timestamp())::float8,
+            'Infinity'::float8)
+    END
+""")
+
+
+class ReplicaHealth:
+    """
+    Cached replica health: reachable and replaying within
+    ``REPLICA_MAX_LAG`` seconds. Re-checked at most every
+    ``REPLICA_HEALTH_INTERVAL`` seconds per worker.
+    """
+
+    def __init__(self, replica: Any) -> None:
+        self.replica = replica
+        self._lock = threading.Lock()
+        self.checked_at = float("-inf")
+        self.healthy = False
+        self.lag: float | None = None
+
+    def is_stale(self) -> bool:
+        return (time.monotonic() - self.checked_at >=
+                settings.REPLICA_HEALTH_INTERVAL)
+
+    def check(self) -> bool:
+        # 只让一个线程执行检查，其余请求沿用上次结果
+        if not self._lock.acquire(blocking=False):
+            return self.healthy
+        try:
+            if not self.is_stale():
+                return self.healthy
+            try:
+                with self.replica.connect() as connection:
+                    self.lag = float(
+                        connection.execute(REPLICA_LAG_SQL).scalar_one())
+                self.healthy = self.lag <= settings.REPLICA_MAX_LAG
+                if not self.healthy:
+                    logger.warning(f"Replica lagging by {self.lag:.1f}s")
+            except exc.SQLAlchemyError as e:
+                logger.warning(f"Replica health check failed: {str(e)}")
+                self.lag = None
+                self.healthy = False
+            self.checked_at = time.monotonic()
+            return self.healthy
+        finally:
+            self._lock.release()
+
+    def is_healthy(self) -> bool:
+        return self.check() if self.is_stale() else self.healthy
+
+
+replica_health = ReplicaHealth(replica_engine) if replica_engine else None
+
+
+def _pool_stats(pool: Any) -> dict[str, Any]:
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        **pool.metrics.snapshot(),
+    }
+
+
+def get_pool_stats() -> dict[str, Any]:
+    """
+    Occupancy and checkout latency of this worker's sync and async pools.
+
+    Each gunicorn worker has its own pools, so the numbers are per ``pid``;
+    the worst case connection count is
+    ``workers * 2 * (pool_size + max_overflow)``.
+    """
+    stats = {
+        "pid": os.getpid(),
+        "sync": _pool_stats(engine.pool),
+        "async": _pool_stats(async_engine.pool),
+    }
+    if replica_health:
+        stats["replica"] = {
+            "healthy": replica_health.healthy,
+            "lag": replica_health.lag,
+            "sync": _pool_stats(replica_engine.pool),
+            "async": _pool_stats(async_replica_engine.pool),
+        }
+    return stats
 
 # make sure all SQLModel models are imported (app.models) before initializing DB
 # otherwise, SQLModel might fail to initialize relationships properly
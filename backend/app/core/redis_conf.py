@@ -1,10 +1,14 @@
 from redis import Redis
+from redis.asyncio import Redis as AsyncRedis
 
 from app.core.config import settings
 
 redis_client = Redis(
     host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=1, decode_responses=True
 )
+async_redis_client = AsyncRedis(
+    host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=1, decode_responses=True
+)
 
 
 def test_redis_connection():
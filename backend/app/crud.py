@@ -1,7 +1,13 @@
+from collections.abc import Sequence
+from datetime import datetime, timedelta
 from typing import Any, Optional
 
+from sqlalchemy import (Float, Integer, and_, column, func, insert, literal,
+                        tuple_, update, values)
+from sqlalchemy.orm import aliased
 from sqlmodel import Session, select
 
+from app.core.config import settings
 from app.core.security import get_password_hash, verify_password
 from app.models import (
     Consumer,
@@ -9,10 +15,13 @@ from app.models import (
     Grower,
     GrowerCreate,
     GrowerRead,
+    InventoryMovement,
+    InventorySnapshot,
     Item,
     ItemCreate,
     Middleman,
     MiddlemanCreate,
+    MiddlemanLineage,
     MiddlemanUpdate,
     Plot,
     PlotCreate,
@@ -21,6 +30,8 @@ from app.models import (
     ProductCreate,
     ProductRead,
     QRCodeInfo,
+    QRCodePayload,
+    SplitLot,
     Transaction,
     TransactionCreate,
     TransactionRead,
@@ -28,7 +39,7 @@ from app.models import (
     UserCreate,
     UserUpdate,
 )
-from app.utils import generate_qr_code
+from app.utils import generate_qr_code, qr_code_file_url
 
 
 def create_user(*, session: Session, user_create: UserCreate) -> User:
@@ -144,10 +155,16 @@ def get_grower_by_id(*, session: Session, grower_id: int) -> Grower | None:
     return session.exec(statement).first()
 
 
+def get_product_by_grower_and_name_statement(*, grower_id: int,
+                                             product_name: str) -> Any:
+    return select(Product).where(Product.grower_id == grower_id,
+                                 Product.name == product_name)
+
+
 def get_product_by_grower_and_name(*, session: Session, grower_id: int,
                                    product_name: str) -> Product | None:
-    statement = select(Product).where(Product.grower_id == grower_id,
-                                      Product.name == product_name)
+    statement = get_product_by_grower_and_name_statement(
+        grower_id=grower_id, product_name=product_name)
     return session.exec(statement).first()
 
 
@@ -242,6 +259,12 @@ def create_product(*, session: Session, product_in: ProductCreate) -> Product:
     db_product = Product.model_validate(
         product_in, update={"remaining_yield": product_in.total_yield})
     session.add(db_product)
+    session.flush()
+    record_inventory_movement(session=session,
+                              node_type="product",
+                              node_id=db_product.id,
+                              delta=db_product.total_yield,
+                              reason="stock")
     session.commit()
     session.refresh(db_product)
     return db_product
@@ -253,13 +276,229 @@ def get_product(*, session: Session, product_id: int) -> Optional[Product]:
 
 def update_product_yield(*, session: Session, db_product: Product,
                          quantity: float) -> Product:
-    db_product.remaining_yield -= quantity
-    session.add(db_product)
+    session.execute(
+        update(Product).where(Product.id == db_product.id).values(
+            remaining_yield=Product.remaining_yield - quantity))
     session.commit()
     session.refresh(db_product)
     return db_product
 
 
+# 库存扣减：单条 UPDATE ... WHERE remaining >= :q RETURNING，
+# 并发购买同一批次时由行锁串行化条件判断，不会超卖
+def decrement_product_yield(*, session: Session, product_id: int,
+                            quantity: float) -> Optional[float]:
+    """
+    Atomically take ``quantity`` from a product's remaining yield.
+
+    Returns the new remaining yield, or None when the product does not
+    exist or has less than ``quantity`` left (nothing is changed then).
+    """
+    statement = (update(Product).where(
+        Product.id == product_id,
+        Product.remaining_yield >= quantity).values(
+            remaining_yield=Product.remaining_yield - quantity).returning(
+                Product.remaining_yield).execution_options(
+                    synchronize_session=False))
+    return session.execute(statement).scalar_one_or_none()
+
+
+def decrement_middleman_remaining(*, session: Session, middleman_id: int,
+                                  quantity: float) -> Optional[float]:
+    """
+    Atomically take ``quantity`` from a middleman's remaining quantity.
+
+    Returns the new remaining quantity, or None when the middleman does not
+    exist or has less than ``quantity`` left (nothing is changed then).
+    """
+    statement = (update(Middleman).where(
+        Middleman.id == middleman_id,
+        Middleman.remaining_quantity >= quantity).values(
+            remaining_quantity=Middleman.remaining_quantity -
+            quantity).returning(Middleman.remaining_quantity).execution_options(
+                synchronize_session=False))
+    return session.execute(statement).scalar_one_or_none()
+
+
+# Inventory ledger
+def record_inventory_movement(*,
+                              session: Session,
+                              node_type: str,
+                              node_id: int,
+                              delta: float,
+                              reason: str,
+                              middleman_id: Optional[int] = None) -> None:
+    """
+    Append one row to the inventory ledger; nothing is committed here.
+    """
+    session.add(
+        InventoryMovement(node_type=node_type,
+                          node_id=node_id,
+                          delta=delta,
+                          reason=reason,
+                          middleman_id=middleman_id))
+
+
+def get_inventory_balance(*,
+                          session: Session,
+                          node_type: str,
+                          node_id: int,
+                          as_of: Optional[datetime] = None) -> float:
+    """
+    Balance of a product or middleman from its latest snapshot plus the
+    ledger rows written after it.
+
+    With ``as_of`` the latest snapshot taken at or before that time is used
+    and only movements created up to then are added.
+    """
+    snapshot_statement = select(InventorySnapshot).where(
+        InventorySnapshot.node_type == node_type,
+        InventorySnapshot.node_id == node_id)
+    if as_of is not None:
+        snapshot_statement = snapshot_statement.where(
+            InventorySnapshot.as_of <= as_of)
+    snapshot = session.exec(
+        snapshot_statement.order_by(
+            InventorySnapshot.last_movement_id.desc()).limit(1)).first()
+
+    tail_statement = get_inventory_tail_statement(
+        node_type=node_type,
+        node_id=node_id,
+        after_id=snapshot.last_movement_id if snapshot else 0,
+        as_of=as_of)
+    tail = session.exec(tail_statement).one()
+    return (snapshot.balance if snapshot else 0.0) + tail
+
+
+def get_inventory_tail_statement(*,
+                                 node_type: str,
+                                 node_id: int,
+                                 after_id: int,
+                                 as_of: Optional[datetime] = None) -> Any:
+    """
+    Sum of the ledger rows of a node after movement ``after_id``.
+    """
+    statement = select(func.coalesce(func.sum(InventoryMovement.delta),
+                                     0.0)).where(
+                                         InventoryMovement.node_type ==
+                                         node_type,
+                                         InventoryMovement.node_id == node_id,
+                                         InventoryMovement.id > after_id)
+    if as_of is not None:
+        statement = statement.where(InventoryMovement.created_at <= as_of)
+    return statement
+
+
+def compact_inventory(*,
+                      session: Session,
+                      grace: Optional[timedelta] = None) -> int:
+    """
+    Fold ledger rows written since each node's latest snapshot, up to a
+    cutoff, into new snapshot rows, and commit.
+
+    No lock is taken, so purchases keep inserting while this runs. The
+    cutoff is the highest id among rows created more than ``grace``
+    (``INVENTORY_COMPACT_GRACE`` seconds by default) ago: a purchase still
+    in flight holds an id below it only if its transaction has been open
+    that long. Returns the number of snapshots written.
+    """
+    if grace is None:
+        grace = timedelta(seconds=settings.INVENTORY_COMPACT_GRACE)
+    # 宽限期内的流水可能属于尚未提交的事务，留给下次压缩
+    cutoff = session.exec(
+        select(func.max(InventoryMovement.id)).where(
+            InventoryMovement.created_at < datetime.utcnow() - grace)).one()
+    if cutoff is None:
+        session.commit()
+        return 0
+
+    latest = select(InventorySnapshot).distinct(
+        InventorySnapshot.node_type, InventorySnapshot.node_id).order_by(
+            InventorySnapshot.node_type, InventorySnapshot.node_id,
+            InventorySnapshot.last_movement_id.desc()).subquery()
+    tail = select(
+        InventoryMovement.node_type, InventoryMovement.node_id,
+        literal(cutoff),
+        func.coalesce(latest.c.balance, 0.0) +
+        func.sum(InventoryMovement.delta),
+        literal(datetime.utcnow())).outerjoin(
+            latest,
+            and_(latest.c.node_type == InventoryMovement.node_type,
+                 latest.c.node_id == InventoryMovement.node_id)).where(
+                     InventoryMovement.id > func.coalesce(
+                         latest.c.last_movement_id, 0),
+                     InventoryMovement.id <= cutoff).group_by(
+                         InventoryMovement.node_type,
+                         InventoryMovement.node_id, latest.c.balance)
+    written = session.execute(
+        insert(InventorySnapshot).from_select([
+            "node_type", "node_id", "last_movement_id", "balance", "as_of"
+        ], tail).returning(InventorySnapshot.node_id)).all()
+    session.commit()
+    return len(written)
+
+
+def get_products_by_grower_and_names(
+        *, session: Session,
+        keys: Sequence[tuple[int, str]]) -> dict[tuple[int, str], Product]:
+    """
+    Resolve many ``(grower_id, product_name)`` pairs with one query.
+
+    When a grower has several products of the same name the lowest id wins.
+    """
+    if not keys:
+        return {}
+    statement = get_products_by_grower_and_names_statement(keys=keys)
+    return {(product.grower_id, product.name): product
+            for product in session.exec(statement)}
+
+
+def get_products_by_grower_and_names_statement(
+        *, keys: Sequence[tuple[int, str]]) -> Any:
+    return select(Product).where(
+        tuple_(Product.grower_id, Product.name).in_(set(keys))).order_by(
+            Product.id.desc())
+
+
+def _decrement_many(session: Session, model: Any, column_name: str,
+                    quantities: dict[int, float]) -> set[int]:
+    if not quantities:
+        return set()
+    amounts = values(column("id", Integer),
+                     column("quantity", Float),
+                     name="amounts").data(list(quantities.items()))
+    remaining = getattr(model, column_name)
+    statement = (update(model).where(
+        model.id == amounts.c.id, remaining >= amounts.c.quantity).values(
+            {column_name: remaining - amounts.c.quantity}).returning(
+                model.id).execution_options(synchronize_session=False))
+    return set(session.execute(statement).scalars())
+
+
+def decrement_products_yield(*, session: Session,
+                             quantities: dict[int, float]) -> set[int]:
+    """
+    Take ``quantities[product_id]`` from each product in one UPDATE ... FROM
+    (VALUES ...) statement.
+
+    Returns the ids that were decremented; products that are missing or
+    have too little yield left are not changed.
+    """
+    return _decrement_many(session, Product, "remaining_yield", quantities)
+
+
+def decrement_middlemen_remaining(*, session: Session,
+                                  quantities: dict[int, float]) -> set[int]:
+    """
+    Take ``quantities[middleman_id]`` from each middleman in one statement.
+
+    Returns the ids that were decremented; middlemen that are missing or
+    have too little left are not changed.
+    """
+    return _decrement_many(session, Middleman, "remaining_quantity",
+                           quantities)
+
+
 # Middleman CRUD operations
 def create_middleman(*, session: Session,
                      middleman_in: MiddlemanCreate) -> Middleman:
@@ -275,6 +514,176 @@ def get_middleman(*, session: Session,
     return session.get(Middleman, middleman_id)
 
 
+# Middleman lineage (closure table)
+def create_middleman_lineage(*, session: Session,
+                             middlemen: Sequence[Middleman]) -> None:
+    """
+    Insert the closure rows of newly created middlemen.
+
+    Every middleman gets a depth-0 row for itself plus one row per ancestor,
+    copied from its seller's rows with the depth and quantity path extended.
+    Must run in the transaction that creates the middlemen (after a flush,
+    so ids are assigned); nothing is committed here.
+    """
+    if not middlemen:
+        return
+    seller_ids = {
+        m.purchase_from_id
+        for m in middlemen if m.purchase_from_type == "middleman"
+    }
+    seller_lineage: dict[int, list[MiddlemanLineage]] = {}
+    if seller_ids:
+        statement = select(MiddlemanLineage).where(
+            MiddlemanLineage.descendant_id.in_(seller_ids))
+        for row in session.exec(statement):
+            seller_lineage.setdefault(row.descendant_id, []).append(row)
+
+    rows = []
+    for middleman in middlemen:
+        rows.append({
+            "ancestor_type": "middleman",
+            "ancestor_id": middleman.id,
+            "descendant_id": middleman.id,
+            "depth": 0,
+            "quantity_path": [],
+        })
+        if middleman.purchase_from_type == "grower":
+            rows.append({
+                "ancestor_type": "grower",
+                "ancestor_id": middleman.purchase_from_id,
+                "descendant_id": middleman.id,
+                "depth": 1,
+                "quantity_path": [middleman.purchased_quantity],
+            })
+        elif middleman.purchase_from_type == "middleman":
+            for ancestor in seller_lineage.get(middleman.purchase_from_id, []):
+                rows.append({
+                    "ancestor_type": ancestor.ancestor_type,
+                    "ancestor_id": ancestor.ancestor_id,
+                    "descendant_id": middleman.id,
+                    "depth": ancestor.depth + 1,
+                    "quantity_path":
+                    ancestor.quantity_path + [middleman.purchased_quantity],
+                })
+    session.execute(insert(MiddlemanLineage), rows)
+
+
+def get_middlemen_upstream(
+    *, session: Session, middleman_ids: Sequence[int]
+) -> dict[int, list[tuple[MiddlemanLineage, Optional[Middleman],
+                          Optional[Grower]]]]:
+    """
+    Return the ancestors of several middlemen, nearest first, keyed by
+    middleman id, in one query.
+
+    Each row is ``(lineage, middleman, grower)`` where exactly one of
+    ``middleman``/``grower`` is set according to ``lineage.ancestor_type``.
+    """
+    statement = get_middlemen_upstream_statement(middleman_ids=middleman_ids)
+    upstream: dict[int, list[tuple[MiddlemanLineage, Optional[Middleman],
+                                   Optional[Grower]]]] = {}
+    for row in session.exec(statement):
+        upstream.setdefault(row[0].descendant_id, []).append(row)
+    return upstream
+
+
+def get_middlemen_upstream_statement(*, middleman_ids: Sequence[int]) -> Any:
+    return (select(MiddlemanLineage, Middleman, Grower).outerjoin(
+        Middleman,
+        and_(MiddlemanLineage.ancestor_type == "middleman",
+             Middleman.id == MiddlemanLineage.ancestor_id)).outerjoin(
+                 Grower,
+                 and_(MiddlemanLineage.ancestor_type == "grower",
+                      Grower.id == MiddlemanLineage.ancestor_id)).where(
+                          MiddlemanLineage.descendant_id.in_(middleman_ids),
+                          MiddlemanLineage.depth > 0).order_by(
+                              MiddlemanLineage.descendant_id,
+                              MiddlemanLineage.depth))
+
+
+def get_middleman_upstream(
+        *, session: Session,
+        middleman_id: int) -> list[tuple[MiddlemanLineage, Optional[Middleman],
+                                         Optional[Grower]]]:
+    """
+    Return every ancestor of a middleman, nearest first, in one query.
+    """
+    return get_middlemen_upstream(session=session,
+                                  middleman_ids=[middleman_id]).get(
+                                      middleman_id, [])
+
+
+def get_middleman_downstream(
+        *, session: Session, ancestor_type: str,
+        ancestor_id: int) -> list[tuple[MiddlemanLineage, Middleman]]:
+    """
+    Return every middleman that bought, directly or indirectly, from the
+    given grower or middleman, nearest first, in one query.
+    """
+    statement = get_middleman_downstream_statement(ancestor_type=ancestor_type,
+                                                   ancestor_id=ancestor_id)
+    return list(session.exec(statement).all())
+
+
+def get_middleman_downstream_statement(*, ancestor_type: str,
+                                       ancestor_id: int) -> Any:
+    return (select(MiddlemanLineage, Middleman).join(
+        Middleman, Middleman.id == MiddlemanLineage.descendant_id).where(
+            MiddlemanLineage.ancestor_type == ancestor_type,
+            MiddlemanLineage.ancestor_id == ancestor_id,
+            MiddlemanLineage.depth > 0).order_by(MiddlemanLineage.depth,
+                                                 MiddlemanLineage.descendant_id))
+
+
+def get_recall_statement(*, grower_id: int,
+                         product_name: Optional[str] = None) -> Any:
+    """
+    Build the set-based forward trace (recall) query for a grower, or for
+    one of its products when ``product_name`` is given.
+
+    The statement selects one row per downstream middleman lot with its
+    depth below the grower and the quantities along the lineage path (for a
+    product, the path starts at the middleman who bought it from the
+    grower), so it can be streamed with ``yield_per`` however large the
+    fan-out is.
+    """
+    columns = (
+        Middleman.id.label("middleman_id"),
+        Middleman.name,
+        Middleman.phone_number,
+        Middleman.purchase_from_type,
+        Middleman.purchase_from_id,
+        Middleman.purchased_product,
+        Middleman.purchased_quantity,
+        Middleman.remaining_quantity,
+        Middleman.split_quantities,
+        Middleman.split_qr_codes,
+        Middleman.qr_code,
+        MiddlemanLineage.quantity_path,
+    )
+    if product_name is None:
+        return (select(*columns, MiddlemanLineage.depth).join(
+            Middleman, Middleman.id == MiddlemanLineage.descendant_id).where(
+                MiddlemanLineage.ancestor_type == "grower",
+                MiddlemanLineage.ancestor_id == grower_id,
+                MiddlemanLineage.depth > 0).order_by(MiddlemanLineage.depth,
+                                                     Middleman.id))
+
+    # 直接从种植者买入该产品的中间商，以及他们的全部下游（含自身）
+    first_hop = select(MiddlemanLineage.descendant_id).join(
+        Middleman, Middleman.id == MiddlemanLineage.descendant_id).where(
+            MiddlemanLineage.ancestor_type == "grower",
+            MiddlemanLineage.ancestor_id == grower_id,
+            MiddlemanLineage.depth == 1,
+            Middleman.purchased_product == product_name)
+    depth = (MiddlemanLineage.depth + 1).label("depth")
+    return (select(*columns, depth).join(
+        Middleman, Middleman.id == MiddlemanLineage.descendant_id).where(
+            MiddlemanLineage.ancestor_type == "middleman",
+            MiddlemanLineage.ancestor_id.in_(first_hop)).order_by(
+                depth, Middleman.id))
+
+
 # Transaction CRUD operations
 def create_transaction(*, session: Session,
                        transaction_in: TransactionCreate) -> Transaction:
@@ -304,35 +713,311 @@ def get_transaction(*, session: Session,
     return session.get(Transaction, transaction_id)
 
 
+def get_transaction_by_qr_code_statement(*, qr_code: str) -> Any:
+    return select(Transaction).where(Transaction.qr_code == qr_code)
+
+
 def get_transaction_by_qr_code(*, session: Session,
                                qr_code: str) -> Optional[Transaction]:
-    statement = select(Transaction).where(Transaction.qr_code == qr_code)
+    statement = get_transaction_by_qr_code_statement(qr_code=qr_code)
     return session.exec(statement).first()
 
 
 # QR Code Info
-def get_qr_code_info(*, session: Session,
-                     qr_code: str) -> Optional[QRCodeInfo]:
-    transaction = get_transaction_by_qr_code(session=session, qr_code=qr_code)
-    if not transaction:
+def get_qr_code_info(*,
+                     session: Session,
+                     qr_code: str,
+                     max_depth: Optional[int] = None) -> Optional[QRCodeInfo]:
+    """
+    Trace a transaction QR code back through its parent transactions.
+
+    The whole ancestor chain, together with the scanned transaction's
+    product, plot and grower, is fetched with a single WITH RECURSIVE query;
+    the grower's full plot and product lists are loaded after it, one query
+    each.
+    At most ``max_depth`` ancestors are followed (defaults to
+    ``settings.TRACE_MAX_DEPTH``), which also guards against cycles.
+    """
+    if max_depth is None:
+        max_depth = settings.TRACE_MAX_DEPTH
+
+    statement = get_qr_code_info_statement(qr_code=qr_code,
+                                           max_depth=max_depth)
+    rows = session.exec(statement).all()
+    if not rows:
         return None
 
-    product = transaction.product
-    plot = product.plot
-    grower = plot.grower
-
-    # Get all related transactions
-    related_transactions = []
-    current_transaction = transaction
-    while current_transaction:
-        related_transactions.append(current_transaction)
-        current_transaction = current_transaction.parent_transaction
+    _, product, plot, grower = rows[0]
+    if not product or not plot or not grower:
+        return None
 
     return QRCodeInfo(
+        # 校验时加载种植者的全部地块和产品，而不只是本次溯源的那一个
         grower=GrowerRead.model_validate(grower),
         plot=PlotRead.model_validate(plot),
         product=ProductRead.model_validate(product),
-        transactions=[
-            TransactionRead.model_validate(t) for t in related_transactions
-        ],
+        transactions=[TransactionRead.model_validate(row[0]) for row in rows],
     )
+
+
+def get_qr_code_info_statement(*, qr_code: str, max_depth: int) -> Any:
+    chain = (select(Transaction.id, Transaction.parent_transaction_id,
+                    literal(0).label("depth")).where(
+                        Transaction.qr_code == qr_code).cte(
+                            "transaction_chain", recursive=True))
+    parent = aliased(Transaction)
+    chain = chain.union_all(
+        select(parent.id, parent.parent_transaction_id,
+               chain.c.depth + 1).where(
+                   parent.id == chain.c.parent_transaction_id,
+                   chain.c.depth < max_depth))
+
+    # 产品、地块、种植者只取被扫描的交易（depth = 0）那一行
+    return (select(Transaction, Product, Plot, Grower).join(
+        chain, chain.c.id == Transaction.id).outerjoin(
+            Product,
+            and_(chain.c.depth == 0,
+                 Product.id == Transaction.product_id)).outerjoin(
+                     Plot, Plot.id == Product.plot_id).outerjoin(
+                         Grower, Grower.id == Plot.grower_id).order_by(
+                             chain.c.depth))
+
+
+# QR Code Payload
+# 只写入当前事务，由调用方负责提交，保证与中间商记录一起落库
+def create_qr_code_payload(*, session: Session, qr_code: str, payload: str,
+                           source_type: str,
+                           middleman_id: Optional[int] = None,
+                           split_index: Optional[int] = None,
+                           parent_type: Optional[str] = None,
+                           parent_id: Optional[int] = None) -> QRCodePayload:
+    db_payload = QRCodePayload(qr_code=qr_code,
+                               payload=payload,
+                               source_type=source_type,
+                               middleman_id=middleman_id,
+                               split_index=split_index,
+                               parent_type=parent_type,
+                               parent_id=parent_id)
+    session.add(db_payload)
+    return db_payload
+
+
+def create_qr_code_payloads(*, session: Session,
+                            payloads: Sequence[dict[str, Any]]) -> list[int]:
+    """
+    Insert many QR code payload rows (``create_qr_code_payload`` keyword
+    arguments) in one statement and return their ids in the same order.
+    """
+    if not payloads:
+        return []
+    statement = insert(QRCodePayload).returning(QRCodePayload.id,
+                                                sort_by_parameter_order=True)
+    return list(session.scalars(statement, list(payloads)))
+
+
+def get_qr_code_payload_statement(*, qr_code: str) -> Any:
+    return select(QRCodePayload).where(QRCodePayload.qr_code == qr_code)
+
+
+def get_qr_code_payload(*, session: Session,
+                        qr_code: str) -> Optional[QRCodePayload]:
+    statement = get_qr_code_payload_statement(qr_code=qr_code)
+    return session.exec(statement).first()
+
+
+def get_middleman_by_split_qr_code(
+        *, session: Session, qr_code: str) -> Optional[tuple[Middleman, int]]:
+    """
+    Return the middleman owning the split QR code file ``qr_code`` and its
+    split index. ``split_qr_codes`` holds the public file URLs, so the
+    filename is turned back into one and matched by JSONB containment, which
+    the GIN index on the column serves.
+    """
+    url = qr_code_file_url(qr_code, "uploads/middleman_qrcodes")
+    statement = get_middleman_by_split_qr_code_statement(url=url)
+    middleman = session.exec(statement).first()
+    if not middleman:
+        return None
+    return middleman, middleman.split_qr_codes.index(url)
+
+
+def get_middleman_by_split_qr_code_statement(*, url: str) -> Any:
+    return select(Middleman).where(Middleman.split_qr_codes.contains([url]))
+
+
+# Split lots
+def create_split_lots(*, session: Session,
+                      middlemen: Sequence[Middleman]) -> None:
+    """
+    Insert one lot per entry of each middleman's ``split_quantities``, with
+    the whole quantity remaining. Must run after a flush so the middleman
+    ids are assigned; nothing is committed here.
+    """
+    lots = [
+        SplitLot(middleman_id=m.id,
+                 split_index=index,
+                 quantity=quantity,
+                 remaining=quantity) for m in middlemen
+        for index, quantity in enumerate(m.split_quantities)
+    ]
+    session.add_all(lots)
+
+
+def get_split_lots_statement(*, middleman_id: int) -> Any:
+    return select(SplitLot).where(
+        SplitLot.middleman_id == middleman_id).order_by(SplitLot.split_index)
+
+
+def get_split_lots(*, session: Session, middleman_id: int) -> list[SplitLot]:
+    statement = get_split_lots_statement(middleman_id=middleman_id)
+    return list(session.exec(statement))
+
+
+def get_split_lots_by_middlemen_statement(*,
+                                         middleman_ids: Sequence[int]) -> Any:
+    return select(SplitLot).where(
+        SplitLot.middleman_id.in_(set(middleman_ids))).order_by(
+            SplitLot.middleman_id, SplitLot.split_index)
+
+
+def get_split_lots_by_middlemen(
+        *, session: Session,
+        middleman_ids: Sequence[int]) -> dict[int, list[SplitLot]]:
+    """
+    Split lots of many middlemen with one query, by middleman id and in
+    split order. Middlemen without splits are absent.
+    """
+    if not middleman_ids:
+        return {}
+    statement = get_split_lots_by_middlemen_statement(
+        middleman_ids=middleman_ids)
+    lots: dict[int, list[SplitLot]] = {}
+    for lot in session.exec(statement):
+        lots.setdefault(lot.middleman_id, []).append(lot)
+    return lots
+
+
+def get_split_lot(*, session: Session, middleman_id: int,
+                  split_index: int) -> Optional[SplitLot]:
+    statement = select(SplitLot).where(SplitLot.middleman_id == middleman_id,
+                                       SplitLot.split_index == split_index)
+    return session.exec(statement).first()
+
+
+def get_split_lots_by_keys(
+        *, session: Session,
+        keys: Sequence[tuple[int, int]]) -> dict[tuple[int, int], SplitLot]:
+    """
+    Resolve many ``(middleman_id, split_index)`` pairs with one query.
+    """
+    if not keys:
+        return {}
+    statement = get_split_lots_by_keys_statement(keys=keys)
+    return {(lot.middleman_id, lot.split_index): lot
+            for lot in session.exec(statement)}
+
+
+def get_split_lots_by_keys_statement(*,
+                                     keys: Sequence[tuple[int, int]]) -> Any:
+    return select(SplitLot).where(
+        tuple_(SplitLot.middleman_id, SplitLot.split_index).in_(set(keys)))
+
+
+def decrement_split_lot_remaining(*, session: Session, middleman_id: int,
+                                  split_index: int,
+                                  quantity: float) -> Optional[float]:
+    """
+    Atomically take ``quantity`` from a single lot.
+
+    Returns the lot's new remaining quantity, or None when the lot does not
+    exist or has less than ``quantity`` left (nothing is changed then).
+    """
+    statement = (update(SplitLot).where(
+        SplitLot.middleman_id == middleman_id,
+        SplitLot.split_index == split_index,
+        SplitLot.remaining >= quantity).values(
+            remaining=SplitLot.remaining - quantity).returning(
+                SplitLot.remaining).execution_options(
+                    synchronize_session=False))
+    return session.execute(statement).scalar_one_or_none()
+
+
+def _split_lot_amounts(quantities: dict[tuple[int, int], float]) -> Any:
+    return values(column("middleman_id", Integer),
+                  column("split_index", Integer),
+                  column("quantity", Float),
+                  name="amounts").data([(middleman_id, split_index, quantity)
+                                        for (middleman_id, split_index),
+                                        quantity in quantities.items()])
+
+
+def decrement_split_lots_remaining(
+        *, session: Session,
+        quantities: dict[tuple[int, int], float]) -> set[tuple[int, int]]:
+    """
+    Take ``quantities[(middleman_id, split_index)]`` from each lot in one
+    statement.
+
+    Returns the keys that were decremented; lots that are missing or have
+    too little left are not changed.
+    """
+    if not quantities:
+        return set()
+    amounts = _split_lot_amounts(quantities)
+    statement = (update(SplitLot).where(
+        SplitLot.middleman_id == amounts.c.middleman_id,
+        SplitLot.split_index == amounts.c.split_index,
+        SplitLot.remaining >= amounts.c.quantity).values(
+            remaining=SplitLot.remaining - amounts.c.quantity).returning(
+                SplitLot.middleman_id, SplitLot.split_index).execution_options(
+                    synchronize_session=False))
+    return {tuple(row) for row in session.execute(statement)}
+
+
+def restore_split_lots_remaining(
+        *, session: Session, quantities: dict[tuple[int, int],
+                                              float]) -> None:
+    """
+    Give back quantities taken by ``decrement_split_lots_remaining`` when
+    the rest of the purchase cannot go through.
+    """
+    if not quantities:
+        return
+    amounts = _split_lot_amounts(quantities)
+    session.execute(
+        update(SplitLot).where(
+            SplitLot.middleman_id == amounts.c.middleman_id,
+            SplitLot.split_index == amounts.c.split_index).values(
+                remaining=SplitLot.remaining +
+                amounts.c.quantity).execution_options(
+                    synchronize_session=False))
+
+
+def get_next_split_index(*, session: Session, middleman_id: int) -> int:
+    statement = select(func.coalesce(func.max(SplitLot.split_index) + 1,
+                                     0)).where(
+                                         SplitLot.middleman_id == middleman_id)
+    return session.exec(statement).one()
+
+
+def create_child_split_lots(*, session: Session, parent: SplitLot,
+                            first_index: int, quantities: Sequence[float],
+                            qr_payload_ids: Sequence[Optional[int]]
+                            ) -> list[SplitLot]:
+    """
+    Insert the lots a parent lot was re-split into, numbered from
+    ``first_index``, in one statement. The caller takes their total from
+    the parent.
+    """
+    rows = [{
+        "middleman_id": parent.middleman_id,
+        "split_index": first_index + offset,
+        "quantity": quantity,
+        "remaining": quantity,
+        "qr_payload_id": qr_payload_id,
+        "parent_lot_id": parent.id,
+    } for offset, (quantity, qr_payload_id) in enumerate(
+        zip(quantities, qr_payload_ids))]
+    statement = insert(SplitLot).returning(SplitLot,
+                                           sort_by_parameter_order=True)
+    return list(session.scalars(statement, rows))
@@ -0,0 +1,21 @@
+import logging
+
+from sqlmodel import Session
+
+from app.core.db import engine
+from app.crud import compact_inventory
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main() -> None:
+    # 定期执行（如 cron），把库存流水压缩为快照，缩短余额查询需累加的流水
+    logger.info("Compacting inventory ledger")
+    with Session(engine) as session:
+        count = compact_inventory(session=session)
+    logger.info(f"Inventory snapshots written: {count}")
+
+
+if __name__ == "__main__":
+    main()
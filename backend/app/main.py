@@ -1,17 +1,36 @@
-from fastapi import FastAPI
+import time
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
 from fastapi.routing import APIRoute
 from starlette.middleware.cors import CORSMiddleware
 
+from app import qr_render
+from app.api.deps import READ_PRIMARY_COOKIE
 from app.api.main import api_router
 from app.core.config import settings
+from app.core.db import async_engine, async_replica_engine
+from app.core.redis_conf import async_redis_client
 
 
 def custom_generate_unique_id(route: APIRoute) -> str:
     return f"{route.tags[0]}-{route.name}"
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    # 异步连接绑定在当前事件循环上，退出时释放连接池
+    await async_engine.dispose()
+    if async_replica_engine:
+        await async_replica_engine.dispose()
+    await async_redis_client.aclose()
+    qr_render.shutdown()
+
+
 app = FastAPI(
     title=settings.PROJECT_NAME,
+    lifespan=lifespan,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     generate_unique_id_function=custom_generate_unique_id,
 )
@@ -30,4 +49,24 @@ if settings.BACKEND_CORS_ORIGINS:
         allow_headers=["*"],
     )
 
+async def read_your_writes(request: Request, call_next):
+    response = await call_next(request)
+    # 写请求后一段时间内该客户端读主库，避免读到副本尚未回放的旧数据；
+    # 标记为只读的 POST（扫码查询等）不算写请求
+    if (request.method not in ("GET", "HEAD", "OPTIONS")
+            and response.status_code < 400
+            and not getattr(request.state, "read_only", False)):
+        window = settings.READ_YOUR_WRITES_WINDOW
+        response.set_cookie(READ_PRIMARY_COOKIE,
+                            f"{time.time() + window:.3f}",
+                            max_age=window,
+                            httponly=True,
+                            samesite="lax")
+    return response
+
+
+if settings.SQLALCHEMY_REPLICA_DATABASE_URI:
+    app.middleware("http")(read_your_writes)
+
+
 app.include_router(api_router, prefix=settings.API_V1_STR)
@@ -1,8 +1,9 @@
 from datetime import date, datetime
 from typing import Generic, List, Optional, TypeVar
 
-from sqlalchemy import JSON
-from sqlmodel import JSON, Column, Field, Relationship, SQLModel
+from sqlalchemy import Index, UniqueConstraint
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlmodel import Column, Field, Relationship, SQLModel
 
 T = TypeVar("T")
 
@@ -16,6 +17,11 @@ class ResponseBase(SQLModel, Generic[T]):
         arbitrary_types_allowed = True
 
 
+class PageResponse(ResponseBase[T], Generic[T]):
+    next_cursor: Optional[str] = Field(default=None,
+                                       description="下一页游标，为空表示没有更多数据")
+
+
 class UserBase(SQLModel):
     phone: str = Field(unique=True, index=True, description="用户手机号")
     is_active: bool = Field(default=True, description="用户是否激活")
@@ -65,7 +71,10 @@ class UserOut(UserBase):
 
 class UsersOut(SQLModel):
     data: List[UserOut] = Field(..., description="用户列表")
-    count: int = Field(..., description="用户总数")
+    count: Optional[int] = Field(default=None,
+                                 description="用户总数，仅第一页返回")
+    next_cursor: Optional[str] = Field(default=None,
+                                       description="下一页游标，为空表示没有更多数据")
 
 
 class ItemBase(SQLModel):
@@ -201,6 +210,8 @@ class MiddlemanCreate(MiddlemanBase):
                                                    description="交易合同图片URL列表")
     split_quantities: Optional[List[float]] = Field(None, description="拆分数量列表")
     split_qr_codes: Optional[List[str]] = Field(None, description="拆分二维码列表")
+    purchase_from_split_index: Optional[int] = Field(
+        None, description="从上游中间商的哪个拆分批次购买，为空表示不指定批次")
 
 
 class ConsumerCreate(ConsumerBase):
@@ -226,6 +237,20 @@ class ProductRead(ProductCreate):
         from_attributes = True
 
 
+class ProductStock(SQLModel):
+    id: int = Field(..., description="产品ID")
+    remaining_yield: float = Field(..., description="剩余产量")
+
+
+class GrowerSummary(GrowerBase):
+    id: int = Field(..., description="种植者ID")
+    qr_code: Optional[str] = Field(None, description="二维码")
+    id_card_photo: Optional[List[str]] = Field(None, description="身份证照片URL列表")
+    crop_type_pic: Optional[List[str]] = Field(None, description="种植品种图片URL列表")
+    plots: List[PlotRead] = Field(default=[], description="地块信息列表")
+    products: List[ProductStock] = Field(default=[], description="产品库存列表")
+
+
 class GrowerRead(GrowerBase):
     id: int = Field(..., description="种植者ID")
     qr_code: str = Field(..., description="二维码")
@@ -258,16 +283,16 @@ class TransactionRead(TransactionCreate):
 class Grower(GrowerBase, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     qr_code: Optional[str] = Field(None, description="二维码")
-    id_card_photo: Optional[List[str]] = Field(sa_column=Column(JSON),
+    id_card_photo: Optional[List[str]] = Field(sa_column=Column(JSONB),
                                                default=None,
                                                description="身份证照片URL列表")
     land_ownership_certificate: Optional[List[str]] = Field(
-        sa_column=Column(JSON), default=None, description="土地所有权证书URL列表")
-    crop_type_pic: Optional[List[str]] = Field(sa_column=Column(JSON),
+        sa_column=Column(JSONB), default=None, description="土地所有权证书URL列表")
+    crop_type_pic: Optional[List[str]] = Field(sa_column=Column(JSONB),
                                                default=None,
                                                description="种植品种图片URL列表")
     business_license_photos: Optional[List[str]] = Field(
-        sa_column=Column(JSON), default=None, description="营业执照照片URL列表")
+        sa_column=Column(JSONB), default=None, description="营业执照照片URL列表")
     # sold_to_middlemen: List["Middleman"] = Relationship(
     #     back_populates="purchase_from_grower",
     #     sa_relationship_kwargs={"foreign_keys": "Middleman.purchase_from_id"},
@@ -285,6 +310,8 @@ class Grower(GrowerBase, table=True):
     user_id: Optional[int] = Field(default=None, foreign_key="user.id")
     user: Optional[User] = Relationship(back_populates="grower")
 
+    __table_args__ = (Index("ix_grower_phone_number", "phone_number"), )
+
 
 class Plot(PlotBase, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -302,6 +329,10 @@ class Product(ProductBase, table=True):
     grower: Grower = Relationship(back_populates="products")
     transactions: List["Transaction"] = Relationship(back_populates="product")
 
+    # 按 (种植者, 产品名) 查找产品：采购时定位种植者的产品批次
+    __table_args__ = (Index("ix_product_grower_id_name", "grower_id",
+                            "name"), )
+
 
 class Middleman(MiddlemanBase, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -309,6 +340,8 @@ class Middleman(MiddlemanBase, table=True):
     purchase_from_id: Optional[int] = Field(default=None)
     purchase_from_type: Optional[str] = Field(
         None, description="购买来源类型：grower 或 middleman")
+    purchase_from_split_index: Optional[int] = Field(
+        None, description="购买来源中间商的拆分序号")
     purchase_from: Optional["Middleman"] = Relationship(
         back_populates="sold_to_middlemen",
         sa_relationship_kwargs={
@@ -324,13 +357,13 @@ class Middleman(MiddlemanBase, table=True):
             "and_(foreign(Middleman.purchase_from_id) == Middleman.id, Middleman.purchase_from_type == 'middleman')",
         })
     transaction_contracts: List[str] = Field(default_factory=list,
-                                             sa_column=Column(JSON),
+                                             sa_column=Column(JSONB),
                                              description="交易合同")
     id_card_photo: List[str] = Field(default_factory=list,
-                                     sa_column=Column(JSON),
+                                     sa_column=Column(JSONB),
                                      description="身份证照片URL列表")
     business_license_photos: List[str] = Field(default_factory=list,
-                                               sa_column=Column(JSON),
+                                               sa_column=Column(JSONB),
                                                description="营业执照照片URL列表")
     consumers: List["Consumer"] = Relationship(back_populates="middleman")
     sold_transactions: List["Transaction"] = Relationship(
@@ -348,22 +381,33 @@ class Middleman(MiddlemanBase, table=True):
     user: Optional[User] = Relationship(back_populates="middleman")
     purchased_product: Optional[str] = Field(None, description="购买的产品")
     purchased_quantity: Optional[float] = Field(None, description="购买数量")
-    transaction_contract_images: List[str] = Field(sa_column=Column(JSON),
+    transaction_contract_images: List[str] = Field(sa_column=Column(JSONB),
                                                    default_factory=list,
                                                    description="交易合同图片URL列表")
-    split_quantities: List[float] = Field(sa_column=Column(JSON),
+    split_quantities: List[float] = Field(sa_column=Column(JSONB),
                                           default_factory=list,
                                           description="拆分数量列表")
-    split_qr_codes: List[str] = Field(sa_column=Column(JSON),
+    split_qr_codes: List[str] = Field(sa_column=Column(JSONB),
                                       default_factory=list,
                                       description="拆分后的二维码列表")
     original_split: Optional[List[float]] = Field(default=None,
-                                                  sa_column=Column(JSON),
+                                                  sa_column=Column(JSONB),
                                                   description="原始拆分数量")
     original_qr_codes: Optional[List[str]] = Field(default=None,
-                                                   sa_column=Column(JSON),
+                                                   sa_column=Column(JSONB),
                                                    description="原始拆分二维码")
 
+    # 按来源查下游中间商：溯源链与召回
+    # 按拆分二维码反查所属中间商：split_qr_codes @> '["<url>"]'
+    __table_args__ = (
+        Index("ix_middleman_purchase_from", "purchase_from_type",
+              "purchase_from_id"),
+        Index("ix_middleman_split_qr_codes",
+              "split_qr_codes",
+              postgresql_using="gin",
+              postgresql_ops={"split_qr_codes": "jsonb_path_ops"}),
+    )
+
 
 class Consumer(ConsumerBase, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -380,7 +424,8 @@ class Transaction(TransactionBase, table=True):
     transaction_date: datetime = Field(default_factory=datetime.utcnow,
                                        description="交易日期")
     parent_transaction_id: Optional[int] = Field(default=None,
-                                                 foreign_key="transaction.id")
+                                                 foreign_key="transaction.id",
+                                                 index=True)
     qr_code: Optional[str] = Field(None, unique=True, description="二维码")
     grower_seller: Optional[Grower] = Relationship(
         back_populates="sold_transactions",
@@ -408,6 +453,107 @@ class Transaction(TransactionBase, table=True):
     child_transactions: List["Transaction"] = Relationship(
         back_populates="parent_transaction")
 
+    __table_args__ = (Index("ix_transaction_seller", "seller_type",
+                            "seller_id"), )
+
+
+class MiddlemanLineage(SQLModel, table=True):
+    ancestor_type: str = Field(primary_key=True,
+                               description="祖先类型：grower 或 middleman")
+    ancestor_id: int = Field(primary_key=True, description="祖先ID")
+    descendant_id: int = Field(primary_key=True,
+                               foreign_key="middleman.id",
+                               index=True,
+                               description="后代中间商ID")
+    depth: int = Field(..., description="祖先到后代的层数，自身为 0")
+    quantity_path: List[float] = Field(sa_column=Column(JSONB),
+                                       default_factory=list,
+                                       description="祖先到后代沿途每一级的购买数量")
+
+
+class QRCodePayload(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    qr_code: str = Field(..., unique=True, index=True, description="二维码文件名")
+    source_type: str = Field(
+        ..., description="二维码来源类型：grower、middleman 或 transaction")
+    middleman_id: Optional[int] = Field(default=None,
+                                        foreign_key="middleman.id",
+                                        index=True,
+                                        description="中间商ID")
+    split_index: Optional[int] = Field(None, description="拆分序号，主二维码为空")
+    parent_type: Optional[str] = Field(None,
+                                       description="上游来源类型：grower 或 middleman")
+    parent_id: Optional[int] = Field(None, description="上游来源ID")
+    payload: str = Field(..., description="二维码编码内容")
+    created_at: datetime = Field(default_factory=datetime.utcnow,
+                                 description="创建时间")
+
+
+class SplitLot(SQLModel, table=True):
+    """中间商拆分后的单个批次，对应一张拆分二维码"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    middleman_id: int = Field(..., foreign_key="middleman.id",
+                              description="所属中间商ID")
+    split_index: int = Field(..., description="拆分序号")
+    quantity: float = Field(..., description="批次数量")
+    remaining: float = Field(..., description="批次剩余数量")
+    qr_payload_id: Optional[int] = Field(default=None,
+                                         foreign_key="qrcodepayload.id",
+                                         description="批次二维码内容ID")
+    parent_lot_id: Optional[int] = Field(default=None,
+                                         foreign_key="splitlot.id",
+                                         index=True,
+                                         description="重新拆分前的父批次ID，原始拆分为空")
+
+    # 按 (中间商, 拆分序号) 定位批次：扫码与下游按批次采购
+    __table_args__ = (UniqueConstraint("middleman_id",
+                                       "split_index",
+                                       name="uq_splitlot_middleman_split"), )
+
+
+class SplitLotRead(SQLModel):
+    id: int = Field(..., description="批次ID")
+    split_index: int = Field(..., description="拆分序号")
+    quantity: float = Field(..., description="批次数量")
+    remaining: float = Field(..., description="批次剩余数量")
+    parent_lot_id: Optional[int] = Field(None, description="父批次ID")
+    qr_code: Optional[str] = Field(None, description="批次二维码")
+
+
+class SplitLotRepackage(SQLModel):
+    quantities: List[float] = Field(..., min_length=1,
+                                    description="重新拆分后各子批次的数量")
+
+
+class InventoryMovement(SQLModel, table=True):
+    """库存流水，只追加不修改；正数为入库，负数为出库"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    node_type: str = Field(..., description="库存节点类型：product 或 middleman")
+    node_id: int = Field(..., description="库存节点ID")
+    delta: float = Field(..., description="数量变化")
+    reason: str = Field(..., description="变动原因：stock、purchase 或 sale")
+    middleman_id: Optional[int] = Field(default=None,
+                                        foreign_key="middleman.id",
+                                        description="引起变动的中间商ID")
+    created_at: datetime = Field(default_factory=datetime.utcnow,
+                                 index=True,
+                                 description="创建时间")
+
+    __table_args__ = (Index("ix_inventorymovement_node", "node_type",
+                            "node_id", "id"), )
+
+
+class InventorySnapshot(SQLModel, table=True):
+    """库存快照，由定期压缩流水生成，余额 = 最新快照 + 之后的流水"""
+    node_type: str = Field(primary_key=True,
+                           description="库存节点类型：product 或 middleman")
+    node_id: int = Field(primary_key=True, description="库存节点ID")
+    last_movement_id: int = Field(primary_key=True,
+                                  description="快照已包含的最大流水ID")
+    balance: float = Field(..., description="截至该流水的余额")
+    as_of: datetime = Field(default_factory=datetime.utcnow,
+                            description="快照时间")
+
 
 class QRCodeInfo(SQLModel):
     grower: GrowerRead = Field(..., description="种植者信息")
@@ -0,0 +1,194 @@
+"""
+Two-tier cache for QR images rendered on demand.
+
+A bounded in-memory LRU sits in front of a size-capped directory shared by
+all workers on the host. Each worker keeps an index of the disk entries in
+least recently used order together with their total size, so writes and
+evictions never walk the directory on the request thread. The index is
+built, and after each eviction re-synced with files written by other
+workers, by scanning the directory (ordered by mtime, which every hit
+refreshes) in a background thread.
+"""
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# 磁盘淘汰时清理到上限的这一比例，避免每次写入都触发目录扫描
+EVICT_TO_RATIO = 0.9
+
+
+def image_cache_key(qr_code: str, box_size: int, border: int,
+                    image_format: str) -> str:
+    # 二维码文件名与内容一一对应且不可变，可直接作为缓存键，命中时无需查库
+    content = f"{qr_code}:{box_size}:{border}:{image_format}"
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+def _remove(paths: list[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class QRImageCache:
+
+    def __init__(self, directory: str, memory_bytes: int,
+                 disk_bytes: int) -> None:
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_used = 0
+        # 磁盘条目索引，按最近使用排序，值为文件大小；_disk_used 为其总和
+        self._disk: OrderedDict[str, int] = OrderedDict()
+        self._disk_used = 0
+        # 后台扫描进行中时记录被访问或写入的键，合并时以内存中的顺序为准
+        self._touched: Optional[set[str]] = None
+        self._scanned = False
+        self._scanner: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key[2:4], key)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            image = self._memory.get(key)
+            if image is not None:
+                self._memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return image
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                image = f.read()
+            # 刷新 mtime，作为磁盘层的最近使用时间
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        with self._lock:
+            self.stats["disk_hits"] += 1
+            self._touch(key, len(image))
+        self._remember(key, image)
+        return image
+
+    def put(self, key: str, image: bytes) -> None:
+        self._remember(key, image)
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(image)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"QR image disk cache write failed: {str(e)}")
+            return
+
+        with self._lock:
+            self._touch(key, len(image))
+            evicted = self._pop_oldest()
+            scan = not self._scanned or bool(evicted)
+            if scan:
+                scan = self._start_scan()
+        _remove(evicted)
+        if scan:
+            self._scanner = threading.Thread(target=self._rescan, daemon=True)
+            self._scanner.start()
+
+    def _touch(self, key: str, size: int) -> None:
+        # 调用方持有锁
+        self._disk_used += size - self._disk.pop(key, 0)
+        self._disk[key] = size
+        if self._touched is not None:
+            self._touched.add(key)
+
+    def _pop_oldest(self) -> list[str]:
+        # 调用方持有锁；超出上限时按最近最少使用清理到上限的 EVICT_TO_RATIO
+        if self._disk_used <= self.disk_bytes:
+            return []
+        target = self.disk_bytes * EVICT_TO_RATIO
+        paths = []
+        while self._disk and self._disk_used > target:
+            key, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            paths.append(self._path(key))
+        return paths
+
+    def _remember(self, key: str, image: bytes) -> None:
+        if len(image) > self.memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_used -= len(previous)
+            self._memory[key] = image
+            self._memory_used += len(image)
+            while self._memory_used > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_used -= len(evicted)
+
+    def _start_scan(self) -> bool:
+        # 调用方持有锁；同一时间只允许一个后台扫描
+        if self._touched is not None:
+            return False
+        self._touched = set()
+        return True
+
+    def _scan(self) -> list[tuple[float, str, int]]:
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, name, stat.st_size))
+        return entries
+
+    def _rescan(self) -> None:
+        """
+        Rebuild the disk index from the directory, which other workers also
+        write to, and evict if that puts it over budget. Runs in a
+        background thread.
+        """
+        try:
+            entries = self._scan()
+        except OSError as e:
+            logger.warning(f"QR image disk cache scan failed: {str(e)}")
+            entries = None
+        with self._lock:
+            touched, self._touched = self._touched or set(), None
+            if entries is not None:
+                self._scanned = True
+                index: OrderedDict[str, int] = OrderedDict(
+                    (key, size) for _, key, size in sorted(entries)
+                    if key not in touched)
+                # 扫描期间访问或写入的条目保持原有的最近使用顺序
+                for key, size in self._disk.items():
+                    if key in touched:
+                        index[key] = size
+                self._disk = index
+                self._disk_used = sum(index.values())
+            evicted = self._pop_oldest()
+        _remove(evicted)
+
+
+qr_image_cache = QRImageCache(settings.QR_IMAGE_CACHE_DIR,
+                              settings.QR_IMAGE_CACHE_BYTES,
+                              settings.QR_IMAGE_DISK_CACHE_BYTES)
@@ -0,0 +1,213 @@
+"""
+Vector and print-label output for QR codes, written straight from the
+module matrix instead of through a bitmap.
+
+``module_rects`` merges the dark modules into rectangles; SVG, ZPL and PDF
+all draw those rectangles, so the output size grows with the number of
+rectangles rather than with the print resolution. PDF sheets and ZIP
+archives of label images are produced as generators for streaming. Only
+the standard library is used, as this module is imported by the render
+workers.
+"""
+import zipfile
+import zlib
+from collections.abc import Iterable, Iterator
+from typing import Optional
+
+# 模块矩阵，True 为深色模块，已包含边框
+Matrix = list[list[bool]]
+# (x, y, 宽, 高)，单位为模块
+Rect = tuple[int, int, int, int]
+
+# A4 纸，单位为 pt（1/72 英寸）
+PAGE_WIDTH = 595.28
+PAGE_HEIGHT = 841.89
+MM = 72 / 25.4
+CAPTION_FONT_SIZE = 7
+
+
+def module_rects(matrix: Matrix) -> list[Rect]:
+    """
+    Cover the dark modules of ``matrix`` with rectangles: each row is split
+    into horizontal runs, and a run is extended downwards over the rows
+    below that have the same run.
+    """
+    rows = []
+    for row in matrix:
+        runs = set()
+        x = 0
+        width = len(row)
+        while x < width:
+            if row[x]:
+                start = x
+                while x < width and row[x]:
+                    x += 1
+                runs.add((start, x - start))
+            else:
+                x += 1
+        rows.append(runs)
+
+    rects = []
+    for y, runs in enumerate(rows):
+        for start, length in sorted(runs):
+            height = 1
+            while y + height < len(rows) and (start,
+                                              length) in rows[y + height]:
+                rows[y + height].remove((start, length))
+                height += 1
+            rects.append((start, y, length, height))
+    return rects
+
+
+def render_svg(matrix: Matrix, box_size: int) -> bytes:
+    # viewBox 以模块为单位，box_size 只决定默认显示尺寸
+    size = len(matrix)
+    path = "".join(f"M{x} {y}h{w}v{h}h-{w}z"
+                   for x, y, w, h in module_rects(matrix))
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" '
+            f'viewBox="0 0 {size} {size}" width="{size * box_size}" '
+            f'height="{size * box_size}" shape-rendering="crispEdges">'
+            f'<rect width="{size}" height="{size}" fill="#fff"/>'
+            f'<path d="{path}"/></svg>').encode()
+
+
+def render_zpl(matrix: Matrix, box_size: int) -> bytes:
+    """
+    One ZPL label drawing every rectangle as a filled ``^GB`` box;
+    ``box_size`` is in printer dots per module.
+    """
+    commands = ["^XA", "^LH0,0"]
+    for x, y, w, h in module_rects(matrix):
+        width, height = w * box_size, h * box_size
+        # 线宽取短边即为实心矩形
+        commands.append(f"^FO{x * box_size},{y * box_size}"
+                        f"^GB{width},{height},{min(width, height)},B^FS")
+    commands.append("^XZ")
+    return "\n".join(commands).encode()
+
+
+def _pdf_text(text: str) -> str:
+    # 标准字体仅支持 Latin-1，其余字符以 ? 代替
+    text = text.encode("latin-1", "replace").decode("latin-1")
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _label_stream(matrix: Matrix, x: float, y: float, size: float,
+                  caption: Optional[str]) -> str:
+    # (x, y) 为标签左上角；翻转 y 轴，使矩阵行号向下递增
+    scale = size / len(matrix)
+    parts = [f"q {scale:.4f} 0 0 {-scale:.4f} {x:.2f} {y:.2f} cm"]
+    parts.extend(f"{rx} {ry} {w} {h} re"
+                 for rx, ry, w, h in module_rects(matrix))
+    parts.append("f Q")
+    if caption:
+        parts.append(f"BT /F1 {CAPTION_FONT_SIZE} Tf {x:.2f} "
+                     f"{y - size - CAPTION_FONT_SIZE - 2:.2f} Td "
+                     f"({_pdf_text(caption)}) Tj ET")
+    return "\n".join(parts)
+
+
+def iter_pdf_sheets(labels: Iterable[tuple[Matrix, Optional[str]]],
+                    label_size: float = 40 * MM,
+                    margin: float = 10 * MM,
+                    gap: float = 5 * MM) -> Iterator[bytes]:
+    """
+    Lay ``(matrix, caption)`` labels out in a grid on A4 pages and yield
+    the PDF a page at a time, so a long sheet is never held in memory.
+
+    Sizes are in points (``MM`` converts from millimetres).
+    """
+    cell_height = label_size + CAPTION_FONT_SIZE + 4 + gap
+    columns = max(1, int((PAGE_WIDTH - 2 * margin + gap) // (label_size + gap)))
+    rows = max(1, int((PAGE_HEIGHT - 2 * margin + gap) // cell_height))
+    per_page = columns * rows
+
+    # 对象 1、2、3 固定为 Catalog、Pages 和字体，页面对象在其后依次编号
+    offsets: dict[int, int] = {}
+    position = 0
+    page_ids: list[int] = []
+
+    def write_object(number: int, body: bytes) -> bytes:
+        nonlocal position
+        offsets[number] = position
+        chunk = b"%d 0 obj\n" % number + body + b"\nendobj\n"
+        position += len(chunk)
+        return chunk
+
+    def write_page(streams: list[str]) -> bytes:
+        content_id = 4 + 2 * len(page_ids)
+        page_id = content_id + 1
+        page_ids.append(page_id)
+        data = zlib.compress("\n".join(streams).encode("latin-1"))
+        content = (b"<< /Length %d /Filter /FlateDecode >>\nstream\n" %
+                   len(data) + data + b"\nendstream")
+        page = (f"<< /Type /Page /Parent 2 0 R "
+                f"/MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+                f"/Resources << /Font << /F1 3 0 R >> >> "
+                f"/Contents {content_id} 0 R >>").encode()
+        return write_object(content_id, content) + write_object(page_id, page)
+
+    header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    position = len(header)
+    yield header + write_object(
+        3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    streams: list[str] = []
+    for matrix, caption in labels:
+        slot = len(streams)
+        column, row = slot % columns, slot // columns
+        streams.append(
+            _label_stream(matrix, margin + column * (label_size + gap),
+                          PAGE_HEIGHT - margin - row * cell_height,
+                          label_size, caption))
+        if len(streams) == per_page:
+            yield write_page(streams)
+            streams = []
+    if streams or not page_ids:
+        yield write_page(streams)
+
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    tail = write_object(
+        2, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode())
+    tail += write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+    count = max(offsets) + 1
+    xref = [b"xref\n0 %d\n" % count, b"0000000000 65535 f \n"]
+    xref.extend(b"%010d 00000 n \n" % offsets[number]
+                for number in range(1, count))
+    yield tail + b"".join(xref) + (
+        b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" %
+        (count, position))
+
+
+class _ChunkBuffer:
+    """Write-only stream for ``zipfile`` whose contents are drained after
+    each entry; it is not seekable, so entries use data descriptors."""
+
+    def __init__(self) -> None:
+        self._chunks: list[bytes] = []
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_zip(entries: Iterable[tuple[str, bytes]]) -> Iterator[bytes]:
+    """
+    Yield a ZIP archive of ``(name, data)`` entries an entry at a time;
+    only the current entry is held in memory.
+    """
+    buffer = _ChunkBuffer()
+    # PNG 已压缩，直接存储不再 deflate
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_STORED) as archive:
+        for name, data in entries:
+            archive.writestr(name, data)
+            yield buffer.drain()
+    yield buffer.drain()
@@ -0,0 +1,289 @@
+"""
+Render QR code images in a process pool, off the request path.
+
+Routes record the QR payloads and pick the filenames inside their
+transaction, then call ``submit`` once it has committed, so no database
+connection is held while images are drawn. Progress of each batch is kept in
+Redis so that any worker can answer ``get_status``.
+"""
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Optional
+
+import qrcode
+from redis import RedisError
+
+from app import qr_labels
+from app.core.config import settings
+from app.core.redis_conf import redis_client
+
+logger = logging.getLogger(__name__)
+
+RENDER_PREFIX = "qr_render"
+
+# (二维码内容, 文件名)
+RenderItem = tuple[str, str]
+
+# 参与文件名哈希的渲染参数；修改后生成新文件，而不是复用按旧参数生成的图片
+RENDER_PARAMS: dict[str, Any] = {
+    "error_correction": qrcode.constants.ERROR_CORRECT_L,
+    "box_size": 10,
+    "border": 4,
+}
+CONTENT_HASH = re.compile(r"_([0-9a-f]{32})\.png$")
+
+# 按需渲染支持的格式及其媒体类型
+IMAGE_FORMATS = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "svg": "image/svg+xml",
+    "zpl": "application/zpl",
+}
+# 经 PIL 栅格化的格式；其余格式直接由模块矩阵生成
+RASTER_FORMATS = {"png": "PNG", "jpeg": "JPEG"}
+
+_executor: Optional[ProcessPoolExecutor] = None
+# 多个请求线程可能同时首次提交任务，避免各自创建进程池
+_executor_lock = threading.Lock()
+
+
+def qr_code_filename(data, prefix: str = "qrcode") -> str:
+    """
+    Content-addressed filename for ``data``: the same data rendered with the
+    same ``RENDER_PARAMS`` always maps to the same file.
+    """
+    content = json.dumps([str(data), RENDER_PARAMS], sort_keys=True)
+    digest = hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+    return f"{prefix}_{digest}.png"
+
+
+def qr_code_subpath(filename: str) -> str:
+    """
+    Location of ``filename`` below its QR directory. Content-addressed files
+    are sharded two levels deep by hash (``ab/cd/<filename>``); names from
+    before the scheme stay at the top level.
+    """
+    match = CONTENT_HASH.search(filename)
+    if not match:
+        return filename
+    digest = match.group(1)
+    return f"{digest[:2]}/{digest[2:4]}/{filename}"
+
+
+def qr_code_label(filename: str) -> str:
+    """
+    Human-readable label for ``filename``: its prefix without the content
+    hash or extension, e.g. ``middleman_12_split_3``.
+    """
+    return os.path.splitext(CONTENT_HASH.sub("", filename))[0]
+
+
+def make_qr_image(data, *, error_correction: int, box_size: int,
+                  border: int) -> Any:
+    # Create QR code instance
+    qr = qrcode.QRCode(version=None,
+                       error_correction=error_correction,
+                       box_size=box_size,
+                       border=border)
+
+    # Add data
+    qr.add_data(str(data))
+    qr.make(fit=True)
+
+    # Create an image from the QR Code instance
+    return qr.make_image(fill_color="black", back_color="white")
+
+
+def make_qr_matrix(data, *, border: int) -> qr_labels.Matrix:
+    qr = qrcode.QRCode(version=None,
+                       error_correction=RENDER_PARAMS["error_correction"],
+                       border=border)
+    qr.add_data(str(data))
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def render_qr_image(data, *, box_size: int, border: int,
+                    image_format: str) -> bytes:
+    """
+    Render ``data`` in memory as one of ``IMAGE_FORMATS``, for serving
+    QR images on demand. ``box_size`` is in pixels, or printer dots for
+    ZPL, per module.
+    """
+    if image_format == "svg":
+        return qr_labels.render_svg(make_qr_matrix(data, border=border),
+                                    box_size)
+    if image_format == "zpl":
+        return qr_labels.render_zpl(make_qr_matrix(data, border=border),
+                                    box_size)
+    img = make_qr_image(data,
+                        error_correction=RENDER_PARAMS["error_correction"],
+                        box_size=box_size,
+                        border=border).get_image()
+    pil_format = RASTER_FORMATS[image_format]
+    if pil_format == "JPEG":
+        img = img.convert("L")
+    buffer = io.BytesIO()
+    img.save(buffer, format=pil_format)
+    return buffer.getvalue()
+
+
+def render_qr_code(data, filepath: str) -> None:
+    """
+    Render ``data`` as a QR code PNG at ``filepath``, unless an identical
+    render is already there.
+
+    Runs in the worker processes, so this module keeps its imports light.
+    """
+    if os.path.exists(filepath):
+        return
+    # Ensure the directory exists
+    os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+
+    img = make_qr_image(data, **RENDER_PARAMS)
+
+    # 先在同一目录写唯一的临时文件再原子替换，已存在即完整，可据此跳过重复渲染；
+    # 同一进程内的多个线程也不会写到同一个临时文件
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or ".",
+                                    suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            img.save(tmp_file)
+        # mkstemp 创建的文件仅属主可读，改回与普通文件一致的权限供静态服务读取
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn：不继承 Web 进程中的线程、连接池和锁
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.QR_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def _discard_executor(executor: ProcessPoolExecutor) -> None:
+    # 只丢弃调用方拿到的那个进程池，其他线程可能已经换上了新的
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+    executor.shutdown(wait=False)
+
+
+def _submit_render(data, filepath: str) -> Future:
+    executor = _get_executor()
+    try:
+        return executor.submit(render_qr_code, data, filepath)
+    except BrokenProcessPool:
+        # 有工作进程异常退出（OOM、PIL 崩溃等）后进程池永久不可用，换新的重试一次
+        logger.warning("QR render pool broken, starting a new one")
+        _discard_executor(executor)
+        return _get_executor().submit(render_qr_code, data, filepath)
+
+
+def _render_key(render_id: str) -> str:
+    return f"{RENDER_PREFIX}:{render_id}"
+
+
+def _record_result(key: str, future: Future) -> None:
+    error = future.exception()
+    if error:
+        logger.error(f"QR code render failed: {str(error)}")
+    try:
+        redis_client.hincrby(key, "failed" if error else "done", 1)
+    except RedisError as e:
+        logger.warning(f"QR render status update failed: {str(e)}")
+
+
+def submit(items: list[RenderItem], directory: str) -> Optional[str]:
+    """
+    Queue the images in ``items`` for rendering into ``directory`` and
+    return the id to poll with ``get_status``, or None when there is
+    nothing to render or images are only rendered on demand
+    (``QR_EAGER_RENDER`` off). Returns immediately.
+
+    A render pool broken by a crashed worker is replaced. Any other failure
+    to queue is logged and None is returned, as callers submit after their
+    transaction has committed.
+    """
+    if not items or not settings.QR_EAGER_RENDER:
+        return None
+    render_id = uuid.uuid4().hex
+    key = _render_key(render_id)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(key, mapping={"total": len(items), "done": 0, "failed": 0})
+        pipe.expire(key, settings.QR_RENDER_STATUS_TTL)
+        pipe.execute()
+    except RedisError as e:
+        logger.warning(f"QR render status write failed: {str(e)}")
+
+    try:
+        for data, filename in items:
+            future = _submit_render(
+                data, os.path.join(directory, qr_code_subpath(filename)))
+            future.add_done_callback(lambda f: _record_result(key, f))
+    except Exception as e:
+        # 调用方在提交事务之后才排队，失败不能影响已完成的写入；图片仍可按需生成
+        logger.error(f"QR render submit failed: {str(e)}")
+        return None
+    return render_id
+
+
+def get_status(render_id: str) -> Optional[dict[str, Any]]:
+    """
+    Progress counters of a render, None if unknown or expired. The status is
+    ``unknown`` when Redis cannot be reached.
+    """
+    try:
+        counts = redis_client.hgetall(_render_key(render_id))
+    except RedisError as e:
+        logger.warning(f"QR render status read failed: {str(e)}")
+        return {
+            "render_id": render_id,
+            "status": "unknown",
+            "total": 0,
+            "done": 0,
+            "failed": 0,
+        }
+    if not counts:
+        return None
+    total, done, failed = (int(counts.get(field, 0))
+                           for field in ("total", "done", "failed"))
+    if done + failed < total:
+        status = "pending"
+    else:
+        status = "failed" if failed else "done"
+    return {
+        "render_id": render_id,
+        "status": status,
+        "total": total,
+        "done": done,
+        "failed": failed,
+    }
+
+
+def shutdown() -> None:
+    # 等待已排队的图片生成完毕，避免退出时丢失
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
@@ -0,0 +1,1038 @@
+import io
+import json
+import os
+import threading
+import time
+import uuid
+import zipfile
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import Any
+
+from fastapi.testclient import TestClient
+from redis import RedisError
+from sqlalchemy import delete, event, update
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import qr_labels, qr_render
+from app.api import deps
+from app.api.pagination import encode_cursor
+from app.api.routes import transactions
+from app.api.routes.transactions import split_qr_payload
+from app.core import cache
+from app.core.config import settings
+from app.core.db import async_engine, engine
+from app.models import Plot, Product, QRCodePayload, SplitLot
+from app.qr_cache import QRImageCache, image_cache_key, qr_image_cache
+from app.qr_token import decode_qr_token
+from app.core.redis_conf import redis_client
+from app.main import app
+from app.utils import generate_qr_code
+from app.tests.utils.trac import create_middleman_purchase, create_random_grower
+
+
+def test_qr_code_info_traces_chain(client: TestClient, db: Session) -> None:
+    grower = create_random_grower(db)
+    product = grower.products[0]
+    first = create_middleman_purchase(client,
+                                      purchase_from_type="grower",
+                                      purchase_from_id=grower.id,
+                                      product=product.name,
+                                      quantity=100)
+    second = create_middleman_purchase(client,
+                                       purchase_from_type="middleman",
+                                       purchase_from_id=first["id"],
+                                       product=product.name,
+                                       quantity=40,
+                                       split_quantities=[10, 30])
+
+    qr_code = os.path.basename(second["qr_codes"][1])
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_code/{qr_code}")
+    assert r.status_code == 200
+    content = r.json()
+    assert content["code"] == 200
+    info = content["data"]["middleman_info"]
+    assert info["id"] == second["id"]
+    assert info["quantity"] == 30
+    assert info["split_index"] == 1
+    trace = content["data"]["trace_data"]
+    assert [(t["source_type"], t["id"]) for t in trace] == [
+        ("middleman", first["id"]),
+        ("grower", grower.id),
+    ]
+
+
+def test_qr_code_info_legacy_split_qr_code(client: TestClient,
+                                           db: Session) -> None:
+    grower = create_random_grower(db)
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=grower.products[0].name,
+                                          quantity=40,
+                                          split_quantities=[15, 25])
+    # 早于二维码内容表的拆分二维码没有对应记录
+    db.exec(
+        update(SplitLot).where(
+            SplitLot.middleman_id == middleman["id"]).values(
+                qr_payload_id=None))
+    db.exec(
+        delete(QRCodePayload).where(
+            QRCodePayload.middleman_id == middleman["id"]))
+    db.commit()
+
+    qr_code = os.path.basename(middleman["qr_codes"][1])
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_code/{qr_code}")
+    info = r.json()["data"]["middleman_info"]
+    assert info["id"] == middleman["id"]
+    assert info["quantity"] == 25
+    assert info["split_index"] == 1
+
+
+def test_qr_codes_rendered_after_commit(client: TestClient,
+                                        db: Session) -> None:
+    grower = create_random_grower(db)
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=grower.products[0].name,
+                                          quantity=30,
+                                          split_quantities=[10, 20])
+    qr_codes = middleman["qr_codes"] + [middleman["main_qr_code"]]
+    filenames = [os.path.basename(qr_code) for qr_code in qr_codes]
+    assert [filename.rsplit("_", 1)[0] for filename in filenames] == [
+        f"middleman_{middleman['id']}_split_0",
+        f"middleman_{middleman['id']}_split_1",
+        f"middleman_{middleman['id']}_main",
+    ]
+
+    url = f"{settings.API_V1_STR}/trac/qr_renders/{middleman['qr_render_id']}"
+    deadline = time.monotonic() + 60
+    while True:
+        status = client.get(url).json()["data"]
+        if status["status"] != "pending" or time.monotonic() > deadline:
+            break
+        time.sleep(0.1)
+    assert status == {
+        "render_id": middleman["qr_render_id"],
+        "status": "done",
+        "total": 3,
+        "done": 3,
+        "failed": 0,
+    }
+    for filename in filenames:
+        # 按内容哈希分两级目录存放
+        path = os.path.join("uploads/middleman_qrcodes",
+                            qr_render.qr_code_subpath(filename))
+        assert path.count("/") == 4
+        assert os.path.exists(path)
+
+    # 相同内容得到相同文件名，已存在的图片不会重新生成
+    path = os.path.join("uploads/middleman_qrcodes",
+                        qr_render.qr_code_subpath(filenames[0]))
+    mtime = os.stat(path).st_mtime_ns
+    assert generate_qr_code(
+        split_qr_payload(middleman["id"], 0),
+        prefix=f"middleman_{middleman['id']}_split_0",
+        directory="uploads/middleman_qrcodes") == (filenames[0], qr_codes[0])
+    assert os.stat(path).st_mtime_ns == mtime
+
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_renders/missing")
+    assert r.json()["code"] == 404
+
+
+def test_qr_render_replaces_broken_pool(tmp_path, monkeypatch) -> None:
+    class Pool:
+
+        def __init__(self, broken: bool) -> None:
+            self.broken = broken
+            self.submitted = []
+            self.shut_down = False
+
+        def submit(self, func: Any, *args: Any) -> Future:
+            if self.broken:
+                raise BrokenProcessPool("worker died")
+            self.submitted.append(args)
+            future = Future()
+            future.set_result(None)
+            return future
+
+        def shutdown(self, wait: bool) -> None:
+            self.shut_down = True
+
+    broken, fresh = Pool(True), Pool(False)
+    monkeypatch.setattr(qr_render, "_executor", broken)
+    monkeypatch.setattr(qr_render, "ProcessPoolExecutor",
+                        lambda **kwargs: fresh)
+    assert qr_render.submit([("a", "a.png"), ("b", "b.png")],
+                            str(tmp_path)) is not None
+    assert broken.shut_down
+    assert qr_render._executor is fresh
+    assert [data for data, _ in fresh.submitted] == ["a", "b"]
+
+
+def test_qr_render_submit_failure_after_commit(client: TestClient, db: Session,
+                                               monkeypatch) -> None:
+    grower = create_random_grower(db, total_yield=100)
+    product = grower.products[0]
+
+    def fail(*args: Any) -> Future:
+        raise RuntimeError("cannot start workers")
+
+    monkeypatch.setattr(qr_render, "_submit_render", fail)
+    # 采购已提交，排队失败只是不返回 qr_render_id
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=product.name,
+                                          quantity=10,
+                                          split_quantities=[4, 6])
+    assert middleman["qr_render_id"] is None
+    assert len(middleman["qr_codes"]) == 2
+    db.refresh(product)
+    assert product.remaining_yield == 90
+
+    r = client.post(
+        f"{settings.API_V1_STR}/trac/middlemen/{middleman['id']}"
+        "/lots/0/repackage",
+        json={"quantities": [1, 1]})
+    assert r.status_code == 200, r.text
+    assert r.json()["data"]["qr_render_id"] is None
+
+
+def test_qr_render_status_without_redis(client: TestClient,
+                                        monkeypatch) -> None:
+    class Unavailable:
+
+        def hgetall(self, key: str) -> None:
+            raise RedisError("connection refused")
+
+    monkeypatch.setattr(qr_render, "redis_client", Unavailable())
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_renders/abc")
+    assert r.status_code == 200
+    assert r.json()["data"]["status"] == "unknown"
+
+
+def test_qr_code_image_rendered_on_demand(client: TestClient, db: Session,
+                                          monkeypatch) -> None:
+    monkeypatch.setattr(settings, "QR_EAGER_RENDER", False)
+    grower = create_random_grower(db)
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=grower.products[0].name,
+                                          quantity=30,
+                                          split_quantities=[10, 20])
+    # 不预先生成图片，二维码地址指向按需渲染接口
+    assert middleman["qr_render_id"] is None
+    image_url = middleman["qr_codes"][0]
+    filename = image_url.split("/qr_code/")[1].rsplit("/", 1)[0]
+    assert image_url.endswith(f"/trac/qr_code/{filename}/image")
+    assert not os.path.exists(
+        os.path.join("uploads/middleman_qrcodes",
+                     qr_render.qr_code_subpath(filename)))
+
+    url = f"{settings.API_V1_STR}/trac/qr_code/{filename}/image"
+    params = {"size": 4, "border": 1, "format": "png"}
+    hits = qr_image_cache.stats["memory_hits"]
+    r = client.get(url, params=params)
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/png"
+    assert "immutable" in r.headers["cache-control"]
+    assert r.content == qr_render.render_qr_image(
+        split_qr_payload(middleman["id"], 0),
+        box_size=4,
+        border=1,
+        image_format="png")
+
+    # 同一参数再次请求命中内存缓存
+    assert client.get(url, params=params).content == r.content
+    assert qr_image_cache.stats["memory_hits"] == hits + 1
+
+    r = client.get(url, params={**params, "format": "jpeg"})
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "image/jpeg"
+
+    # 矢量和打印格式直接由模块矩阵生成
+    r = client.get(url, params={**params, "format": "svg"})
+    assert r.headers["content-type"] == "image/svg+xml"
+    assert r.content.startswith(b"<svg") and b"<path d=\"M" in r.content
+    r = client.get(url, params={**params, "format": "zpl"})
+    assert r.headers["content-type"] == "application/zpl"
+    assert r.content.startswith(b"^XA") and r.content.endswith(b"^XZ")
+
+    r = client.get(url, params={"format": "gif"})
+    assert r.status_code == 422
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_code/missing.png/image")
+    assert r.status_code == 404
+
+
+def test_render_qr_code_concurrent_threads(tmp_path) -> None:
+    # 同一进程内多个线程同时渲染同一文件，临时文件互不覆盖且不残留
+    path = str(tmp_path / "same.png")
+    barrier = threading.Barrier(8)
+
+    def render(_: int) -> None:
+        barrier.wait()
+        qr_render.render_qr_code("same", path)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(render, range(8)))
+    assert os.listdir(tmp_path) == ["same.png"]
+    with open(path, "rb") as f:
+        assert f.read() == qr_render.render_qr_image(
+            "same",
+            box_size=qr_render.RENDER_PARAMS["box_size"],
+            border=qr_render.RENDER_PARAMS["border"],
+            image_format="png")
+
+
+def test_get_executor_creates_one_pool(monkeypatch) -> None:
+    created = []
+    monkeypatch.setattr(qr_render, "_executor", None)
+    monkeypatch.setattr(
+        qr_render, "ProcessPoolExecutor",
+        lambda **kwargs: created.append(kwargs) or SimpleNamespace())
+    barrier = threading.Barrier(8)
+
+    def get(_: int) -> Any:
+        barrier.wait()
+        return qr_render._get_executor()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        assert len({id(pool) for pool in executor.map(get, range(8))}) == 1
+    assert len(created) == 1
+
+
+def test_qr_image_disk_cache_eviction(tmp_path, monkeypatch) -> None:
+    cache = QRImageCache(str(tmp_path), memory_bytes=0, disk_bytes=500)
+    keys = [image_cache_key(f"{i}.png", 10, 4, "png") for i in range(6)]
+    # 其他 worker 早先写入的条目，由首次写入触发的后台扫描纳入索引
+    other = cache._path(keys[5])
+    os.makedirs(os.path.dirname(other))
+    with open(other, "wb") as f:
+        f.write(b"o" * 100)
+    os.utime(other, (0, 0))
+    cache.put(keys[0], b"x" * 100)
+    cache._scanner.join()
+    assert cache._disk_used == 200
+
+    # 扫描完成后写入只更新索引，不再遍历目录
+    walks = []
+    walk = os.walk
+    monkeypatch.setattr(os, "walk",
+                        lambda directory: walks.append(directory) or walk(directory))
+    for key in keys[1:4]:
+        cache.put(key, b"x" * 100)
+    assert cache._disk_used == 500
+    assert walks == []
+    # 超出上限，按最近最少使用淘汰到 450 字节以下
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[4], b"x" * 100)
+    assert cache._disk_used == 400
+    assert not os.path.exists(other)
+    assert not os.path.exists(cache._path(keys[1]))
+    assert all(
+        os.path.exists(cache._path(key)) for key in [keys[0], *keys[2:5]])
+
+    # 淘汰后在后台重新扫描目录
+    cache._scanner.join()
+    assert walks == [str(tmp_path)]
+    assert cache._disk_used == 400
+
+
+def test_module_rects_cover_dark_modules() -> None:
+    matrix = qr_render.make_qr_matrix(split_qr_payload(1, 0), border=2)
+    covered = [[False] * len(row) for row in matrix]
+    rects = qr_labels.module_rects(matrix)
+    for x, y, w, h in rects:
+        for row in covered[y:y + h]:
+            assert not any(row[x:x + w])
+            row[x:x + w] = [True] * w
+    assert covered == matrix
+    assert len(rects) < sum(map(sum, matrix))
+
+
+def test_qr_label_sheet(client: TestClient, db: Session) -> None:
+    grower = create_random_grower(db)
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=grower.products[0].name,
+                                          quantity=30,
+                                          split_quantities=[10, 20])
+    qr_codes = [
+        os.path.basename(qr_code)
+        for qr_code in middleman["qr_codes"] + [middleman["main_qr_code"]]
+    ]
+    url = f"{settings.API_V1_STR}/trac/qr_labels/sheet"
+    r = client.post(url, json={"qr_codes": qr_codes})
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/pdf"
+    assert r.content.startswith(b"%PDF-1.4")
+    assert r.content.endswith(b"%%EOF\n")
+    assert b"/Count 1" in r.content
+
+    r = client.post(url, json={"qr_codes": qr_codes + ["missing.png"]})
+    assert r.status_code == 404
+
+
+def test_export_labels(client: TestClient, db: Session, monkeypatch) -> None:
+    monkeypatch.setattr(settings, "QR_EAGER_RENDER", False)
+    grower = create_random_grower(db)
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=grower.products[0].name,
+                                          quantity=30,
+                                          split_quantities=[10, 20])
+    prefix = f"middleman_{middleman['id']}"
+
+    # 图片未预先生成，导出时逐张渲染
+    url = f"{settings.API_V1_STR}/trac/middlemen/{middleman['id']}/labels"
+    r = client.get(url)
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/zip"
+    with zipfile.ZipFile(io.BytesIO(r.content)) as archive:
+        assert archive.namelist() == [
+            f"{prefix}_main.png", f"{prefix}_split_0.png",
+            f"{prefix}_split_1.png"
+        ]
+        assert archive.read(f"{prefix}_split_0.png") == (
+            qr_render.render_qr_image(split_qr_payload(middleman["id"], 0),
+                                      box_size=10,
+                                      border=4,
+                                      image_format="png"))
+
+    r = client.get(url, params={"format": "pdf"})
+    assert r.headers["content-type"] == "application/pdf"
+    assert b"/Count 1" in r.content
+
+    r = client.get(f"{settings.API_V1_STR}/trac/growers/{grower.id}/labels")
+    with zipfile.ZipFile(io.BytesIO(r.content)) as archive:
+        assert len(archive.namelist()) == 3
+        assert archive.namelist()[0] == f"{prefix}_main.png"
+
+    r = client.get(f"{settings.API_V1_STR}/trac/middlemen/0/labels")
+    assert r.status_code == 404
+
+
+def test_compact_qr_token_payloads(client: TestClient, db: Session,
+                                   monkeypatch) -> None:
+    monkeypatch.setattr(settings, "QR_PAYLOAD_FORMAT", "token")
+    grower = create_random_grower(db)
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=grower.products[0].name,
+                                          quantity=30,
+                                          split_quantities=[10, 20])
+    main, _, second = db.exec(
+        select(QRCodePayload.payload).where(
+            QRCodePayload.middleman_id == middleman["id"]).order_by(
+                QRCodePayload.split_index.nulls_first())).all()
+    assert decode_qr_token(main) == ("middleman", middleman["id"], None)
+    assert decode_qr_token(second) == ("middleman", middleman["id"], 1)
+    assert second.startswith(f"T/M{middleman['id']}.1.")
+    # 纯字母数字内容，二维码版本低于 JSON 内容
+    monkeypatch.setattr(settings, "QR_PAYLOAD_FORMAT", "json")
+    assert len(qr_render.make_qr_matrix(second, border=0)) < len(
+        qr_render.make_qr_matrix(split_qr_payload(middleman["id"], 1),
+                                 border=0))
+
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_token/{second}")
+    assert r.status_code == 200
+    assert r.json()["data"]["split_index"] == 1
+    assert r.json()["data"]["quantity"] == 20
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_token/{main}")
+    assert r.json()["data"]["middleman_id"] == middleman["id"]
+
+    tampered = second.replace(".1.", ".0.")
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_token/{tampered}")
+    assert r.status_code == 400
+
+
+def test_qr_code_info_not_found(client: TestClient) -> None:
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_code/missing.png")
+    assert r.status_code == 200
+    assert r.json()["code"] == 404
+
+
+def test_recall_product_streams_downstream_lots(client: TestClient,
+                                                db: Session) -> None:
+    grower = create_random_grower(db)
+    product = grower.products[0]
+    first = create_middleman_purchase(client,
+                                      purchase_from_type="grower",
+                                      purchase_from_id=grower.id,
+                                      product=product.name,
+                                      quantity=100)
+    second = create_middleman_purchase(client,
+                                       purchase_from_type="middleman",
+                                       purchase_from_id=first["id"],
+                                       product=product.name,
+                                       quantity=40,
+                                       split_quantities=[10, 30])
+
+    r = client.get(f"{settings.API_V1_STR}/trac/recall/products/{product.id}")
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/x-ndjson"
+    lots = [json.loads(line) for line in r.text.splitlines()]
+    assert [(lot["middleman_id"], lot["depth"]) for lot in lots] == [
+        (first["id"], 1),
+        (second["id"], 2),
+    ]
+    assert lots[1]["split_quantities"] == [10, 30]
+    assert lots[1]["purchased_quantity"] == 40
+
+    r = client.get(f"{settings.API_V1_STR}/trac/recall/growers/{grower.id}")
+    assert len(r.text.splitlines()) == 2
+
+
+def test_qr_code_info_cache_invalidated_by_upstream_purchase(
+        client: TestClient, db: Session) -> None:
+    grower = create_random_grower(db)
+    product = grower.products[0]
+    first = create_middleman_purchase(client,
+                                      purchase_from_type="grower",
+                                      purchase_from_id=grower.id,
+                                      product=product.name,
+                                      quantity=100)
+    second = create_middleman_purchase(client,
+                                       purchase_from_type="middleman",
+                                       purchase_from_id=first["id"],
+                                       product=product.name,
+                                       quantity=40)
+    qr_code = os.path.basename(second["qr_codes"][0])
+    cache_key = cache.trace_key("qr_code", qr_code)
+
+    url = f"{settings.API_V1_STR}/trac/qr_code/{qr_code}"
+    r = client.get(url)
+    hits = cache.get_stats()["hits"]
+    assert client.get(url).json() == r.json()
+    assert cache.get_stats()["hits"] == hits + 1
+    assert redis_client.exists(cache_key)
+
+    # 上游中间商卖出新批次后，其下游的溯源缓存应被清除
+    create_middleman_purchase(client,
+                              purchase_from_type="middleman",
+                              purchase_from_id=first["id"],
+                              product=product.name,
+                              quantity=10)
+    assert not redis_client.exists(cache_key)
+
+
+def test_replica_reads_not_cached(client: TestClient, db: Session) -> None:
+    grower = create_random_grower(db)
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=grower.products[0].name,
+                                          quantity=10,
+                                          split_quantities=[4, 6])
+    # 指向同一数据库的另一个引擎充当副本
+    replica = create_async_engine(str(settings.SQLALCHEMY_DATABASE_URI))
+
+    async def read_replica() -> AsyncIterator[AsyncSession]:
+        async with AsyncSession(replica, expire_on_commit=False) as session:
+            yield session
+
+    requests = [
+        ("info", {"middleman_id": middleman["id"]},
+         cache.trace_key("info", middleman["id"])),
+        ("split-info", {"middleman_id": middleman["id"], "split_index": 1},
+         cache.trace_key("split_info", middleman["id"], 1)),
+    ]
+    app.dependency_overrides[deps.get_async_read_db] = read_replica
+    try:
+        for path, body, key in requests:
+            r = client.post(f"{settings.API_V1_STR}/trac/api/middleman/{path}",
+                            json=body)
+            assert r.status_code == 200, r.text
+            assert not redis_client.exists(key)
+    finally:
+        del app.dependency_overrides[deps.get_async_read_db]
+        replica.sync_engine.dispose()
+
+    # 主库读取的结果照常缓存
+    for path, body, key in requests:
+        client.post(f"{settings.API_V1_STR}/trac/api/middleman/{path}",
+                    json=body)
+        assert redis_client.exists(key)
+
+
+def test_trace_cache_skips_stale_write_back() -> None:
+    key = cache.trace_key("test", uuid.uuid4().hex)
+    node = ("middleman", 10**9)
+    cached, generation = cache.get_trace(key)
+    assert cached is None
+
+    # 读取数据库期间该节点被写入并失效，之前查到的响应不应写回缓存
+    cache.invalidate_nodes([node])
+    cache.set_trace(key, {"stale": True}, [node], generation=generation)
+    assert not redis_client.exists(key)
+
+    cached, generation = cache.get_trace(key)
+    cache.set_trace(key, {"stale": False}, [node], generation=generation)
+    assert cache.get_trace(key).value == {"stale": False}
+    cache.invalidate_nodes([node])
+    assert not redis_client.exists(key)
+
+
+def test_trace_cache_stats_without_redis(monkeypatch) -> None:
+    class Unavailable:
+
+        def mget(self, *keys: str) -> None:
+            raise RedisError("connection refused")
+
+    monkeypatch.setattr(cache, "redis_client", Unavailable())
+    assert cache.get_stats() == {
+        "available": False,
+        "hits": 0,
+        "misses": 0,
+        "hit_ratio": 0.0,
+    }
+
+
+def test_middleman_batch_info(client: TestClient, db: Session) -> None:
+    grower = create_random_grower(db)
+    product = grower.products[0]
+    first = create_middleman_purchase(client,
+                                      purchase_from_type="grower",
+                                      purchase_from_id=grower.id,
+                                      product=product.name,
+                                      quantity=100)
+    lots = [
+        create_middleman_purchase(client,
+                                  purchase_from_type="middleman",
+                                  purchase_from_id=first["id"],
+                                  product=product.name,
+                                  quantity=20,
+                                  split_quantities=[5, 15]) for _ in range(3)
+    ]
+    items = [{
+        "middleman_id": lot["id"],
+        "split_index": 1
+    } for lot in lots]
+    items.append({"middleman_id": lots[0]["id"], "split_index": 9})
+
+    r = client.post(f"{settings.API_V1_STR}/trac/api/middleman/batch-info",
+                    json={"items": items})
+    assert r.status_code == 200
+    content = r.json()
+    assert content["count"] == 3
+    assert [d["quantity"] for d in content["data"]] == [15, 15, 15]
+    assert content["missing"] == [items[-1]]
+    # 共享的上游只返回一次
+    grower_key = f"grower:{grower.id}:{product.name}"
+    assert set(content["nodes"]) == {f"middleman:{first['id']}", grower_key}
+    assert content["data"][0]["trace"] == [
+        {"node": f"middleman:{first['id']}", "quantity": 20},
+        {"node": grower_key, "quantity": 100},
+    ]
+
+    # 同一种植者的另一种产品是不同的节点，各条目的产品互不覆盖
+    plot = Plot(location_coordinates="0,0", grower_id=grower.id)
+    db.add(plot)
+    db.flush()
+    other = Product(name=f"{product.name}_pear",
+                    crop_type="pear",
+                    total_yield=10,
+                    remaining_yield=10,
+                    plot_id=plot.id,
+                    grower_id=grower.id)
+    db.add(other)
+    db.commit()
+    pear = create_middleman_purchase(client,
+                                     purchase_from_type="grower",
+                                     purchase_from_id=grower.id,
+                                     product=other.name,
+                                     quantity=5)
+    r = client.post(f"{settings.API_V1_STR}/trac/api/middleman/batch-info",
+                    json={
+                        "items": [{
+                            "middleman_id": first["id"]
+                        }, {
+                            "middleman_id": pear["id"]
+                        }]
+                    })
+    content = r.json()
+    traces = [d["trace"] for d in content["data"]]
+    assert traces == [[{
+        "node": grower_key,
+        "quantity": 100
+    }], [{
+        "node": f"grower:{grower.id}:{other.name}",
+        "quantity": 5
+    }]]
+    assert [content["nodes"][trace[0]["node"]]["product"]
+            for trace in traces] == [product.name, other.name]
+
+
+def test_create_middleman_insufficient_yield(client: TestClient,
+                                             db: Session) -> None:
+    grower = create_random_grower(db, total_yield=50)
+    data = {
+        "phone_number": "13900000000",
+        "middleman_type": "individual",
+        "purchase_from_type": "grower",
+        "purchase_from_id": grower.id,
+        "purchased_product": grower.products[0].name,
+        "purchased_quantity": 60,
+    }
+    r = client.post(f"{settings.API_V1_STR}/trac/middlemen/", json=data)
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Insufficient remaining yield from grower"
+    db.refresh(grower.products[0])
+    assert grower.products[0].remaining_yield == 50
+
+
+def test_purchase_draws_from_split_lot(client: TestClient,
+                                       db: Session) -> None:
+    grower = create_random_grower(db)
+    seller = create_middleman_purchase(client,
+                                       purchase_from_type="grower",
+                                       purchase_from_id=grower.id,
+                                       product=grower.products[0].name,
+                                       quantity=100,
+                                       split_quantities=[30, 70])
+    create_middleman_purchase(client,
+                              purchase_from_type="middleman",
+                              purchase_from_id=seller["id"],
+                              product=grower.products[0].name,
+                              quantity=20,
+                              purchase_from_split_index=0)
+
+    data = {
+        "name": "overdraw",
+        "phone_number": "13900000000",
+        "middleman_type": "individual",
+        "purchase_from_type": "middleman",
+        "purchase_from_id": seller["id"],
+        "purchased_product": grower.products[0].name,
+        "purchased_quantity": 20,
+        "purchase_from_split_index": 0,
+    }
+    r = client.post(f"{settings.API_V1_STR}/trac/middlemen/", json=data)
+    assert r.status_code == 400
+    assert r.json()["detail"] == "Insufficient remaining quantity in split lot"
+
+    r = client.post(f"{settings.API_V1_STR}/trac/api/middleman/split-info",
+                    json={
+                        "middleman_id": seller["id"],
+                        "split_index": 0
+                    })
+    info = r.json()["data"]
+    assert (info["quantity"], info["remaining"]) == (30, 10)
+    r = client.get(f"{settings.API_V1_STR}/trac/middlemen/{seller['id']}")
+    assert r.json()["data"]["remaining_quantity"] == 80
+
+
+def test_create_middlemen_bulk_partial_failure(client: TestClient,
+                                              db: Session) -> None:
+    grower = create_random_grower(db, total_yield=100)
+    product = grower.products[0]
+    seller = create_middleman_purchase(client,
+                                       purchase_from_type="grower",
+                                       purchase_from_id=grower.id,
+                                       product=product.name,
+                                       quantity=50)
+
+    def item(**kwargs: object) -> dict[str, object]:
+        return {
+            "phone_number": "13900000000",
+            "middleman_type": "individual",
+            "purchased_product": product.name,
+            **kwargs
+        }
+
+    items = [
+        item(purchase_from_type="grower",
+             purchase_from_id=grower.id,
+             purchased_quantity=20,
+             split_quantities=[5, 15]),
+        item(purchase_from_type="middleman",
+             purchase_from_id=seller["id"],
+             purchased_quantity=30),
+        item(purchase_from_type="grower",
+             purchase_from_id=grower.id,
+             purchased_quantity=10,
+             split_quantities=[3, 3]),
+        item(purchase_from_type="middleman",
+             purchase_from_id=0,
+             purchased_quantity=1),
+        item(purchase_from_type="grower",
+             purchase_from_id=grower.id,
+             purchased_product="missing",
+             purchased_quantity=1),
+    ]
+    r = client.post(f"{settings.API_V1_STR}/trac/middlemen/bulk",
+                    json={"items": items})
+    assert r.status_code == 200, r.text
+    data = r.json()["data"]
+    assert data["created"] == 2
+    assert data["failed"] == 3
+    results = data["results"]
+    assert [result["success"] for result in results] == [
+        True, True, False, False, False
+    ]
+    assert results[2]["error"] == (
+        "Sum of split quantities must equal purchased quantity")
+    assert results[3]["error"] == "Seller middleman not found"
+    assert results[4]["error"] == "Product not found for this grower"
+    assert len(results[0]["qr_codes"]) == 2
+    assert results[0]["main_qr_code"]
+    assert results[1]["middleman"]["remaining_quantity"] == 30
+
+    db.refresh(product)
+    assert product.remaining_yield == 30
+
+    # 汇总数量超过卖方剩余时，该来源的所有条目都失败且不扣减库存
+    r = client.post(f"{settings.API_V1_STR}/trac/middlemen/bulk",
+                    json={
+                        "items": [
+                            item(purchase_from_type="middleman",
+                                 purchase_from_id=seller["id"],
+                                 purchased_quantity=15)
+                        ] * 2
+                    })
+    data = r.json()["data"]
+    assert data["created"] == 0
+    assert {result["error"] for result in data["results"]} == {
+        "Insufficient remaining quantity from seller middleman"
+    }
+
+
+def test_create_middlemen_bulk_qr_failure(client: TestClient, db: Session,
+                                          monkeypatch) -> None:
+    grower = create_random_grower(db, total_yield=100)
+    product = grower.products[0]
+
+    def fail(*args: Any) -> str:
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(transactions, "generate_main_qr_code", fail)
+    r = client.post(f"{settings.API_V1_STR}/trac/middlemen/bulk",
+                    json={
+                        "items": [{
+                            "phone_number": "13900000000",
+                            "middleman_type": "individual",
+                            "purchased_product": product.name,
+                            "purchase_from_type": "grower",
+                            "purchase_from_id": grower.id,
+                            "purchased_quantity": 10,
+                            "split_quantities": [4, 6],
+                        }]
+                    })
+    assert r.status_code == 200, r.text
+    data = r.json()["data"]
+    # 采购已提交，二维码失败只在顶层报告
+    assert data["created"] == 1
+    assert data["qr_error"] == "QR code generation failed: disk full"
+    assert data["qr_render_id"] is None
+    result = data["results"][0]
+    assert result["success"] is True
+    assert result["error"] is None
+    assert result["qr_codes"] == []
+    assert result["main_qr_code"] is None
+    assert result["middleman"]["split_qr_codes"] == []
+    db.refresh(product)
+    assert product.remaining_yield == 90
+
+
+def test_create_middlemen_bulk_loads_split_lots_once(client: TestClient,
+                                                     db: Session) -> None:
+    grower = create_random_grower(db, total_yield=100)
+    product = grower.products[0]
+    items = [{
+        "phone_number": "13900000000",
+        "middleman_type": "individual",
+        "purchased_product": product.name,
+        "purchase_from_type": "grower",
+        "purchase_from_id": grower.id,
+        "purchased_quantity": 10,
+        "split_quantities": [4, 6],
+    }] * 3
+    lot_selects = []
+
+    def before_execute(conn: Any, cursor: Any, statement: str, *args: Any) -> None:
+        if statement.startswith("SELECT") and "FROM splitlot" in statement:
+            lot_selects.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_execute)
+    try:
+        r = client.post(f"{settings.API_V1_STR}/trac/middlemen/bulk",
+                        json={"items": items})
+    finally:
+        event.remove(engine, "before_cursor_execute", before_execute)
+    assert r.status_code == 200, r.text
+    results = r.json()["data"]["results"]
+    assert [len(result["qr_codes"]) for result in results] == [2, 2, 2]
+    assert len(lot_selects) == 1
+
+
+def test_pool_stats(client: TestClient,
+                    superuser_token_headers: dict[str, str]) -> None:
+    # 先经过一次异步路由，保证两个连接池都有借出记录
+    client.get(f"{settings.API_V1_STR}/trac/middlemen/0")
+    r = client.get(f"{settings.API_V1_STR}/trac/stats/pool",
+                   headers=superuser_token_headers)
+    assert r.status_code == 200
+    data = r.json()["data"]
+    assert data["pid"] == os.getpid()
+    for pool in ("sync", "async"):
+        stats = data[pool]
+        assert stats["size"] == settings.DB_POOL_SIZE
+        assert stats["checkouts"] >= 1
+        assert stats["timeouts"] == 0
+        assert stats["wait_p99_ms"] >= stats["wait_p50_ms"] >= 0
+
+
+def test_list_middlemen_cursor_pagination(client: TestClient,
+                                          db: Session) -> None:
+    grower = create_random_grower(db)
+    for _ in range(3):
+        create_middleman_purchase(client,
+                                  purchase_from_type="grower",
+                                  purchase_from_id=grower.id,
+                                  product=grower.products[0].name,
+                                  quantity=1)
+
+    r = client.get(f"{settings.API_V1_STR}/trac/middlemen/",
+                   params={"limit": 1000})
+    all_ids = [m["id"] for m in r.json()["data"]]
+
+    ids: list[int] = []
+    cursor = None
+    while True:
+        params = {"limit": 2, **({"cursor": cursor} if cursor else {})}
+        r = client.get(f"{settings.API_V1_STR}/trac/middlemen/",
+                       params=params)
+        assert r.status_code == 200
+        content = r.json()
+        ids += [m["id"] for m in content["data"]]
+        cursor = content["next_cursor"]
+        if not cursor or len(ids) >= len(all_ids):
+            break
+    assert ids == sorted(ids)
+    assert ids == all_ids[:len(ids)]
+
+    r = client.get(f"{settings.API_V1_STR}/trac/middlemen/",
+                   params={"cursor": "not-a-cursor"})
+    assert r.status_code == 400
+
+
+@contextmanager
+def count_queries(bind: Any = None) -> Iterator[dict[str, int]]:
+    bind = bind or async_engine.sync_engine
+    counts = {"statements": 0, "rows": 0}
+
+    def after_execute(conn: Any, cursor: Any, *args: Any) -> None:
+        counts["statements"] += 1
+        counts["rows"] += max(cursor.rowcount, 0)
+
+    event.listen(bind, "after_cursor_execute", after_execute)
+    try:
+        yield counts
+    finally:
+        event.remove(bind, "after_cursor_execute", after_execute)
+
+
+def test_grower_readers_do_not_multiply_rows(client: TestClient,
+                                             db: Session) -> None:
+    grower = create_random_grower(db)
+    plot_id = grower.plots[0].id
+    db.add_all(
+        Plot(location_coordinates=f"{i},{i}", grower_id=grower.id)
+        for i in range(49))
+    db.add_all(
+        Product(name=f"product_{i}",
+                crop_type="apple",
+                total_yield=10,
+                remaining_yield=10,
+                plot_id=plot_id,
+                grower_id=grower.id) for i in range(49))
+    db.commit()
+
+    with count_queries() as counts:
+        r = client.get(f"{settings.API_V1_STR}/trac/growers/{grower.id}")
+    data = r.json()["data"]
+    assert len(data["plots"]) == 50
+    assert len(data["products"]) == 50
+    # 种植者 1 行 + 地块 50 行 + 产品 50 行，而非 50 × 50
+    assert counts == {"statements": 3, "rows": 101}
+
+    with count_queries() as counts:
+        r = client.get(f"{settings.API_V1_STR}/trac/growers/",
+                       params={
+                           "limit": 1,
+                           "cursor": encode_cursor(grower.id - 1)
+                       })
+    data = r.json()["data"]
+    assert [g["id"] for g in data] == [grower.id]
+    assert len(data[0]["plots"]) == 50
+    assert len(data[0]["products"]) == 50
+    assert "user_id" not in data[0]
+    assert counts == {"statements": 3, "rows": 101}
+
+
+def test_repackage_split_lot(client: TestClient, db: Session) -> None:
+    grower = create_random_grower(db)
+    middleman = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=grower.products[0].name,
+                                          quantity=500,
+                                          split_quantities=[100, 400])
+    url = (f"{settings.API_V1_STR}/trac/middlemen/{middleman['id']}"
+           "/lots/{}/repackage")
+
+    statements = []
+    for split_index, children in ((0, 5), (1, 50)):
+        with count_queries(engine) as counts:
+            r = client.post(url.format(split_index),
+                            json={"quantities": [2] * children})
+        assert r.status_code == 200, r.text
+        statements.append(counts["statements"])
+    # 语句数与子批次数量无关
+    assert statements[0] == statements[1]
+
+    lots = r.json()["data"]["lots"]
+    assert len(lots) == 50
+    assert lots[0]["split_index"] == 7
+    # 子批次可以继续重新拆分
+    r = client.post(url.format(lots[0]["split_index"]),
+                    json={"quantities": [1, 1]})
+    assert [lot["parent_lot_id"] for lot in r.json()["data"]["lots"]
+            ] == [lots[0]["id"]] * 2
+    r = client.post(url.format(1), json={"quantities": [400]})
+    assert r.status_code == 400
+
+    r = client.get(
+        f"{settings.API_V1_STR}/trac/middlemen/{middleman['id']}/lots")
+    by_index = {lot["split_index"]: lot for lot in r.json()["data"]}
+    assert len(by_index) == 2 + 5 + 50 + 2
+    assert by_index[0]["remaining"] == 90
+    assert by_index[1]["remaining"] == 300
+    assert by_index[7]["remaining"] == 0
+    assert by_index[2]["parent_lot_id"] == by_index[0]["id"]
+
+    qr_code = os.path.basename(by_index[58]["qr_code"])
+    r = client.get(f"{settings.API_V1_STR}/trac/qr_code/{qr_code}")
+    info = r.json()["data"]["middleman_info"]
+    assert (info["split_index"], info["quantity"]) == (58, 1)
+
+    # 中间商的拆分数组与批次表保持一致
+    r = client.get(f"{settings.API_V1_STR}/trac/middlemen/{middleman['id']}")
+    detail = r.json()["data"]
+    assert detail["split_quantities"] == [
+        by_index[i]["quantity"] for i in sorted(by_index)
+    ]
+    assert detail["split_qr_codes"] == [
+        by_index[i]["qr_code"] for i in sorted(by_index)
+    ]
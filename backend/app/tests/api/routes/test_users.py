@@ -166,6 +166,29 @@ def test_retrieve_users(
         assert "email" in item
 
 
+def test_retrieve_users_count_first_page_only(
+    client: TestClient, superuser_token_headers: dict[str, str], db: Session
+) -> None:
+    for _ in range(2):
+        user_in = UserCreate(phone=random_lower_string()[:11],
+                             password=random_lower_string())
+        crud.create_user(session=db, user_create=user_in)
+
+    r = client.get(f"{settings.API_V1_STR}/users/",
+                   headers=superuser_token_headers,
+                   params={"limit": 1})
+    first = r.json()
+    assert first["count"] > 1
+    assert first["next_cursor"]
+
+    r = client.get(f"{settings.API_V1_STR}/users/",
+                   headers=superuser_token_headers,
+                   params={"limit": 1, "cursor": first["next_cursor"]})
+    second = r.json()
+    assert second["count"] is None
+    assert second["data"][0]["id"] > first["data"][0]["id"]
+
+
 def test_update_user_me(
     client: TestClient, normal_user_token_headers: dict[str, str], db: Session
 ) -> None:
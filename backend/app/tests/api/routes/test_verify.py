@@ -0,0 +1,40 @@
+import asyncio
+
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.api.routes import verify
+from app.api.routes.transactions import grower_qr_payload
+from app.core.config import settings
+from app.core.db import async_engine
+from app.models import Grower, QRCodePayload
+from app.qr_token import decode_qr_token
+from app.utils import qr_code_filename_from_url
+
+
+def create_company_grower() -> Grower:
+    async def create() -> Grower:
+        async with AsyncSession(async_engine,
+                                expire_on_commit=False) as session:
+            grower = await verify.create_company_grower(
+                session, {
+                    "phone_number": "13800000000",
+                    "grower_type": "company"
+                }, {}, "temp")
+        # 连接绑定在本次事件循环上，结束前释放
+        await async_engine.dispose()
+        return grower
+
+    return asyncio.run(create())
+
+
+def test_company_grower_qr_payload(db: Session, monkeypatch) -> None:
+    # 企业种植主的二维码内容与个人种植主一致，并遵循 QR_PAYLOAD_FORMAT
+    monkeypatch.setattr(settings, "QR_PAYLOAD_FORMAT", "token")
+    grower = create_company_grower()
+    qr_code = qr_code_filename_from_url(grower.qr_code)
+    payload = db.exec(
+        select(QRCodePayload).where(QRCodePayload.qr_code == qr_code)).one()
+    assert payload.payload == grower_qr_payload(grower.id)
+    assert decode_qr_token(payload.payload).node_id == grower.id
+    assert payload.source_type == "grower"
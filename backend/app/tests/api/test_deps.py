@@ -0,0 +1,161 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import Depends, FastAPI, Request
+from fastapi.routing import APIRoute
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import create_engine
+
+from app.api import deps
+from app.core.config import settings
+from app.core.db import async_engine, engine
+from app.main import app, read_your_writes
+
+
+class FakeReplicaHealth:
+    def __init__(self, healthy: bool, stale: bool = False) -> None:
+        self.healthy = healthy
+        self.stale = stale
+        self.checks = 0
+
+    def is_stale(self) -> bool:
+        return self.stale
+
+    def is_healthy(self) -> bool:
+        return self.healthy
+
+    def check(self) -> bool:
+        self.checks += 1
+        self.stale = False
+        return self.healthy
+
+
+def make_request(cookie: str | None = None) -> Request:
+    headers = []
+    if cookie is not None:
+        headers.append((b"cookie",
+                        f"{deps.READ_PRIMARY_COOKIE}={cookie}".encode()))
+    return Request({"type": "http", "headers": headers})
+
+
+def read_bind(cookie: str | None = None) -> object:
+    sessions = deps.get_read_db(make_request(cookie))
+    bind = next(sessions).bind
+    sessions.close()
+    return bind
+
+
+def async_read_bind(cookie: str | None = None) -> object:
+    async def resolve() -> object:
+        sessions = deps.get_async_read_db(make_request(cookie))
+        bind = (await sessions.__anext__()).bind
+        await sessions.aclose()
+        return bind
+
+    return asyncio.run(resolve())
+
+
+@pytest.fixture
+def replica(monkeypatch: pytest.MonkeyPatch) -> object:
+    replica = create_engine("sqlite://")
+    monkeypatch.setattr(deps, "replica_engine", replica)
+    monkeypatch.setattr(deps, "replica_health", FakeReplicaHealth(True))
+    return replica
+
+
+@pytest.fixture
+def async_replica(replica: object, monkeypatch: pytest.MonkeyPatch) -> object:
+    # 引擎在首次使用时才建立连接，这里只比较会话绑定的对象
+    async_replica = create_async_engine(str(settings.SQLALCHEMY_DATABASE_URI))
+    monkeypatch.setattr(deps, "async_replica_engine", async_replica)
+    return async_replica
+
+
+def test_read_db_without_replica_uses_primary(
+        monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(deps, "replica_health", None)
+    assert read_bind() is engine
+    assert async_read_bind() is async_engine
+
+
+def test_read_db_routes_to_healthy_replica(replica: object) -> None:
+    assert read_bind() is replica
+    # 读己之写窗口已过期
+    assert read_bind(f"{time.time() - 1:.3f}") is replica
+    assert read_bind("garbage") is replica
+
+
+def test_read_db_read_your_writes_window(replica: object) -> None:
+    assert read_bind(f"{time.time() + 10:.3f}") is engine
+
+
+def test_read_db_falls_back_when_replica_unhealthy(
+        replica: object, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(deps, "replica_health", FakeReplicaHealth(False))
+    assert read_bind() is engine
+
+
+def test_async_read_db_routes_to_healthy_replica(
+        async_replica: object) -> None:
+    assert async_read_bind() is async_replica
+    assert async_read_bind(f"{time.time() - 1:.3f}") is async_replica
+    assert async_read_bind("garbage") is async_replica
+
+
+def test_async_read_db_read_your_writes_window(async_replica: object) -> None:
+    assert async_read_bind(f"{time.time() + 10:.3f}") is async_engine
+
+
+def test_async_read_db_falls_back_when_replica_unhealthy(
+        async_replica: object, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(deps, "replica_health", FakeReplicaHealth(False))
+    assert async_read_bind() is async_engine
+
+
+def test_async_read_db_rechecks_stale_health(
+        async_replica: object, monkeypatch: pytest.MonkeyPatch) -> None:
+    health = FakeReplicaHealth(True, stale=True)
+    monkeypatch.setattr(deps, "replica_health", health)
+    assert async_read_bind() is async_replica
+    assert health.checks == 1
+
+    # 缓存结果过期后重新检查，发现副本已不健康则回退主库
+    health.healthy = False
+    health.stale = True
+    assert async_read_bind() is async_engine
+    assert health.checks == 2
+
+
+def test_read_only_posts_do_not_open_read_your_writes_window() -> None:
+    probe = FastAPI()
+    probe.middleware("http")(read_your_writes)
+
+    @probe.post("/write")
+    def write() -> None:
+        pass
+
+    @probe.post("/scan", dependencies=[Depends(deps.read_only)])
+    def scan() -> None:
+        pass
+
+    with TestClient(probe) as client:
+        assert deps.READ_PRIMARY_COOKIE in client.post("/write").cookies
+        assert deps.READ_PRIMARY_COOKIE not in client.post("/scan").cookies
+
+
+def test_scan_routes_are_read_only() -> None:
+    read_only = {
+        route.path
+        for route in app.routes if isinstance(route, APIRoute) and any(
+            dependency.call is deps.read_only
+            for dependency in route.dependant.dependencies)
+    }
+    prefix = f"{settings.API_V1_STR}/trac"
+    assert read_only == {
+        f"{prefix}/api/middleman/info",
+        f"{prefix}/api/middleman/split-info",
+        f"{prefix}/api/middleman/batch-info",
+        f"{prefix}/qr_labels/sheet",
+    }
@@ -0,0 +1,136 @@
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import text, update
+from sqlmodel import Session
+
+from app import crud
+from app.core.db import engine
+from app.models import InventoryMovement, Product
+from app.tests.utils.trac import create_random_grower
+
+
+def buy(product_id: int,
+        quantity: float,
+        barrier: threading.Barrier | None = None) -> bool:
+    if barrier:
+        barrier.wait()
+    with Session(engine) as session:
+        remaining = crud.decrement_product_yield(session=session,
+                                                 product_id=product_id,
+                                                 quantity=quantity)
+        session.commit()
+        return remaining is not None
+
+
+@pytest.mark.parametrize("buyers", [1, 10, 50])
+def test_concurrent_purchases_never_oversell(db: Session, buyers: int) -> None:
+    grower = create_random_grower(db, total_yield=100)
+    product_id = grower.products[0].id
+
+    with ThreadPoolExecutor(max_workers=min(buyers, 10)) as executor:
+        results = list(executor.map(lambda _: buy(product_id, 7), range(buyers)))
+
+    product = db.get(Product, product_id)
+    db.refresh(product)
+    assert sum(results) == min(buyers, 100 // 7)
+    assert product.remaining_yield == 100 - 7 * sum(results)
+    assert product.remaining_yield >= 0
+
+
+def test_concurrent_purchases_no_lost_updates(db: Session) -> None:
+    buyers = 20
+    grower = create_random_grower(db, total_yield=100)
+    product_id = grower.products[0].id
+
+    # 所有买家同时开始，读改写方式会在此丢失更新
+    barrier = threading.Barrier(buyers)
+    with ThreadPoolExecutor(max_workers=buyers) as executor:
+        results = list(
+            executor.map(lambda _: buy(product_id, 3, barrier),
+                         range(buyers)))
+
+    product = db.get(Product, product_id)
+    db.refresh(product)
+    assert all(results)
+    assert product.remaining_yield == 100 - 3 * buyers
+
+
+def test_decrement_middleman_remaining_insufficient(db: Session) -> None:
+    assert crud.decrement_middleman_remaining(session=db,
+                                              middleman_id=0,
+                                              quantity=1) is None
+
+
+def test_inventory_balance_from_snapshot_and_ledger(db: Session) -> None:
+    grower = create_random_grower(db, total_yield=100)
+    product_id = grower.products[0].id
+
+    def move(delta: float) -> None:
+        crud.record_inventory_movement(session=db,
+                                       node_type="product",
+                                       node_id=product_id,
+                                       delta=delta,
+                                       reason="stock" if delta > 0 else "sale")
+        db.commit()
+
+    def balance(as_of: datetime | None = None) -> float:
+        return crud.get_inventory_balance(session=db,
+                                          node_type="product",
+                                          node_id=product_id,
+                                          as_of=as_of)
+
+    move(100)
+    move(-30)
+    assert balance() == 70
+
+    with Session(engine) as session:
+        assert crud.compact_inventory(session=session,
+                                      grace=timedelta(0)) >= 1
+    compacted_at = datetime.utcnow()
+    assert balance() == 70
+
+    move(-20)
+    assert balance() == 50
+    assert balance(as_of=compacted_at) == 70
+
+    # 再次压缩只会在已有快照上累加新流水
+    with Session(engine) as session:
+        crud.compact_inventory(session=session, grace=timedelta(0))
+    assert balance() == 50
+    assert balance(as_of=compacted_at) == 70
+
+
+def test_compaction_does_not_block_inflight_purchases(db: Session) -> None:
+    grower = create_random_grower(db, total_yield=100)
+    product_id = grower.products[0].id
+    crud.record_inventory_movement(session=db,
+                                   node_type="product",
+                                   node_id=product_id,
+                                   delta=100,
+                                   reason="stock")
+    db.flush()
+    db.execute(
+        update(InventoryMovement).where(
+            InventoryMovement.node_type == "product",
+            InventoryMovement.node_id == product_id).values(
+                created_at=datetime.utcnow() - timedelta(hours=1)))
+    db.commit()
+
+    with Session(engine) as buyer, Session(engine) as compactor:
+        # 未提交的出库流水：压缩不加表锁，不会等待它，也不会把它折叠进快照
+        crud.record_inventory_movement(session=buyer,
+                                       node_type="product",
+                                       node_id=product_id,
+                                       delta=-30,
+                                       reason="sale")
+        buyer.flush()
+        compactor.execute(text("SET lock_timeout = '1s'"))
+        assert crud.compact_inventory(session=compactor) >= 1
+        buyer.commit()
+
+    assert crud.get_inventory_balance(session=db,
+                                      node_type="product",
+                                      node_id=product_id) == 70
@@ -0,0 +1,44 @@
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+from app import crud
+from app.tests.utils.trac import create_middleman_purchase, create_random_grower
+
+
+def test_middleman_lineage(client: TestClient, db: Session) -> None:
+    grower = create_random_grower(db)
+    product = grower.products[0].name
+    first = create_middleman_purchase(client,
+                                      purchase_from_type="grower",
+                                      purchase_from_id=grower.id,
+                                      product=product,
+                                      quantity=100)
+    second = create_middleman_purchase(client,
+                                       purchase_from_type="middleman",
+                                       purchase_from_id=first["id"],
+                                       product=product,
+                                       quantity=60)
+    third = create_middleman_purchase(client,
+                                      purchase_from_type="middleman",
+                                      purchase_from_id=second["id"],
+                                      product=product,
+                                      quantity=20)
+
+    upstream = crud.get_middleman_upstream(session=db, middleman_id=third["id"])
+    assert [(row.ancestor_type, row.ancestor_id, row.depth)
+            for row, _, _ in upstream] == [
+                ("middleman", second["id"], 1),
+                ("middleman", first["id"], 2),
+                ("grower", grower.id, 3),
+            ]
+    assert upstream[-1][0].quantity_path == [100, 60, 20]
+    assert upstream[-1][2].id == grower.id
+
+    downstream = crud.get_middleman_downstream(session=db,
+                                               ancestor_type="grower",
+                                               ancestor_id=grower.id)
+    assert [(row.descendant_id, row.depth) for row, _ in downstream] == [
+        (first["id"], 1),
+        (second["id"], 2),
+        (third["id"], 3),
+    ]
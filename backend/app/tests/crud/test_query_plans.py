@@ -0,0 +1,137 @@
+from collections.abc import Iterator
+from typing import Any
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event, text
+from sqlalchemy.orm import with_parent
+from sqlmodel import Session, select
+
+from app import crud
+from app.models import Grower, Middleman, Transaction
+from app.tests.utils.trac import create_middleman_purchase, create_random_grower
+from app.tests.utils.utils import random_lower_string
+
+SEED_GROWERS = 30
+
+# 溯源、采购与召回路径上的热点查询，直接取自 crud 的语句构造函数和模型关系
+HOT_QUERIES: dict[str, Any] = {
+    "product_by_grower_and_name":
+    crud.get_product_by_grower_and_name_statement(grower_id=1,
+                                                  product_name="apple"),
+    "products_by_grower_and_names":
+    crud.get_products_by_grower_and_names_statement(keys=[(1, "apple"),
+                                                          (2, "pear")]),
+    "middlemen_by_source":
+    select(Middleman).where(
+        with_parent(Middleman(id=1), Middleman.sold_to_middlemen)),
+    "transactions_by_grower_seller":
+    select(Transaction).where(
+        with_parent(Grower(id=1), Grower.sold_transactions)),
+    "transactions_by_middleman_seller":
+    select(Transaction).where(
+        with_parent(Middleman(id=1), Middleman.sold_transactions)),
+    "child_transactions":
+    select(Transaction).where(
+        with_parent(Transaction(id=1), Transaction.child_transactions)),
+    "transaction_by_qr_code":
+    crud.get_transaction_by_qr_code_statement(qr_code="transaction.png"),
+    "qr_code_info":
+    crud.get_qr_code_info_statement(qr_code="transaction.png", max_depth=10),
+    "middleman_by_split_qr_code":
+    crud.get_middleman_by_split_qr_code_statement(
+        url="https://www.example.com/a.png"),
+    "qr_code_payload":
+    crud.get_qr_code_payload_statement(qr_code="middleman.png"),
+    "split_lots":
+    crud.get_split_lots_statement(middleman_id=1),
+    "split_lots_by_middlemen":
+    crud.get_split_lots_by_middlemen_statement(middleman_ids=[1, 2]),
+    "split_lots_by_key":
+    crud.get_split_lots_by_keys_statement(keys=[(1, 0), (2, 1)]),
+    "lineage_upstream":
+    crud.get_middlemen_upstream_statement(middleman_ids=[1, 2]),
+    "lineage_downstream":
+    crud.get_middleman_downstream_statement(ancestor_type="grower",
+                                            ancestor_id=1),
+    "recall_grower":
+    crud.get_recall_statement(grower_id=1),
+    "recall_product":
+    crud.get_recall_statement(grower_id=1, product_name="apple"),
+    "inventory_tail":
+    crud.get_inventory_tail_statement(node_type="product",
+                                      node_id=1,
+                                      after_id=0),
+}
+
+
+def plan_nodes(plan: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from plan_nodes(child)
+
+
+def seq_scanned_tables(session: Session, statement: Any) -> set[str]:
+    plans = []
+
+    # 用驱动实际收到的 SQL 和参数在同一游标上 EXPLAIN，再照常执行原语句
+    def explain(connection: Any, cursor: Any, sql: str, parameters: Any,
+                context: Any, executemany: bool) -> None:
+        cursor.execute(f"EXPLAIN (FORMAT JSON) {sql}", parameters)
+        plans.append(cursor.fetchone()[0])
+
+    connection = session.connection()
+    # 关闭顺序扫描后仍出现 Seq Scan，说明该表上没有可用索引
+    connection.execute(text("SET LOCAL enable_seqscan = off"))
+    event.listen(connection, "before_cursor_execute", explain)
+    try:
+        connection.execute(statement)
+    finally:
+        event.remove(connection, "before_cursor_execute", explain)
+        session.rollback()
+    plan = plans[0]
+    return {
+        node["Relation Name"]
+        for node in plan_nodes(plan[0]["Plan"])
+        if node["Node Type"] == "Seq Scan"
+    }
+
+
+@pytest.fixture(scope="module", autouse=True)
+def seeded(client: TestClient, db: Session) -> None:
+    # 多个种植者，各自带两级中间商、拆分批次和一条交易链，使统计信息接近真实分布
+    for _ in range(SEED_GROWERS):
+        grower = create_random_grower(db)
+        product = grower.products[0]
+        first = create_middleman_purchase(client,
+                                          purchase_from_type="grower",
+                                          purchase_from_id=grower.id,
+                                          product=product.name,
+                                          quantity=100,
+                                          split_quantities=[40, 60])
+        create_middleman_purchase(client,
+                                  purchase_from_type="middleman",
+                                  purchase_from_id=first["id"],
+                                  product=product.name,
+                                  quantity=40,
+                                  purchase_from_split_index=0)
+        parent_id = None
+        for _ in range(3):
+            transaction = Transaction(product_id=product.id,
+                                      seller_type="grower",
+                                      seller_id=grower.id,
+                                      buyer_id=first["id"],
+                                      quantity=1,
+                                      parent_transaction_id=parent_id,
+                                      qr_code=random_lower_string())
+            db.add(transaction)
+            db.flush()
+            parent_id = transaction.id
+    db.commit()
+    db.execute(text("ANALYZE"))
+    db.commit()
+
+
+@pytest.mark.parametrize("name", HOT_QUERIES)
+def test_hot_query_uses_index(db: Session, name: str) -> None:
+    assert seq_scanned_tables(db, HOT_QUERIES[name]) == set()
@@ -0,0 +1,83 @@
+import pytest
+from sqlalchemy import event
+from sqlmodel import Session
+
+from app import crud
+from app.core.db import engine
+from app.models import Middleman, Plot, Product, Transaction
+from app.tests.utils.trac import create_random_grower
+from app.tests.utils.utils import random_lower_string
+
+
+def create_transaction_chain(db: Session, hops: int) -> Transaction:
+    grower = create_random_grower(db)
+    product = grower.products[0]
+    # 再加一个地块和产品，溯源结果应列出种植者的全部地块和产品
+    other_plot = Plot(location_coordinates="1,1", grower_id=grower.id)
+    db.add(other_plot)
+    db.flush()
+    db.add(
+        Product(name=random_lower_string(),
+                crop_type="pear",
+                total_yield=10,
+                remaining_yield=10,
+                plot_id=other_plot.id,
+                grower_id=grower.id))
+    buyer = Middleman(phone_number="13900000000", middleman_type="individual")
+    db.add(buyer)
+    db.flush()
+    parent_id = None
+    for _ in range(hops):
+        transaction = Transaction(product_id=product.id,
+                                  seller_type="grower",
+                                  seller_id=grower.id,
+                                  buyer_id=buyer.id,
+                                  quantity=1,
+                                  parent_transaction_id=parent_id,
+                                  qr_code=random_lower_string())
+        db.add(transaction)
+        db.flush()
+        parent_id = transaction.id
+    db.commit()
+    return transaction
+
+
+@pytest.mark.parametrize("hops", [1, 10, 100])
+def test_get_qr_code_info_query_count(db: Session, hops: int) -> None:
+    transaction = create_transaction_chain(db, hops)
+    db.refresh(transaction)
+    db.expunge_all()
+
+    statements = []
+
+    def count(*args, **kwargs):  # type: ignore[no-untyped-def]
+        statements.append(args[2])
+
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        info = crud.get_qr_code_info(session=db, qr_code=transaction.qr_code)
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+    assert info
+    assert len(info.transactions) == hops
+    assert info.transactions[0].id == transaction.id
+    assert info.transactions[-1].parent_transaction_id is None
+    assert info.product.id == transaction.product_id
+    assert len(info.grower.plots) == 2
+    assert len(info.grower.products) == 2
+    # 溯源链一条查询，种植者的地块和产品各一条
+    assert len(statements) == 3
+
+
+def test_get_qr_code_info_depth_limit(db: Session) -> None:
+    transaction = create_transaction_chain(db, 10)
+    info = crud.get_qr_code_info(session=db,
+                                 qr_code=transaction.qr_code,
+                                 max_depth=3)
+    assert info
+    assert len(info.transactions) == 4
+
+
+def test_get_qr_code_info_not_found(db: Session) -> None:
+    assert crud.get_qr_code_info(session=db, qr_code="missing") is None
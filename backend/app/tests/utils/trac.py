@@ -0,0 +1,59 @@
+from typing import Any
+
+from fastapi.testclient import TestClient
+from sqlmodel import Session
+
+from app.core.config import settings
+from app.models import Grower, Plot, Product
+from app.tests.utils.utils import random_lower_string
+
+
+def create_random_grower(db: Session,
+                         *,
+                         total_yield: float = 1000.0) -> Grower:
+    grower = Grower(name=random_lower_string(),
+                    phone_number="13800000000",
+                    grower_type="individual",
+                    id_card_photo=[],
+                    crop_type_pic=[],
+                    qr_code=random_lower_string())
+    db.add(grower)
+    db.flush()
+    plot = Plot(location_coordinates="0,0", grower_id=grower.id)
+    db.add(plot)
+    db.flush()
+    product = Product(name=random_lower_string(),
+                      crop_type="apple",
+                      total_yield=total_yield,
+                      remaining_yield=total_yield,
+                      plot_id=plot.id,
+                      grower_id=grower.id)
+    db.add(product)
+    db.commit()
+    db.refresh(grower)
+    return grower
+
+
+def create_middleman_purchase(client: TestClient,
+                              *,
+                              purchase_from_type: str,
+                              purchase_from_id: int,
+                              product: str,
+                              quantity: float,
+                              split_quantities: list[float] | None = None,
+                              purchase_from_split_index: int | None = None
+                              ) -> dict[str, Any]:
+    data = {
+        "name": random_lower_string(),
+        "phone_number": "13900000000",
+        "middleman_type": "individual",
+        "purchase_from_type": purchase_from_type,
+        "purchase_from_id": purchase_from_id,
+        "purchased_product": product,
+        "purchased_quantity": quantity,
+        "split_quantities": split_quantities,
+        "purchase_from_split_index": purchase_from_split_index,
+    }
+    r = client.post(f"{settings.API_V1_STR}/trac/middlemen/", json=data)
+    assert r.status_code == 200, r.text
+    return r.json()["data"]
@@ -9,9 +9,9 @@ from dataclasses import dataclass
 from datetime import datetime, timedelta
 from pathlib import Path
 from typing import Any, Optional
+from urllib.parse import urlparse
 
 import emails  # type: ignore
-import qrcode
 from aliyunsdkcore.client import AcsClient
 from aliyunsdkcore.request import CommonRequest
 from fastapi import UploadFile
@@ -20,7 +20,8 @@ from jose import JWTError, jwt
 from pydantic import TypeAdapter
 
 from app.core.config import settings
-from app.core.redis_conf import redis_client
+from app.core.redis_conf import async_redis_client, redis_client
+from app.qr_render import qr_code_filename, qr_code_subpath, render_qr_code
 
 client = AcsClient(settings.ACCESS_KEY_ID, settings.ACCESS_KEY_SECRET,
                    settings.REGION)
@@ -37,7 +38,7 @@ def decode_qr_code(qr_code_filename: str) -> str:
     """
     # Construct the full path to the QR code image
     qr_code_path = os.path.join("uploads", "middleman_qrcodes",
-                                qr_code_filename)
+                                qr_code_subpath(qr_code_filename))
 
     # Open the image file
     with Image.open(qr_code_path) as img:
@@ -103,6 +104,17 @@ def verify_code(phone_number: str, code: str) -> bool:
     return False
 
 
+async def verify_code_async(phone_number: str, code: str) -> bool:
+    """
+    Same as ``verify_code`` on the asyncio Redis client, for async routes.
+    """
+    stored_code = await async_redis_client.get(f"verification:{phone_number}")
+    if stored_code and stored_code == code:
+        await async_redis_client.delete(f"verification:{phone_number}")
+        return True
+    return False
+
+
 def model_to_dict(obj, output_model):
     return TypeAdapter(output_model).validate_python(obj)
 
@@ -111,39 +123,52 @@ def generate_qr_code(data, prefix="qrcode", directory="qrcodes"):
     """
     Generate a QR code and save it as an image file.
 
+    With ``QR_EAGER_RENDER`` off only the name is chosen; the caller records
+    the payload and the image is rendered on demand when first requested.
+
     :param data: The data to be encoded in the QR code.
     :param prefix: Prefix for the filename (default: "qrcode").
     :param directory: Directory to save the QR code image (default: "qrcodes").
     :return: The filename of the generated QR code image.
     """
-    # Ensure the directory exists
-    os.makedirs(directory, exist_ok=True)
-
-    # Generate a unique filename
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    filename = f"{prefix}_{timestamp}.png"
-    filepath = os.path.join(directory, filename)
-
-    # Create QR code instance
-    qr = qrcode.QRCode(
-        version=None,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
+    # 文件名由内容哈希决定，相同内容复用已生成的图片
+    filename = qr_code_filename(data, prefix)
+    if settings.QR_EAGER_RENDER:
+        render_qr_code(data,
+                       os.path.join(directory, qr_code_subpath(filename)))
 
-    # Add data
-    qr.add_data(str(data))
-    qr.make(fit=True)
+    return filename, qr_code_url(filename, directory)
 
-    # Create an image from the QR Code instance
-    img = qr.make_image(fill_color="black", back_color="white")
 
-    # Save the image
-    img.save(filepath)
-    full_url = f"https://www.{settings.DOMAIN}/{directory}/{filename}"
+def qr_code_url(filename: str, directory: str = "qrcodes") -> str:
+    """
+    Return the public URL of a QR code image, as stored on the owning row:
+    the static file when images are rendered eagerly, otherwise the
+    on-demand image endpoint.
+    """
+    if not settings.QR_EAGER_RENDER:
+        return (f"https://www.{settings.DOMAIN}{settings.API_V1_STR}"
+                f"/trac/qr_code/{filename}/image")
+    return qr_code_file_url(filename, directory)
+
 
-    return filename, full_url
+def qr_code_file_url(filename: str, directory: str = "qrcodes") -> str:
+    """
+    Return the URL of a QR code image file under ``directory``.
+    """
+    subpath = qr_code_subpath(filename)
+    return f"https://www.{settings.DOMAIN}/{directory}/{subpath}"
+
+
+def qr_code_filename_from_url(url: str) -> str:
+    """
+    Return the QR code filename in a URL from ``qr_code_url``, whether it
+    points at the static file or at the on-demand image endpoint.
+    """
+    path = urlparse(url).path
+    if path.endswith("/image"):
+        path = path[:-len("/image")]
+    return os.path.basename(path)
 
 
 # def generate_qr_code(id: int, data: str, directory: str) -> str:
@@ -0,0 +1,87 @@
+"""
+Purchase throughput on one source product as the number of buyers grows.
+
+Creates a product with plenty of stock, then for each ``--buyers`` count
+runs that many threads, each committing ``--purchases`` single-unit
+purchases through ``decrement_product_yield``, and prints purchases per
+second. The product and its grower are deleted at the end.
+
+    python scripts/bench_inventory.py --buyers 1 10 50 --purchases 50
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlmodel import Session
+
+from app import crud
+from app.core.db import engine
+from app.models import Grower, Plot, Product
+
+
+def buy(product_id: int, purchases: int, barrier: threading.Barrier) -> int:
+    bought = 0
+    barrier.wait()
+    for _ in range(purchases):
+        with Session(engine) as session:
+            if crud.decrement_product_yield(session=session,
+                                            product_id=product_id,
+                                            quantity=1) is not None:
+                bought += 1
+            session.commit()
+    return bought
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--buyers", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--purchases", type=int, default=50)
+    args = parser.parse_args()
+
+    stock = sum(args.buyers) * args.purchases
+    with Session(engine) as session:
+        grower = Grower(name="bench",
+                        phone_number="13800000000",
+                        grower_type="individual",
+                        id_card_photo=[],
+                        crop_type_pic=[])
+        session.add(grower)
+        session.flush()
+        plot = Plot(location_coordinates="0,0", grower_id=grower.id)
+        session.add(plot)
+        session.flush()
+        product = Product(name="bench",
+                          crop_type="apple",
+                          total_yield=stock,
+                          remaining_yield=stock,
+                          plot_id=plot.id,
+                          grower_id=grower.id)
+        session.add(product)
+        session.commit()
+        product_id = product.id
+
+    try:
+        for buyers in args.buyers:
+            barrier = threading.Barrier(buyers)
+            with ThreadPoolExecutor(max_workers=buyers) as executor:
+                start = time.perf_counter()
+                bought = sum(
+                    executor.map(
+                        lambda _: buy(product_id, args.purchases, barrier),
+                        range(buyers)))
+                elapsed = time.perf_counter() - start
+            print(f"{buyers:>4} buyers: {bought / elapsed:8.0f} purchases/s")
+    finally:
+        with Session(engine) as session:
+            product = session.get(Product, product_id)
+            print(f"remaining: {product.remaining_yield} "
+                  f"(expected {stock - sum(args.buyers) * args.purchases})")
+            session.delete(product)
+            session.delete(session.get(Plot, product.plot_id))
+            session.delete(session.get(Grower, product.grower_id))
+            session.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compare OFFSET and keyset (cursor) pagination of the grower list.
+
+Seeds ``--rows`` growers inside a transaction that is rolled back at the
+end, then times fetching page 1 and page ``--page`` of ``--limit`` rows with
+both strategies, using the same statements as ``list_growers``.
+
+    python scripts/bench_pagination.py --rows 1000000 --page 1000
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import text
+from sqlmodel import Session, select
+
+from app.api.pagination import encode_cursor, paginate
+from app.core.db import engine
+from app.models import Grower
+
+
+def timed(session: Session, statement, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        session.exec(statement).all()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--page", type=int, default=1000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with Session(engine) as session:
+        session.execute(
+            text("""
+                INSERT INTO grower (name, phone_number, grower_type)
+                SELECT 'bench_' || g, '13800000000', 'individual'
+                FROM generate_series(1, :rows) AS g
+            """), {"rows": args.rows})
+        session.execute(text("ANALYZE grower"))
+
+        skip = (args.page - 1) * args.limit
+        # 第 page 页之前最后一行的 id，即客户端逐页翻到此处时持有的游标
+        last_id = session.exec(
+            select(Grower.id).order_by(Grower.id).offset(skip - 1).limit(1)
+        ).one()
+        cursor = encode_cursor(last_id)
+
+        print(f"rows: {args.rows}, limit: {args.limit}")
+        for page, page_skip, page_cursor in ((1, 0, None),
+                                             (args.page, skip, cursor)):
+            offset_ms = timed(
+                session,
+                paginate(select(Grower), Grower.id, skip=page_skip,
+                         limit=args.limit, cursor=None), args.repeat)
+            keyset_ms = timed(
+                session,
+                paginate(select(Grower), Grower.id, skip=0,
+                         limit=args.limit, cursor=page_cursor), args.repeat)
+            print(f"page {page:>5}: offset {offset_ms:8.2f} ms   "
+                  f"keyset {keyset_ms:8.2f} ms")
+
+        session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Compare QR label output formats: render time and bytes per label.
+
+Renders ``--labels`` split QR payloads as PNG (the ``generate_qr_code``
+path, rasterized by PIL at ``--box-size`` pixels per module), SVG, ZPL and
+a PDF sheet, and prints the average time and size per label for each.
+
+    python scripts/bench_qr_formats.py --labels 300 --box-size 10
+"""
+import argparse
+import time
+
+from app import qr_labels, qr_render
+from app.api.routes.transactions import split_qr_payload
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--labels", type=int, default=300)
+    parser.add_argument("--box-size", type=int, default=10)
+    parser.add_argument("--border", type=int, default=4)
+    args = parser.parse_args()
+
+    payloads = [split_qr_payload(1000, index) for index in range(args.labels)]
+    # 无边框时矩阵边长为 17 + 4 * 版本号
+    version = (len(qr_render.make_qr_matrix(payloads[0], border=0)) - 17) // 4
+    print(f"labels: {args.labels}, box size: {args.box_size}, "
+          f"QR version: {version}")
+
+    for image_format in ("png", "jpeg", "svg", "zpl"):
+        start = time.perf_counter()
+        size = sum(
+            len(
+                qr_render.render_qr_image(payload,
+                                          box_size=args.box_size,
+                                          border=args.border,
+                                          image_format=image_format))
+            for payload in payloads)
+        elapsed = time.perf_counter() - start
+        print(f"{image_format:>5}: {elapsed / args.labels * 1000:8.3f} ms"
+              f"   {size / args.labels:10.0f} bytes per label")
+
+    # PDF 按整张标签纸生成，时间和大小按标签数均摊
+    start = time.perf_counter()
+    labels = ((qr_render.make_qr_matrix(payload, border=args.border),
+               f"middleman_1000_split_{index}")
+              for index, payload in enumerate(payloads))
+    size = sum(len(chunk) for chunk in qr_labels.iter_pdf_sheets(labels))
+    elapsed = time.perf_counter() - start
+    print(f"{'pdf':>5}: {elapsed / args.labels * 1000:8.3f} ms"
+          f"   {size / args.labels:10.0f} bytes per label")
+
+
+if __name__ == "__main__":
+    main()
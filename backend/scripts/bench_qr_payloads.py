@@ -0,0 +1,79 @@
+"""
+Compare JSON and compact token QR payloads for split lots.
+
+Builds ``--labels`` split payloads in each ``QR_PAYLOAD_FORMAT`` and prints
+the QR version, PNG render time and size, scan time (pyzbar on the
+rendered PNG) and the time to turn the scanned text back into a
+middleman id and split index.
+
+    python scripts/bench_qr_payloads.py --labels 300
+"""
+import argparse
+import io
+import json
+import time
+
+from PIL import Image
+from pyzbar.pyzbar import decode
+
+from app import qr_render
+from app.api.routes.transactions import split_qr_payload
+from app.core.config import settings
+from app.qr_token import decode_qr_token
+
+
+def parse_json(payload: str) -> tuple[int, int]:
+    data = json.loads(payload)["data"]
+    return data["middleman_id"], data["split_index"]
+
+
+def parse_token(payload: str) -> tuple[int, int]:
+    token = decode_qr_token(payload)
+    return token.node_id, token.split_index
+
+
+def per_label_ms(func, items: list) -> tuple[float, list]:
+    start = time.perf_counter()
+    results = [func(item) for item in items]
+    return (time.perf_counter() - start) / len(items) * 1000, results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--labels", type=int, default=300)
+    parser.add_argument("--middleman-id", type=int, default=123456)
+    parser.add_argument("--skip-scan",
+                        action="store_true",
+                        help="skip pyzbar, e.g. where libzbar is missing")
+    args = parser.parse_args()
+
+    box_size = qr_render.RENDER_PARAMS["box_size"]
+    border = qr_render.RENDER_PARAMS["border"]
+    for payload_format, parse in (("json", parse_json), ("token",
+                                                         parse_token)):
+        settings.QR_PAYLOAD_FORMAT = payload_format
+        payloads = [
+            split_qr_payload(args.middleman_id, index)
+            for index in range(args.labels)
+        ]
+        # 无边框时矩阵边长为 17 + 4 * 版本号
+        version = (len(qr_render.make_qr_matrix(payloads[-1], border=0)) -
+                   17) // 4
+        render_ms, images = per_label_ms(
+            lambda payload: qr_render.render_qr_image(
+                payload, box_size=box_size, border=border, image_format="png"),
+            payloads)
+        parse_ms, _ = per_label_ms(parse, payloads)
+        line = (f"{payload_format:>5}: {len(payloads[-1]):4d} chars  "
+                f"version {version:2d}  render {render_ms:7.3f} ms  "
+                f"{sum(map(len, images)) / len(images):6.0f} bytes  "
+                f"parse {parse_ms * 1000:7.2f} us")
+        if not args.skip_scan:
+            scan_ms, _ = per_label_ms(
+                lambda image: decode(Image.open(io.BytesIO(image))), images)
+            line += f"  scan {scan_ms:7.3f} ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Load benchmark for consumer QR scans.
+
+Fires ``--requests`` GET /trac/qr_code/{qr_code} calls at a running server
+with ``--concurrency`` of them in flight at once and prints throughput and
+latency percentiles. Pass ``--path`` to benchmark any other GET endpoint.
+
+    python scripts/bench_qr_scan.py --qr-code middleman_1_main_xxx.png
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+
+async def run(url: str, concurrency: int, total: int) -> None:
+    latencies: list[float] = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+
+        async def scan() -> None:
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(url)
+                    if response.status_code != 200:
+                        errors += 1
+                except httpx.HTTPError:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(scan() for _ in range(total)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100)
+    print(f"url:          {url}")
+    print(f"concurrency:  {concurrency}")
+    print(f"requests:     {total} ({errors} errors)")
+    print(f"throughput:   {total / elapsed:.1f} req/s")
+    print(f"latency p50:  {quantiles[49] * 1000:.1f} ms")
+    print(f"latency p95:  {quantiles[94] * 1000:.1f} ms")
+    print(f"latency p99:  {quantiles[98] * 1000:.1f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--base-url", default="http://localhost:8000/api/v1")
+    parser.add_argument("--qr-code", help="QR code file name to scan")
+    parser.add_argument("--path", help="GET path under --base-url instead")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=5000)
+    args = parser.parse_args()
+
+    if not args.path and not args.qr_code:
+        parser.error("one of --qr-code or --path is required")
+    path = args.path or f"/trac/qr_code/{args.qr_code}"
+    asyncio.run(run(args.base_url.rstrip("/") + path, args.concurrency,
+                    args.requests))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Time tracing a transaction QR code back through its parent chain.
+
+Seeds one chain of ``--hops`` transactions per requested length inside a
+transaction that is rolled back at the end, then times
+``get_qr_code_info`` on the last transaction of each chain.
+
+    python scripts/bench_trace.py --hops 1 10 100
+"""
+import argparse
+import statistics
+import time
+import uuid
+
+from sqlmodel import Session
+
+from app import crud
+from app.core.db import engine
+from app.models import Grower, Middleman, Plot, Product, Transaction
+
+
+def seed_chain(session: Session, hops: int) -> str:
+    grower = Grower(name="bench",
+                    phone_number="13800000000",
+                    grower_type="individual",
+                    id_card_photo=[],
+                    crop_type_pic=[],
+                    qr_code=f"bench_{uuid.uuid4().hex}")
+    session.add(grower)
+    session.flush()
+    plot = Plot(location_coordinates="0,0", grower_id=grower.id)
+    session.add(plot)
+    session.flush()
+    product = Product(name="bench",
+                      crop_type="apple",
+                      total_yield=1000,
+                      remaining_yield=1000,
+                      plot_id=plot.id,
+                      grower_id=grower.id)
+    buyer = Middleman(phone_number="13900000000", middleman_type="individual")
+    session.add_all([product, buyer])
+    session.flush()
+
+    parent_id = None
+    for _ in range(hops):
+        transaction = Transaction(product_id=product.id,
+                                  seller_type="grower",
+                                  seller_id=grower.id,
+                                  buyer_id=buyer.id,
+                                  quantity=1,
+                                  parent_transaction_id=parent_id,
+                                  qr_code=f"bench_{uuid.uuid4().hex}")
+        session.add(transaction)
+        session.flush()
+        parent_id = transaction.id
+    return transaction.qr_code
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hops", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with Session(engine) as session:
+        qr_codes = {hops: seed_chain(session, hops) for hops in args.hops}
+        for hops, qr_code in qr_codes.items():
+            timings = []
+            for _ in range(args.repeat):
+                session.expunge_all()
+                start = time.perf_counter()
+                info = crud.get_qr_code_info(session=session, qr_code=qr_code)
+                timings.append(time.perf_counter() - start)
+                assert info and len(info.transactions) == hops
+            print(f"{hops:>4}-hop trace: "
+                  f"{statistics.median(timings) * 1000:8.2f} ms")
+        session.rollback()
+
+
+if __name__ == "__main__":
+    main()